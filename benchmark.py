@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Benchmark harness for pg_bloat_check.py. Builds a synthetic catalog in a throwaway database and measures
+# the queries per object, runtime and peak memory of the scan, report and rebuild paths.
+
+import argparse, contextlib, json, os, psycopg2, sys, threading, time, tracemalloc
+
+parser = argparse.ArgumentParser(description="Benchmark the scan, report and rebuild paths of pg_bloat_check.py against a synthetic catalog. A recording psycopg2 connection counts every query & commit sent to the database. The bloat statistics tables in the target database are dropped & recreated, so only run this against a throwaway database. Exits with an error if a result is noticeably worse than the saved baseline.")
+parser.add_argument('-c','--connection', default="host=", help="Connection string of the throwaway database to benchmark against. The pgstattuple extension must be installed in it.")
+parser.add_argument('--tables', type=int, default=10000, help="Number of synthetic tables to create. Each table has a TOAST table and three indexes. Default is 10000.")
+parser.add_argument('--schema', default="bloat_bench", help="Schema the synthetic tables are created in. Default is bloat_bench.")
+parser.add_argument('--setup', action="store_true", help="Create the synthetic tables (dropping the schema first if it exists) and the bloat statistics tables, then run the benchmarks.")
+parser.add_argument('--teardown', action="store_true", help="Drop the synthetic schema and exit.")
+parser.add_argument('--paths', default="scan,report,rebuild", help="Comma separated list of paths to benchmark. Default is scan,report,rebuild.")
+parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"), help="File the results are compared against. Default is benchmark_baseline.json next to this script, which holds the queries per object of the default --tables and is the same on every machine.")
+parser.add_argument('--save_baseline', action="store_true", help="Save the results as the new baseline instead of comparing against it. Only the queries per object and the values of the metrics given a tolerance are saved.")
+parser.add_argument('--query_tolerance', type=float, default=5, help="Percentage that queries per object may grow over the baseline before the benchmark fails. Default is 5.")
+parser.add_argument('--runtime_tolerance', type=float, help="Percentage that runtime may grow over the baseline before the benchmark fails. Runtime depends on the machine, so it is only compared when this is set, against a baseline saved on the same machine with this set.")
+parser.add_argument('--memory_tolerance', type=float, help="Percentage that peak memory may grow over the baseline before the benchmark fails. Only measured & compared when this is set, against a baseline saved with this set. Memory is measured in a second run of each path since tracing it slows the first down.")
+parser.add_argument('--jobs', type=int, default=1, help="Value of --jobs used for the scan path. Default is 1.")
+bench_args = parser.parse_args()
+
+import pg_bloat_check
+
+# Whether a table needs analyzing depends on autovacuum timing, so it is skipped to keep query counts comparable between runs
+pg_bloat_check.configure(connection=bench_args.connection, schema=bench_args.schema, jobs=bench_args.jobs, noanalyze=True)
+
+
+class QueryCounter:
+    """
+    Counts the queries & commits sent through every CountingConnection. Safe to share between scan workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.queries = 0
+            self.commits = 0
+
+
+    def add_query(self):
+        with self.lock:
+            self.queries += 1
+
+
+    def add_commit(self):
+        with self.lock:
+            self.commits += 1
+## end class QueryCounter
+
+counter = QueryCounter()
+cursor_classes = {}
+
+
+def counting_cursor_class(base):
+    """
+    Returns a subclass of the given cursor class that counts its executes. Classes are cached so
+    each cursor factory used by pg_bloat_check (plain, DictCursor) is only wrapped once.
+    """
+    if base not in cursor_classes:
+        class CountingCursor(base):
+            def execute(self, query, vars=None):
+                counter.add_query()
+                return super().execute(query, vars)
+        cursor_classes[base] = CountingCursor
+    return cursor_classes[base]
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that records every query & commit. Rows fetched by named cursors are not counted
+    as separate queries.
+    """
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = counting_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+
+    def commit(self):
+        counter.add_commit()
+        return super().commit()
+## end class CountingConnection
+
+
+def create_counting_conn(dbname=None):
+    if dbname != None:
+        return psycopg2.connect(psycopg2.extensions.make_dsn(bench_args.connection, dbname=dbname), connection_factory=CountingConnection)
+    return psycopg2.connect(bench_args.connection, connection_factory=CountingConnection)
+
+
+def drop_synthetic_catalog(conn):
+    """
+    Drop --schema if it exists. Its tables are dropped in batches first since every dropped relation holds a
+    lock until commit, which would run out of lock table space for a large --tables in a single transaction.
+    """
+    cur = conn.cursor()
+    cur.execute("""SELECT 'DROP TABLE ' || quote_ident(n.nspname) || '.' || quote_ident(c.relname)
+                   FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                   WHERE n.nspname = %s AND c.relkind = 'r'""", [bench_args.schema])
+    for i, r in enumerate(cur.fetchall()):
+        cur.execute(r[0])
+        if (i + 1) % 200 == 0:
+            conn.commit()
+    cur.execute("DROP SCHEMA IF EXISTS \"" + bench_args.schema + "\" CASCADE")
+    conn.commit()
+    cur.close()
+
+
+def create_synthetic_catalog(conn):
+    """
+    Create --tables tables in --schema, each with text columns so it has a TOAST table, a primary key and two
+    secondary indexes. A few rows are inserted & updated in each so every object has pages with dead tuples
+    and free space to scan, and two large values per table are stored out of line in its TOAST table. Tables are created in
+    batches since every new relation holds a lock until commit.
+    """
+    drop_synthetic_catalog(conn)
+    cur = conn.cursor()
+    cur.execute("CREATE SCHEMA \"" + bench_args.schema + "\"")
+    conn.commit()
+    batch_size = 200
+    for batch_start in range(0, bench_args.tables, batch_size):
+        batch_end = min(batch_start + batch_size, bench_args.tables)
+        sql = """DO $$
+                 BEGIN
+                    FOR i IN %(batch_start)s..%(batch_end)s - 1 LOOP
+                        EXECUTE format('CREATE TABLE %%I.%%I (id bigint PRIMARY KEY, val int, note text, doc text)', %(schema)s, 't' || i);
+                        EXECUTE format('CREATE INDEX ON %%I.%%I (val)', %(schema)s, 't' || i);
+                        EXECUTE format('CREATE INDEX ON %%I.%%I (note)', %(schema)s, 't' || i);
+                        EXECUTE format('INSERT INTO %%I.%%I SELECT g, g, repeat(''x'', 100) FROM generate_series(1, 20) g', %(schema)s, 't' || i);
+                        -- incompressible values large enough to be moved out to the TOAST table
+                        EXECUTE format('UPDATE %%I.%%I SET doc = (SELECT string_agg(md5(random()::text), '''') FROM generate_series(1, 100)) WHERE id <= 2', %(schema)s, 't' || i);
+                        EXECUTE format('UPDATE %%I.%%I SET val = val + 1 WHERE id <= 5', %(schema)s, 't' || i);
+                    END LOOP;
+                 END $$"""
+        cur.execute(sql, {'batch_start': batch_start, 'batch_end': batch_end, 'schema': bench_args.schema})
+        conn.commit()
+        print("Created " + str(batch_end) + " of " + str(bench_args.tables) + " tables", file=sys.stderr)
+    # analyzed up front so planner statistics of the synthetic tables match what a real catalog would have
+    cur.execute("""SELECT 'ANALYZE ' || quote_ident(n.nspname) || '.' || quote_ident(c.relname)
+                   FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                   WHERE n.nspname = %s AND c.relkind = 'r'""", [bench_args.schema])
+    # committed in batches like the tables, since each analyze holds its lock until commit
+    for i, r in enumerate(cur.fetchall()):
+        cur.execute(r[0])
+        if (i + 1) % batch_size == 0:
+            conn.commit()
+    conn.commit()
+    cur.close()
+    pg_bloat_check.create_stats_table(conn)
+    conn.commit()
+
+
+def measure(name, func, object_count_func):
+    """
+    Run func with the query counter reset, returning its queries per object and runtime. With --memory_tolerance,
+    func is run a second time with memory tracing on for its peak memory, so tracing does not add to the runtime.
+    Anything func outputs is discarded.
+    """
+    counter.reset()
+    start_time = time.time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        func()
+    runtime = time.time() - start_time
+    queries = counter.queries
+    commits = counter.commits
+    object_count = object_count_func()
+    result = { 'objects': object_count
+             , 'queries': queries
+             , 'commits': commits
+             , 'queries_per_object': round((queries + commits) / max(object_count, 1), 4)
+             , 'runtime_seconds': round(runtime, 3) }
+    summary = (name + ": " + str(object_count) + " objects, " + str(queries) + " queries, " + str(commits) + " commits ("
+               + "{:.3f}".format(result['queries_per_object']) + " per object), " + "{:.2f}".format(runtime) + " seconds")
+
+    if bench_args.memory_tolerance != None:
+        tracemalloc.start()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            func()
+        result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        summary += ", " + "{:.1f}".format(result['peak_memory_bytes'] / 1048576) + " MB peak memory"
+    print(summary)
+    return result
+
+
+def bench_scan(conn):
+    def run():
+        # only the synthetic schema, without the pg_catalog schema that --schema always adds
+        pg_bloat_check.get_bloat(conn, (), (bench_args.schema,), [])
+
+    def object_count():
+        cur = conn.cursor()
+        cur.execute("SELECT objects_scanned FROM " + pg_bloat_check.bloat_table_name("bloat_runs") + " ORDER BY run_id DESC LIMIT 1")
+        count = cur.fetchone()[0]
+        conn.commit()
+        return count
+
+    return measure("scan", run, object_count)
+
+
+def bench_report(conn):
+    rows_output = [0]
+    def run():
+        rows_output[0] = pg_bloat_check.print_report_rows(pg_bloat_check.get_report_rows(conn))
+    return measure("report", run, lambda: rows_output[0])
+
+
+def bench_rebuild(conn):
+    index_count = [0]
+    def run():
+        pg_bloat_check.args.rebuild_index = True
+        try:
+            index_list = list(pg_bloat_check.get_report_rows(conn))
+            index_count[0] = len(index_list)
+            if index_list:
+                pg_bloat_check.rebuild_index(conn, index_list)
+        finally:
+            pg_bloat_check.args.rebuild_index = False
+    return measure("rebuild", run, lambda: index_count[0])
+
+
+def get_tolerances():
+    """
+    Returns the allowed percentage of growth of each metric compared against the baseline. Runtime & memory
+    depend on the machine, so they are left out unless their tolerance is set.
+    """
+    tolerances = { 'queries_per_object': bench_args.query_tolerance }
+    if bench_args.runtime_tolerance != None:
+        tolerances['runtime_seconds'] = bench_args.runtime_tolerance
+    if bench_args.memory_tolerance != None:
+        tolerances['peak_memory_bytes'] = bench_args.memory_tolerance
+    return tolerances
+
+
+def compare_to_baseline(results, baseline):
+    """
+    Returns a list of the results that are worse than the baseline by more than the allowed tolerance,
+    or that cannot be compared because the baseline does not have them.
+    """
+    regressions = []
+    for path, result in results.items():
+        if path not in baseline:
+            regressions.append(path + " is not in the baseline")
+            continue
+        if result['objects'] != baseline[path]['objects']:
+            print("Warning: " + path + " covered " + str(result['objects']) + " objects but the baseline covered " + str(baseline[path]['objects'])
+                  + ". Totals are not comparable, only per object values are.", file=sys.stderr)
+        for metric, tolerance in get_tolerances().items():
+            if metric not in baseline[path]:
+                regressions.append(path + " " + metric + " is not in the baseline. Save a baseline with its tolerance set to compare it")
+                continue
+            limit = baseline[path][metric] * (1 + tolerance / 100)
+            if result[metric] > limit:
+                regressions.append(path + " " + metric + " of " + str(result[metric]) + " is more than " + str(tolerance) + "% worse than the baseline of " + str(baseline[path][metric]))
+    return regressions
+
+
+if __name__ == "__main__":
+    pg_bloat_check.create_conn = create_counting_conn
+    conn = create_counting_conn()
+
+    if bench_args.teardown:
+        drop_synthetic_catalog(conn)
+        conn.close()
+        sys.exit(0)
+
+    if bench_args.setup:
+        create_synthetic_catalog(conn)
+    try:
+        pg_bloat_check.check_requirements(conn)
+    except pg_bloat_check.BloatCheckError as e:
+        print(str(e))
+        sys.exit(2)
+
+    benchmarks = { 'scan': bench_scan, 'report': bench_report, 'rebuild': bench_rebuild }
+    results = {}
+    for path in pg_bloat_check.create_list('csv', bench_args.paths):
+        if path not in benchmarks:
+            print("Unknown benchmark path: " + path)
+            sys.exit(2)
+        results[path] = benchmarks[path](conn)
+    conn.close()
+
+    if bench_args.save_baseline:
+        saved_metrics = ['objects', 'queries', 'commits'] + list(get_tolerances())
+        baseline = dict( (path, dict( (m, result[m]) for m in saved_metrics )) for path, result in results.items() )
+        with open(bench_args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print("Baseline saved to " + bench_args.baseline)
+        sys.exit(0)
+
+    if not os.path.exists(bench_args.baseline):
+        print("No baseline found at " + bench_args.baseline + ". Use --save_baseline to create one.")
+        sys.exit(2)
+
+    with open(bench_args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline)
+    if regressions:
+        for r in regressions:
+            print("REGRESSION: " + r)
+        sys.exit(1)
+    print("No regressions found compared to " + bench_args.baseline)
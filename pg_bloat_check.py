@@ -2,30 +2,86 @@
 
 # Script is maintained at https://github.com/keithf4/pg_bloat_check
 
-import argparse, csv, json, psycopg2, re, sys
-from psycopg2 import extras
-from random import randint
-
-version = "2.8.0"
-
-parser = argparse.ArgumentParser(description="Provide a bloat report for PostgreSQL tables and/or indexes. This script uses the pgstattuple contrib module which must be installed first. Note that the query to check for bloat can be extremely expensive on very large databases or those with many tables. The script stores the bloat stats in a table so they can be queried again as needed without having to re-run the entire scan. The table contains a timestamp columns to show when it was obtained.")
+import argparse, concurrent.futures, csv, datetime, fnmatch, getpass, json, math, os, psycopg2, queue, re, signal, sqlite3, sys, threading, time
+from psycopg2 import errors, extras
+from random import randint, randrange
+
+version = "2.9.0"
+
+class OptionParser(argparse.ArgumentParser):
+    """
+    Parser of the command line options. parse_options() raises ValueError for invalid options instead of
+    printing the usage & exiting, so that configure() never exits the program that imported this module.
+    """
+    raise_errors = False
+
+    def error(self, message):
+        if self.raise_errors:
+            raise ValueError(message)
+        super().error(message)
+
+    def parse_options(self, argv):
+        self.raise_errors = True
+        try:
+            return self.parse_args(argv)
+        finally:
+            self.raise_errors = False
+## end class OptionParser
+
+
+parser = OptionParser(description="Provide a bloat report for PostgreSQL tables and/or indexes. This script uses the pgstattuple contrib module which must be installed first. Note that the query to check for bloat can be extremely expensive on very large databases or those with many tables. The script stores the bloat stats in a table so they can be queried again as needed without having to re-run the entire scan. The table contains a timestamp columns to show when it was obtained.")
 args_general = parser.add_argument_group(title="General options")
 args_general.add_argument('-c','--connection', default="host=", help="""Connection string for use by psycopg. Defaults to "host=" (local socket).""")
-args_general.add_argument('-e', '--exclude_object_file', help="""Full path to file containing a list of objects to exclude from the report (tables and/or indexes). Each line is a CSV entry in the format: objectname,bytes_wasted,percent_wasted. All objects must be schema qualified. bytes_wasted & percent_wasted are additional filter values on top of -s, -p, and -z to exclude the given object unless these values are also exceeded. Set either of these values to zero (or leave them off entirely) to exclude the object no matter what its bloat level. Comments are allowed if the line is prepended with "#". See the README.md for clearer examples of how to use this for more fine grained filtering.""")
-args_general.add_argument('-f', '--format', default="simple", choices=["simple", "json", "jsonpretty", "dict"], help="Output formats. Simple is a plaintext version suitable for any output (ex: console, pipe to email). Object type is in parentheses (t=table, i=index, p=primary key). Json provides standardized json output which may be useful if taking input into something that needs a more structured format. Json also provides more details about dead tuples, empty space & free space. jsonpretty outputs in a more human readable format. Dict is the same as json but in the form of a python dictionary. Default is simple.")
+args_general.add_argument('--all_databases', action="store_true", help="Scan every database in the cluster that allows connections instead of only the database given by --connection. The --connection string is used to connect to each database with its dbname replaced. Databases are scanned concurrently within the --max_connections limit and a single report ordered by wasted space is output, with the database name added to every entry. Each database must have the pgstattuple extension & the statistics tables installed, otherwise it is skipped with a warning. Can be combined with --create_stats_table to create the statistics tables in every database. Cannot be combined with --rebuild_index or --trend.")
+args_general.add_argument('--include_database', help="Comma separated list of database names to scan with --all_databases. Shell style wildcards (*, ?, [seq]) are allowed. All other databases are skipped.")
+args_general.add_argument('--exclude_database', help="Comma separated list of database names to skip with --all_databases. Shell style wildcards (*, ?, [seq]) are allowed. Template databases are always skipped.")
+args_general.add_argument('--max_connections', type=int, default=4, help="Maximum number of database connections open at the same time with --all_databases. Each database being scanned uses one connection, plus one per worker when --jobs is greater than 1, so this limits how many databases are scanned concurrently. Default is 4.")
+args_general.add_argument('--analyze_threshold', type=float, default=10, help="Percentage of a table's row count that the number of rows modified since it was last analyzed (n_mod_since_analyze from pg_stat_all_tables) must exceed for the table to be analyzed again before it is scanned. Tables that have never been analyzed are always analyzed. Fillfactor calculations use the actual size of each object, so the analyze only keeps the row estimates used by --triage, --fsm & --index_method=pgstatindex current. Default is 10.")
+args_general.add_argument('--commit_interval', type=float, default=10, help="Scan results are buffered and written to the bloat statistics table in batches using multi-row inserts. A batch is written and committed once this many seconds have passed since the last commit. Helps avoid long running transactions when scanning large tables. Set to 0 to only commit based on --commit_size. Default is 10.")
+args_general.add_argument('--commit_size', default="1GB", help="Also write and commit buffered scan results once the objects scanned since the last commit add up to this size. Size units (mb, kb, tb, etc.) can be provided. Set to 0 to only commit based on --commit_interval. If both are 0, results are committed when the scan finishes. Default is 1GB.")
+args_general.add_argument('--daemon', action="store_true", help="Keep running and scan again every --interval seconds, or whenever the process receives a SIGUSR1 signal, instead of exiting after one run. The database connection and any --jobs worker connections are kept open between runs. The report of each run is output the same way as a single run, so this is best combined with --metrics_file or -u. A SIGTERM or SIGINT stops the daemon once the current run is done. Cannot be combined with --create_stats_table or --rebuild_index.")
+args_general.add_argument('-e', '--exclude_object_file', help="""Full path to file containing a list of objects to exclude from the report (tables and/or indexes). Each line is a CSV entry in the format: objectname,bytes_wasted,percent_wasted. All objects must be schema qualified. objectname can also be a shell style wildcard pattern (*, ?, [seq]) or a regular expression prefixed with "re:" that matches the whole schema qualified name. bytes_wasted & percent_wasted are additional filter values on top of -s, -p, and -z to exclude the given object unless these values are also exceeded. Set either of these values to zero (or leave them off entirely) to exclude the object no matter what its bloat level. Comments are allowed if the line is prepended with "#". See the README.md for clearer examples of how to use this for more fine grained filtering.""")
+args_general.add_argument('-f', '--format', default="simple", choices=["simple", "json", "jsonpretty", "ndjson", "dict", "openmetrics"], help="Output formats. Simple is a plaintext version suitable for any output (ex: console, pipe to email). Object type is in parentheses (t=table, i=index, p=primary key). Json provides standardized json output which may be useful if taking input into something that needs a more structured format. Json also provides more details about dead tuples, empty space & free space. jsonpretty outputs in a more human readable format. ndjson outputs the same details as json with one object per line, each line output as soon as it is read. Dict is the same as json but in the form of a python dictionary. Openmetrics outputs the statistics of every object in the report & the last completed run as OpenMetrics (Prometheus) gauges. The -z & -p thresholds apply as they do to the other formats, so an object's series stops being output while its wasted space is below them. Default is simple.")
+args_general.add_argument('--fsm', action="store_true", help="Estimate the free space of tables, toast tables & materialized views from the free space map using the pg_freespacemap extension instead of reading every page with pgstattuple(). The free space map is a tiny fraction of the size of the table. Dead tuple space is estimated by splitting the used space by the live & dead tuple counts in the catalog statistics. Sets the 'approximate' column in the bloat statistics table to True. A full scan is still done for any table whose free space map looks stale compared to its last vacuum (see --fsm_stale_threshold). Indexes are not affected by this option.")
+args_general.add_argument('--fsm_stale_threshold', type=float, default=10, help="The free space map is only updated by vacuum. With --fsm, a table is scanned in full instead if it has never been vacuumed, has no free space map, or the rows inserted plus dead rows since its last vacuum are more than this percentage of its row count. Default is 10.")
+args_general.add_argument('--history', action="store_true", help="Keep the statistics of every completed run in the bloat_history table so that growth over time can be reported with --trend. Every scanned object is stored, including those still below the -z & -p thresholds, so their growth towards the thresholds can be tracked. The report still only includes objects above the thresholds. The history table is partitioned by month and partitions older than --history_retention are dropped at the end of each run. Requires PostgreSQL 11+ and the bloat_history table created by --create_stats_table.")
+args_general.add_argument('--history_retention', type=int, default=730, help="Number of days of history to keep when --history is set. Monthly partitions of the bloat_history table that end before this many days ago are dropped. Default is 730.")
+args_general.add_argument('--incremental', action="store_true", help="Only rescan objects that have changed enough since they were last scanned. The update, delete & vacuum counters from pg_stat_all_tables along with the relfilenode of every object are recorded at scan time in the bloat_scan_state table. On the next run with this option, an object is scanned again only if its update & delete count has grown by more than --incremental_threshold percent of its row count, its relfilenode has changed (ex. VACUUM FULL, REINDEX) or the statistics counters were reset. All other objects keep their previous row in the bloat statistics table. Index churn excludes heap-only (HOT) updates since those do not add new index entries.")
+args_general.add_argument('--incremental_threshold', type=float, default=10, help="Percentage of a table's row count that the number of updated and deleted rows must exceed since the last scan for the --incremental option to scan the table and its indexes again. Default is 10.")
+args_general.add_argument('--index_method', choices=["pgstattuple", "pgstatindex"], default="pgstattuple", help="Function used to measure the bloat of btree indexes. pgstattuple() reads every tuple to find dead tuples & free space. pgstatindex() reads only the page level statistics of a btree index and also records the average leaf density, leaf fragmentation and page counts in the bloat_indexes table. With pgstatindex, free space is the unused space on leaf pages plus all empty & deleted pages, so wasted space is the leaf density shortfall compared to the index fillfactor. It does not report dead tuples. Non-btree indexes are always scanned with pgstattuple(). Default is pgstattuple.")
+args_general.add_argument('--interval', type=int, default=3600, help="Number of seconds to wait between the end of one run and the start of the next with --daemon. Set to 0 to only run when a SIGUSR1 signal is received. Default is 3600.")
+args_general.add_argument('-j', '--jobs', type=int, default=1, help="Number of parallel workers used to scan objects. Each worker opens its own database connection and runs the analyze, pgstattuple and statistics insert steps for the objects it is handed. The --commit_interval & --commit_size settings apply to each worker individually. The report produced is the same as a serial run. Default is 1 (serial scan using the main connection).")
+args_general.add_argument('--lock_timeout', type=int, help="Sets lock_timeout, in milliseconds, for the analyze & scan of each object. An object whose analyze or scan cannot get its lock in time (ex. it is queued behind an ALTER TABLE) is moved to a retry queue that is scanned again once all other objects are done. Default is the lock_timeout of the connecting role.")
+args_general.add_argument('--metrics_file', help="Write the --format=openmetrics output to this file instead of stdout, for use with the textfile collector of the Prometheus node_exporter. The file is written to a temporary file first and renamed into place so a partial file is never read. Implies --format=openmetrics.")
 args_general.add_argument('-m', '--mode', choices=["tables", "indexes", "both"], default="both", help="""Provide bloat reports for tables, indexes or both. Index bloat is always distinct from table bloat and reported as separate entries in the report. Default is "both". NOTE: GIN indexes are not supported at this time and will be skipped.""")
+args_general.add_argument('--max_read_rate', type=float, help="Limit the rate that objects are read by the scan to this many megabytes per second, shared by all --jobs workers. After each object is scanned, the next scan waits until the average read rate since the start of the run is back under the limit, based on the size of the object read. If the pageinspect extension is installed and the scanning role is a superuser (required by get_raw_page()), tables, toast tables & materialized views larger than --read_chunk_size are read in chunks of blocks with get_raw_page() so that a single large table cannot read faster than the limit. Otherwise every object is read with pgstattuple() and only paced between objects. Rows read in chunks have a method of 'pageinspect' and are marked as approximate, since tuples deleted or locked by a transaction that has not been seen to abort are counted as dead without checking their visibility the way pgstattuple() does. Indexes are never read in chunks. Note that get_raw_page() does not use the small ring buffer that pgstattuple() uses for bulk reads. Reads done by ANALYZE are not counted. The actual read rate is output to stderr at the end of the run.")
+args_general.add_argument('--read_chunk_size', default="64MB", help="Size of the block ranges used to read large tables when --max_read_rate is set and the pageinspect extension is installed. Size units (mb, kb, tb, etc.) can be provided. Default is 64MB.")
 args_general.add_argument('-n', '--schema', help="Comma separated list of schema to include in report. pg_catalog schema is always included. All other schemas will be ignored.")
 args_general.add_argument('-N', '--exclude_schema', help="Comma separated list of schemas to exclude.")
-args_general.add_argument('--noanalyze', action="store_true", help="To ensure accurate fillfactor statistics, an analyze if each object being scanned is done before the check for bloat. Set this to skip the analyze step and reduce overall runtime, however your bloat statistics may not be as accurate.")
+args_general.add_argument('--noanalyze', action="store_true", help="Before an object is scanned, the table it belongs to is analyzed if its statistics are out of date (see --analyze_threshold). Set this to skip the analyze step entirely and reduce overall runtime, however estimated bloat statistics may not be as accurate.")
 args_general.add_argument('--noscan', action="store_true", help="Set this option to have the script just read from the bloat statistics table without doing a scan of any tables again.")
 args_general.add_argument('-p', '--min_wasted_percentage', type=float, default=0.1, help="Minimum percentage of wasted space an object must have to be included in the report. Default and minimum value is 0.1 (DO NOT include percent sign in given value).")
 args_general.add_argument('-q', '--quick', action="store_true", help="Use the pgstattuple_approx() function instead of pgstattuple() for a quicker, but possibly less accurate bloat report on tables. Note that this does not work on indexes or TOAST tables and those objects will continue to be scanned with pgstattuple() and still be included in the results. Sets the 'approximate' column in the bloat statistics table to True. Note this only works in PostgreSQL 9.5+.")
 args_general.add_argument('-u', '--quiet', default=0, action="count", help="Suppress console output but still insert data into the bloat statistics table. This option can be set several times. Setting once will suppress all non-error console output if no bloat is found, but still output when it is found for given parameter settings. Setting it twice will suppress all console output, even if bloat is found.")
-args_general.add_argument('-r', '--commit_rate', type=int, default=5, help="Sets how many tables are scanned before committing inserts into the bloat statistics table. Helps avoid long running transactions when scanning large tables. Default is 5. Set to 0 to avoid committing until all tables are scanned. NOTE: The bloat table is truncated on every run unless --noscan is set.")
-args_general.add_argument('--rebuild_index', action="store_true", help="Output a series of SQL commands for each index that will rebuild it with minimal impact on database locks. This does NOT run the given sql, it only provides the commands to do so manually. This does not run a new scan and will use the indexes contained in the statistics table from the last run. If a unique index was previously defined as a constraint, it will be recreated as a unique index. All other filters used during a standard bloat check scan can be used with this option so you only get commands to run for objects relevant to your desired bloat thresholds.")
+args_general.add_argument('-r', '--commit_rate', type=int, help="DEPRECATED. Commits are now driven by --commit_interval and --commit_size. Setting this to 0 still commits only once all objects are scanned (both of those set to 0). Any other value has no effect. A warning is output when this is set and it will be removed in a future version.")
+args_general.add_argument('--rebuild_index', action="store_true", help="Output a series of SQL commands for each index that will rebuild it with minimal impact on database locks. This does NOT run the given sql, it only provides the commands to do so manually. This does not run a new scan and will use the indexes contained in the statistics table from the last run. On PostgreSQL 12+ each index is rebuilt with REINDEX INDEX CONCURRENTLY. On older versions a new index is built concurrently and swapped in; if a unique index was previously defined as a constraint, it will be recreated as a unique index. Indexes of system catalogs & of exclusion constraints cannot be rebuilt concurrently, so a blocking REINDEX is output for them commented out. Each command is annotated with its estimated build I/O and the space it should reclaim. Commands are grouped into waves where no two indexes are on the same table, so the commands of one wave can be run in parallel. All other filters used during a standard bloat check scan can be used with this option so you only get commands to run for objects relevant to your desired bloat thresholds.")
 args_general.add_argument('--recovery_mode_norun', action="store_true", help="Setting this option will cause the script to check if the database it is running against is a replica (in recovery mode) and cause it to skip running. Otherwise if it is not in recovery, it will run as normal. This is useful for when you want to ensure the bloat check always runs only on the primary after failover without having to edit crontabs or similar process managers.")
-args_general.add_argument('-s', '--min_size', default=1, help="Minimum size in bytes of object to scan (table or index). Default and minimum value is 1. Size units (mb, kb, tb, etc.) can be provided as well")
+args_general.add_argument('--resume', action="store_true", help="Continue the last scan run that did not finish (ex. the script was stopped or lost its connection) instead of starting a new one. A run stopped by the --time_budget is finished, so it is not resumed. Objects already completed by that run are not scanned again. Statistics from a run are only reported once it finishes, so the report continues to show the previous completed run until then. Without this option any unfinished run is discarded when a new scan starts.")
+args_general.add_argument('--sample', action="store_true", help="Estimate the bloat of tables, toast tables & materialized views larger than --sample_min_size by reading a random sample of their blocks with the pageinspect extension instead of the whole relation. Dead tuple space, free space and tuple counts are extrapolated from the sample. The number of blocks sampled grows until the 95%% confidence interval of the wasted space is within --sample_error percent. The sample size and error bound are stored with each row and the rows are marked as approximate. Tables that would need most of their blocks sampled are scanned in full instead. Requires superuser or a role allowed to run get_raw_page(). Indexes are not affected by this option.")
+args_general.add_argument('--sample_error', type=float, default=5, help="Target relative error, in percent, of the wasted space estimated by --sample at 95%% confidence. Default is 5.")
+args_general.add_argument('--sample_min_size', default="1GB", help="Minimum size of a table for it to be sampled with --sample. Smaller tables are scanned normally. Size units (mb, kb, tb, etc.) can be provided. Default is 1GB.")
+args_general.add_argument('--scan_connection', help="Connection string of the server that objects are read from, such as a hot standby of the database given by --connection. The catalog queries & bloat statistics tables stay on --connection, so only the pgstattuple (and pageinspect/pg_freespacemap) reads and their small results go over this connection, keeping the read I/O of the scan off the primary. Must be a physical replica of the same cluster. Tables are not analyzed when this server is in recovery. Scans canceled by a conflict with recovery on the standby are put on the retry queue like with --lock_timeout. With --all_databases the dbname is replaced like for --connection. Default is to read objects over --connection.")
+args_general.add_argument('-s', '--min_size', default=1, help="Minimum size in bytes of object to scan (table or index). Default and minimum value is 1. Size units (mb, kb, tb, etc.) can be provided as well. Objects smaller than this are filtered out when the list of objects to scan is first gathered, so they are never analyzed or scanned. The --debug option will output how many objects were filtered out this way.")
+args_general.add_argument('--statement_timeout', type=int, help="Sets statement_timeout, in milliseconds, for the analyze & scan of each object. An object whose analyze or scan takes longer is cancelled and moved to the retry queue like with --lock_timeout. Default is the statement_timeout of the connecting role.")
+args_general.add_argument('--store', choices=["database", "sqlite"], default="database", help="Where the bloat statistics, scan state & runs are kept. database uses the statistics tables created by --create_stats_table in the database being scanned. sqlite uses a local SQLite file given by --store_file instead, so a scan writes nothing to the database and reports (--noscan, --timing, all --format outputs) can be output again from the file without connecting to the database at all. Several databases can share one file. --rebuild_index still connects to look up the index definitions. With sqlite, --bloat_schema has no effect, --create_stats_table removes the statistics of the database from the file and --history & --trend are not available. Default is database.")
+args_general.add_argument('--store_file', help="Path of the SQLite file used by --store=sqlite. It is created if it does not exist.")
 args_general.add_argument('-t', '--tablename', help="Scan for bloat only on the given table. Must be schema qualified. This always gets both table and index bloat and overrides all other filter options so you always get the bloat statistics for the table no matter what they are.")
+args_general.add_argument('--timing', action="store_true", help="Output a summary of where the time of the last run went to stderr: the total time spent on catalog queries, analyzes, scans and writing results (summed across all --jobs workers), followed by the 10 slowest objects. The scan start time, analyze, scan & write durations and bytes read of every object are always recorded in the statistics tables. Can be used with --noscan to show the summary of the previous run.")
+args_general.add_argument('--time_budget', type=int, help="Maximum number of seconds the scan is allowed to run. When set, objects are scanned in order of the wasted space recorded for them by the previous run (largest first), followed by all other objects from largest to smallest. Once the time budget has been used up, no new objects are scanned, the objects currently being scanned are allowed to finish and a list of all objects that were not scanned is output to stderr. The run is then finished, so the report shows the new statistics of the objects that were scanned and the statistics from the previous run of those that were not.")
+args_general.add_argument('--trend', action="store_true", help="Instead of the normal bloat report, output the growth rate of wasted space for each object based on the runs recorded with --history over the last --trend_days days. Also shows the estimated number of days until each object will exceed both the -z & -p thresholds if its current growth continues. Objects are ordered by growth rate, largest first. All other report filters (-m, --format, -u) apply. Can be combined with --noscan to report without running a new scan.")
+args_general.add_argument('--trend_days', type=int, default=90, help="Number of days of history used to calculate growth rates for --trend. Default is 90.")
+args_general.add_argument('--triage', action="store_true", help="First estimate the bloat of every table & btree index using only the catalog statistics (pg_class & pg_stats) which requires no reads of the objects themselves. Only objects whose estimated wasted space & percentage are near or above the -z & -p thresholds (see --triage_margin) are then scanned with pgstattuple() (or pgstattuple_approx() with --quick). Objects that cannot be estimated (toast tables, non-btree indexes, tables without statistics) are always scanned. The estimated values for all other objects are stored in the statistics table with the 'method' column set to 'estimate' and 'approximate' set to True. Running an analyze before using this option is recommended for the best estimates.")
+args_general.add_argument('--triage_margin', type=float, default=25, help="Safety margin for --triage, as a percentage of the -z & -p thresholds. An object is scanned if its estimated wasted space and percentage are within this margin of the thresholds (ex. with the default of 25 and -p 40, any object estimated at 30%% or more is scanned). Default is 25.")
 args_general.add_argument('--version', action="store_true", help="Print version of this script.")
 args_general.add_argument('-z', '--min_wasted_size', default=1, help="Minimum size of wasted space in bytes. Default and minimum is 1. Size units (mb, kb, tb, etc.) can be provided as well")
 args_general.add_argument('--debug', action="store_true", help="Output additional debugging information. Overrides quiet option.")
@@ -34,7 +90,35 @@ args_setup = parser.add_argument_group(title="Setup")
 args_setup.add_argument('--pgstattuple_schema', help="If pgstattuple is not installed in the default search path, use this option to designate the schema where it is installed.")
 args_setup.add_argument('--bloat_schema', help="Set the schema that the bloat report table is in if it's not in the default search path. Note this option can also be set when running --create_stats_table to set which schema you want the table created.")
 args_setup.add_argument('--create_stats_table', action="store_true", help="Create the required tables that the bloat report uses (bloat_stats + two child tables). Places table in default search path unless --bloat_schema is set.")
-args = parser.parse_args()
+# Options used by every function of this module. Importing it does not parse sys.argv, so these are the defaults
+# until they are set by main() when run as a script or by configure() when used as a module.
+args = parser.parse_args([])
+
+# Shared by every scan of this run, including all databases with --all_databases. Set in main when --max_read_rate is used.
+read_rate_limiter = None
+
+# Number of tables analyzed & analyzes skipped because the table statistics were still current, across all workers & databases
+analyze_counts = { 'analyzed': 0, 'skipped': 0 }
+analyze_counts_lock = threading.Lock()
+
+# Keeps worker connections open between runs with --daemon. Set in run_daemon()
+worker_conn_pool = None
+
+# Local SQLite file the results are kept in with --store=sqlite. Opened on first use by get_result_store()
+result_store = None
+result_store_lock = threading.Lock()
+
+# Held by configure(), scan() & run_once() so that the options cannot be changed by another thread while a scan
+# of this process is using them. Callers in different threads are run one after another.
+run_lock = threading.RLock()
+
+
+class BloatCheckError(Exception):
+    """
+    Raised when the database does not meet the requirements of the chosen options (ex. a missing extension
+    or statistics table). The message is the reason to output to the user.
+    """
+    pass
 
 
 def check_pgstattuple(conn):
@@ -43,14 +127,10 @@ def check_pgstattuple(conn):
     cur.execute(sql)
     pgstattuple_info = cur.fetchone()
     if pgstattuple_info == None:
-        print("pgstattuple extension not found. Please ensure it is installed in the database this script is connecting to.")
-        close_conn(conn)
-        sys.exit(2)
+        raise BloatCheckError("pgstattuple extension not found. Please ensure it is installed in the database this script is connecting to.")
     if args.pgstattuple_schema != None:
         if args.pgstattuple_schema != pgstattuple_info[1]:
-            print("pgstattuple not found in the schema given by --pgstattuple_schema option: " + args.pgstattuple_schema + ". Found instead in: " + pgstattuple_info[1]+".")
-            close_conn(conn)
-            sys.exit(2)
+            raise BloatCheckError("pgstattuple not found in the schema given by --pgstattuple_schema option: " + args.pgstattuple_schema + ". Found instead in: " + pgstattuple_info[1]+".")
     return pgstattuple_info[0]
 
 
@@ -63,8 +143,35 @@ def check_recovery_status(conn):
     return is_in_recovery
 
 
-def create_conn():
-    conn = psycopg2.connect(args.connection)
+def check_psycopg2():
+    """
+    Raises BloatCheckError if the installed psycopg2 is older than 2.7, which added the make_dsn() & parse_dsn()
+    functions used to build & read connection strings.
+    """
+    psycopg2_version = tuple(int(v) for v in re.findall(r"\d+", psycopg2.__version__)[:2])
+    if psycopg2_version < (2, 7):
+        raise BloatCheckError("psycopg2 version 2.7 or greater is required. Found version " + psycopg2.__version__)
+
+
+def create_conn(dbname=None):
+    if dbname != None:
+        # replaces the dbname of the given connection string whether it is in keyword/value or URI format
+        conn = psycopg2.connect(psycopg2.extensions.make_dsn(args.connection, dbname=dbname))
+    else:
+        conn = psycopg2.connect(args.connection)
+    return conn
+
+
+def create_scan_conn(dbname=None):
+    """
+    Connect to the --scan_connection server that objects are read from. Each statement runs in its own transaction
+    so that a hot standby is never kept from replaying by a long open snapshot.
+    """
+    if dbname != None:
+        conn = psycopg2.connect(psycopg2.extensions.make_dsn(args.scan_connection, dbname=dbname))
+    else:
+        conn = psycopg2.connect(args.scan_connection)
+    conn.autocommit = True
     return conn
 
 
@@ -72,6 +179,66 @@ def close_conn(conn):
     conn.close()
 
 
+def open_worker_conn(dbname=None, scan=False):
+    """
+    Open a connection for a scan worker or a database scanned with --all_databases, taking an idle one from
+    the pool instead when running with --daemon. Set scan to connect to the --scan_connection server instead.
+    """
+    if worker_conn_pool != None:
+        return worker_conn_pool.get(dbname, scan)
+    if scan:
+        return create_scan_conn(dbname)
+    return create_conn(dbname)
+
+
+def release_worker_conn(conn, dbname=None, scan=False):
+    if worker_conn_pool != None:
+        worker_conn_pool.put(conn, dbname, scan)
+    elif not conn.closed:
+        close_conn(conn)
+
+
+class ConnectionPool:
+    """
+    Idle connections kept open between the runs of --daemon, per database & server. Connections that are closed or
+    left inside a transaction (ex. after an error) are not reused. Safe to share between workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+
+    def get(self, dbname, scan=False):
+        with self.lock:
+            idle_conns = self.idle.get((dbname, scan), [])
+            if idle_conns:
+                return idle_conns.pop()
+        if scan:
+            return create_scan_conn(dbname)
+        return create_conn(dbname)
+
+
+    def put(self, conn, dbname, scan=False):
+        if conn.closed:
+            return
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            close_conn(conn)
+            return
+        with self.lock:
+            self.idle.setdefault((dbname, scan), []).append(conn)
+
+
+    def close_all(self):
+        with self.lock:
+            for idle_conns in self.idle.values():
+                for c in idle_conns:
+                    if not c.closed:
+                        close_conn(c)
+            self.idle = {}
+## end class ConnectionPool
+
+
 def create_list(list_type, list_items):
     split_list = []
     if list_type == "csv":
@@ -98,17 +265,143 @@ def create_list(list_type, list_items):
     return split_list
 
 
+def glob_to_like(pattern):
+    """
+    Translate a shell style wildcard pattern using only * and ? to the equivalent LIKE pattern.
+    """
+    like = ""
+    for c in pattern:
+        if c == "*":
+            like += "%"
+        elif c == "?":
+            like += "_"
+        elif c in "\\%_":
+            like += "\\" + c
+        else:
+            like += c
+    return like
+
+
+class NamePatterns:
+    """
+    Wildcard & regular expression entries of the --exclude_object_file, indexed by the literal text each
+    pattern starts with (ex. "public.events_2024_" for "public.events_2024_*"). Matching a name only tries
+    the patterns whose literal prefix is a prefix of that name, so thousands of patterns for different
+    partition sets do not all have to be tried for every object.
+    """
+
+    def __init__(self):
+        self.by_prefix = {}
+        self.prefix_lengths = set()
+        self.count = 0
+
+
+    def add(self, prefix, regex, value):
+        # entry order is kept so the first matching entry of the file is returned
+        self.by_prefix.setdefault(prefix, []).append((self.count, regex, value))
+        self.prefix_lengths.add(len(prefix))
+        self.count += 1
+
+
+    def match(self, name):
+        """
+        Returns the value given for the first entry that matches the whole name, or None if none does.
+        """
+        found = None
+        for length in self.prefix_lengths:
+            for order, regex, value in self.by_prefix.get(name[:length], []):
+                if (found == None or order < found[0]) and regex.fullmatch(name):
+                    found = (order, value)
+        if found != None:
+            return found[1]
+        return None
+## end class NamePatterns
+
+
+class ExcludeRules:
+    """
+    The entries of --exclude_object_file compiled for fast lookups. An entry is a schema qualified object name,
+    a shell style wildcard pattern (*, ?, [seq]) or a regular expression prefixed with "re:", both of which must
+    match the whole schema qualified name. Entries with both max values at zero exclude an object completely.
+    Exact names and wildcard patterns of those are also returned as SQL filters so the catalog snapshot never
+    returns them. Other entries only exclude an object while its bloat is within their max values.
+    """
+
+    def __init__(self, exclude_object_list):
+        self.full_names = set()
+        self.full_like_patterns = []
+        self.full_patterns = NamePatterns()
+        self.limit_names = {}
+        self.limit_patterns = NamePatterns()
+        for e in exclude_object_list:
+            name = e['objectname']
+            full = e['max_wasted'] == 0 and e['max_perc'] == 0
+            if name.startswith("re:"):
+                # the literal prefix of a regular expression is not worth working out, so these are always tried
+                prefix = ""
+                regex = re.compile(name[3:])
+            elif "*" in name or "?" in name or "[" in name:
+                prefix = re.split(r"[*?\[]", name, maxsplit=1)[0]
+                regex = re.compile(fnmatch.translate(name))
+            else:
+                if full:
+                    self.full_names.add(name)
+                else:
+                    # the last entry for the same object wins, as it always has
+                    self.limit_names[name] = (e['max_wasted'], e['max_perc'])
+                continue
+
+            if full and not name.startswith("re:") and "[" not in name:
+                self.full_like_patterns.append(glob_to_like(name))
+            elif full:
+                self.full_patterns.add(prefix, regex, True)
+            else:
+                self.limit_patterns.add(prefix, regex, (e['max_wasted'], e['max_perc']))
+
+
+    def is_excluded(self, name):
+        """
+        Returns True if the object is excluded completely by an entry that is not part of the SQL filters.
+        """
+        return self.full_patterns.count > 0 and self.full_patterns.match(name) != None
+
+
+    def get_limits(self, name):
+        """
+        Returns the max wasted bytes & max wasted percentage to apply to the given object, or None if no entry
+        with max values matches it. An entry for the exact name takes precedence over patterns.
+        """
+        if name in self.limit_names:
+            return self.limit_names[name]
+        if self.limit_patterns.count > 0:
+            return self.limit_patterns.match(name)
+        return None
+## end class ExcludeRules
+
+
 def create_stats_table(conn):
+    store = get_result_store()
+    if store != None:
+        # the tables of the file are created when it is opened
+        store.clear(get_dbname(conn))
+        return
+
     if args.bloat_schema != None:
         parent_sql = args.bloat_schema + "." + "bloat_stats"
         tables_sql = args.bloat_schema + "." + "bloat_tables"
         indexes_sql = args.bloat_schema + "." + "bloat_indexes"
+        state_sql = args.bloat_schema + "." + "bloat_scan_state"
+        runs_sql = args.bloat_schema + "." + "bloat_runs"
+        history_sql = args.bloat_schema + "." + "bloat_history"
     else:
         parent_sql = "bloat_stats"
         tables_sql = "bloat_tables"
         indexes_sql = "bloat_indexes"
+        state_sql = "bloat_scan_state"
+        runs_sql = "bloat_runs"
+        history_sql = "bloat_history"
 
-    drop_sql = "DROP TABLE IF EXISTS " + parent_sql + " CASCADE"
+    drop_sql = "DROP TABLE IF EXISTS " + parent_sql + ", " + state_sql + ", " + runs_sql + " CASCADE"
 
     sql = "CREATE TABLE " + parent_sql + """ (
                               oid oid NOT NULL
@@ -126,7 +419,22 @@ def create_stats_table(conn):
                             , stats_timestamp timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
                             , approximate boolean NOT NULL DEFAULT false
                             , relpages bigint NOT NULL DEFAULT 1
-                            , fillfactor float8 NOT NULL DEFAULT 100)"""
+                            , fillfactor float8 NOT NULL DEFAULT 100
+                            , method text NOT NULL DEFAULT 'pgstattuple'
+                            , run_id bigint NOT NULL DEFAULT 0
+                            , avg_leaf_density float8
+                            , leaf_fragmentation float8
+                            , leaf_pages bigint
+                            , internal_pages bigint
+                            , empty_pages bigint
+                            , deleted_pages bigint
+                            , sample_blocks bigint
+                            , wasted_error_bytes bigint
+                            , scan_started_at timestamptz
+                            , analyze_seconds float8
+                            , scan_seconds float8
+                            , write_seconds float8
+                            , bytes_read bigint)"""
     cur = conn.cursor()
     if args.debug:
         print(cur.mogrify("drop_sql: " + drop_sql))
@@ -142,6 +450,63 @@ def create_stats_table(conn):
     if args.debug:
         print(cur.mogrify("sql: " + sql))
     cur.execute(sql)
+    sql = "CREATE TABLE " + state_sql + """ (
+                              oid oid PRIMARY KEY
+                            , relkind text NOT NULL
+                            , relfilenode oid NOT NULL
+                            , n_tup_upd bigint NOT NULL DEFAULT 0
+                            , n_tup_del bigint NOT NULL DEFAULT 0
+                            , n_tup_hot_upd bigint NOT NULL DEFAULT 0
+                            , vacuum_count bigint NOT NULL DEFAULT 0
+                            , autovacuum_count bigint NOT NULL DEFAULT 0
+                            , scan_timestamp timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+                            , run_id bigint NOT NULL DEFAULT 0)"""
+    if args.debug:
+        print(cur.mogrify("sql: " + sql))
+    cur.execute(sql)
+    sql = "CREATE TABLE " + runs_sql + """ (
+                              run_id bigserial PRIMARY KEY
+                            , mode text NOT NULL
+                            , started_at timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+                            , finished_at timestamptz
+                            , objects_scanned bigint NOT NULL DEFAULT 0
+                            , bytes_scanned bigint NOT NULL DEFAULT 0
+                            , objects_skipped bigint NOT NULL DEFAULT 0
+                            , catalog_seconds float8 NOT NULL DEFAULT 0
+                            , analyze_seconds float8 NOT NULL DEFAULT 0
+                            , scan_seconds float8 NOT NULL DEFAULT 0
+                            , write_seconds float8 NOT NULL DEFAULT 0)"""
+    if args.debug:
+        print(cur.mogrify("sql: " + sql))
+    cur.execute(sql)
+    cur.execute("SELECT current_setting('server_version_num')::int")
+    if cur.fetchone()[0] >= 110000:
+        # History is not dropped when the stats tables are recreated. It is kept until removed by --history_retention
+        sql = "CREATE TABLE IF NOT EXISTS " + history_sql + """ (
+                                  run_id bigint NOT NULL
+                                , oid oid NOT NULL
+                                , schemaname text NOT NULL
+                                , objectname text NOT NULL
+                                , objecttype text NOT NULL
+                                , size_bytes bigint
+                                , wasted_bytes bigint NOT NULL
+                                , wasted_percent float8 NOT NULL
+                                , method text NOT NULL
+                                , stats_timestamp timestamptz NOT NULL)
+                              PARTITION BY RANGE (stats_timestamp)"""
+        if args.debug:
+            print(cur.mogrify("sql: " + sql))
+        cur.execute(sql)
+        sql = "CREATE INDEX IF NOT EXISTS bloat_history_object_idx ON " + history_sql + " (schemaname, objectname, stats_timestamp)"
+        if args.debug:
+            print(cur.mogrify("sql: " + sql))
+        cur.execute(sql)
+        sql = "COMMENT ON TABLE " + history_sql + " IS 'Table keeping the wasted space of objects from every completed run when --history is used. Partitioned by month'"
+        if args.debug:
+            print(cur.mogrify("sql: " + sql))
+        cur.execute(sql)
+    elif args.debug:
+        print("PostgreSQL 11+ is required for the bloat_history table. Skipping its creation.")
     sql = "COMMENT ON TABLE " + parent_sql + " IS 'Table providing raw data for table & index bloat'"
     if args.debug:
         print(cur.mogrify("sql: " + sql))
@@ -154,66 +519,601 @@ def create_stats_table(conn):
     if args.debug:
         print(cur.mogrify("sql: " + sql))
     cur.execute(sql)
+    sql = "COMMENT ON TABLE " + state_sql + " IS 'Table tracking the change counters of each object at the time it was last scanned. Used by --incremental'"
+    if args.debug:
+        print(cur.mogrify("sql: " + sql))
+    cur.execute(sql)
+    sql = "COMMENT ON TABLE " + runs_sql + " IS 'Table tracking each scan run. Statistics from a run are only reported once it has finished'"
+    if args.debug:
+        print(cur.mogrify("sql: " + sql))
+    cur.execute(sql)
 
     conn.commit()
     cur.close()
 
 
-def get_bloat(conn, exclude_schema_list, include_schema_list, exclude_object_list):
-    sql = ""
-    commit_counter = 0
-    analyzed_tables = []
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+class SQLiteStore:
+    """
+    Keeps the bloat statistics, scan state & runs in a local SQLite file for --store=sqlite instead of the statistics
+    tables in the database. The tables match those made by create_stats_table() with a database column added, so
+    several databases can share one file. Toast tables also keep the name of the table they belong to since there is
+    no catalog to look it up in when reports are read from the file. Run times are stored as seconds since the epoch.
+    Statements take psycopg2 style %s placeholders so their SQL can be shared with the database store.
+    Safe to share between workers.
+    """
+
+    schema = """CREATE TABLE IF NOT EXISTS bloat_stats (
+                      database text NOT NULL
+                    , oid integer NOT NULL
+                    , schemaname text NOT NULL
+                    , objectname text NOT NULL
+                    , objecttype text NOT NULL
+                    , size_bytes integer
+                    , live_tuple_count integer
+                    , live_tuple_percent real
+                    , dead_tuple_count integer
+                    , dead_tuple_size_bytes integer
+                    , dead_tuple_percent real
+                    , free_space_bytes integer
+                    , free_percent real
+                    , stats_timestamp text NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    , approximate integer NOT NULL DEFAULT 0
+                    , relpages integer NOT NULL DEFAULT 1
+                    , fillfactor real NOT NULL DEFAULT 100
+                    , method text NOT NULL DEFAULT 'pgstattuple'
+                    , run_id integer NOT NULL DEFAULT 0
+                    , avg_leaf_density real
+                    , leaf_fragmentation real
+                    , leaf_pages integer
+                    , internal_pages integer
+                    , empty_pages integer
+                    , deleted_pages integer
+                    , sample_blocks integer
+                    , wasted_error_bytes integer
+                    , scan_started_at text
+                    , analyze_seconds real
+                    , scan_seconds real
+                    , write_seconds real
+                    , bytes_read integer
+                    , real_table text);
+                CREATE INDEX IF NOT EXISTS bloat_stats_run_idx ON bloat_stats (database, run_id);
+                CREATE TABLE IF NOT EXISTS bloat_scan_state (
+                      database text NOT NULL
+                    , oid integer NOT NULL
+                    , relkind text NOT NULL
+                    , relfilenode integer NOT NULL
+                    , n_tup_upd integer NOT NULL DEFAULT 0
+                    , n_tup_del integer NOT NULL DEFAULT 0
+                    , n_tup_hot_upd integer NOT NULL DEFAULT 0
+                    , vacuum_count integer NOT NULL DEFAULT 0
+                    , autovacuum_count integer NOT NULL DEFAULT 0
+                    , scan_timestamp text NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    , run_id integer NOT NULL DEFAULT 0
+                    , PRIMARY KEY (database, oid));
+                CREATE TABLE IF NOT EXISTS bloat_runs (
+                      run_id integer PRIMARY KEY AUTOINCREMENT
+                    , database text NOT NULL
+                    , mode text NOT NULL
+                    , block_size integer NOT NULL
+                    , started_at real NOT NULL
+                    , finished_at real
+                    , objects_scanned integer NOT NULL DEFAULT 0
+                    , bytes_scanned integer NOT NULL DEFAULT 0
+                    , objects_skipped integer NOT NULL DEFAULT 0
+                    , catalog_seconds real NOT NULL DEFAULT 0
+                    , analyze_seconds real NOT NULL DEFAULT 0
+                    , scan_seconds real NOT NULL DEFAULT 0
+                    , write_seconds real NOT NULL DEFAULT 0);"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = self.connect()
+        # lets a report be read from the file while a scan is writing to it
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(self.schema)
+
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.create_function("pg_size_pretty", 1, pg_size_pretty, deterministic=True)
+        return conn
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+    def query(self, sql, params=()):
+        """
+        Returns all rows of the given query as dictionaries.
+        """
+        with self.lock:
+            return [ dict(r) for r in self.conn.execute(sql.replace("%s", "?"), params) ]
+
+
+    def stream(self, sql, params=()):
+        """
+        Yields the rows of the given query as dictionaries as they are read. Uses a connection of its own so that
+        output of a long report does not hold up workers writing to the file.
+        """
+        conn = self.connect()
+        try:
+            for r in conn.execute(sql.replace("%s", "?"), params):
+                yield dict(r)
+        finally:
+            conn.close()
+
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            self.conn.execute(sql.replace("%s", "?"), params)
+            self.conn.commit()
+
+
+    def new_run(self, dbname, mode, block_size):
+        """
+        Remove the unfinished runs of the given database along with their partial results and start a new run.
+        Returns its run id.
+        """
+        unfinished_runs = "(SELECT run_id FROM bloat_runs WHERE database = ? AND finished_at IS NULL)"
+        with self.lock:
+            self.conn.execute("DELETE FROM bloat_stats WHERE database = ? AND run_id IN " + unfinished_runs, [dbname, dbname])
+            self.conn.execute("DELETE FROM bloat_scan_state WHERE database = ? AND run_id IN " + unfinished_runs, [dbname, dbname])
+            self.conn.execute("DELETE FROM bloat_runs WHERE database = ? AND finished_at IS NULL", [dbname])
+            cur = self.conn.execute("INSERT INTO bloat_runs (database, mode, block_size, started_at) VALUES (?, ?, ?, ?)", [dbname, mode, block_size, time.time()])
+            self.conn.commit()
+            return cur.lastrowid
+
+
+    def finish_run(self, dbname, run_id, carried_oids, snapshot_oids):
+        """
+        Same as finish_run() for the database store. Object lists are passed as json arrays.
+        """
+        if args.mode == "tables":
+            stats_filter = " AND objecttype NOT IN ('index', 'index_pk')"
+            state_filter = " AND relkind <> 'i'"
+        elif args.mode == "indexes":
+            stats_filter = " AND objecttype IN ('index', 'index_pk')"
+            state_filter = " AND relkind = 'i'"
+        else:
+            stats_filter = ""
+            state_filter = ""
+        with self.lock:
+            sql = "DELETE FROM bloat_stats WHERE database = ? AND run_id <> ? AND oid NOT IN (SELECT value FROM json_each(?))" + stats_filter
+            self.conn.execute(sql, [dbname, run_id, json.dumps(carried_oids)])
+            sql = "DELETE FROM bloat_scan_state WHERE database = ? AND oid NOT IN (SELECT value FROM json_each(?))" + state_filter
+            self.conn.execute(sql, [dbname, json.dumps(snapshot_oids)])
+            self.conn.execute("UPDATE bloat_runs SET finished_at = ? WHERE run_id = ?", [time.time(), run_id])
+            self.conn.commit()
+
+
+    def write(self, dbname, stats_rows, state_rows):
+        """
+        Write the rows buffered by a StatsWriter. Statistics rows have the name of the table a toast table belongs to
+        added after the run id.
+        """
+        stats_cols = re.findall(r"\w+", StatsWriter.stats_cols) + ["real_table", "database"]
+        stats_sql = "INSERT INTO bloat_stats (" + ", ".join(stats_cols) + ") VALUES (" + ", ".join(["?"] * len(stats_cols)) + ")"
+        state_sql = """INSERT INTO bloat_scan_state (oid, relkind, relfilenode, n_tup_upd, n_tup_del, n_tup_hot_upd, vacuum_count, autovacuum_count, run_id, database)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (database, oid) DO UPDATE SET relkind = excluded.relkind
+                           , relfilenode = excluded.relfilenode
+                           , n_tup_upd = excluded.n_tup_upd
+                           , n_tup_del = excluded.n_tup_del
+                           , n_tup_hot_upd = excluded.n_tup_hot_upd
+                           , vacuum_count = excluded.vacuum_count
+                           , autovacuum_count = excluded.autovacuum_count
+                           , scan_timestamp = CURRENT_TIMESTAMP
+                           , run_id = excluded.run_id"""
+        with self.lock:
+            for rows in stats_rows:
+                # scan start times are kept as ISO 8601 text
+                self.conn.executemany(stats_sql, ( [ v.isoformat() if isinstance(v, datetime.datetime) else v for v in r ] + [dbname] for r in rows ))
+            self.conn.executemany(state_sql, ( r + [dbname] for r in state_rows ))
+            self.conn.commit()
+
+
+    def clear(self, dbname):
+        with self.lock:
+            for table in ["bloat_stats", "bloat_scan_state", "bloat_runs"]:
+                self.conn.execute("DELETE FROM " + table + " WHERE database = ?", [dbname])
+            self.conn.commit()
+
+
+    def get_database_list(self):
+        return [ r['database'] for r in self.query("SELECT DISTINCT database FROM bloat_runs WHERE finished_at IS NOT NULL ORDER BY database") ]
+## end class SQLiteStore
+
+
+def pg_size_pretty(size):
+    """
+    Python version of the pg_size_pretty() function of PostgreSQL, giving the same output for reports read from --store=sqlite.
+    """
+    if size == None:
+        return None
+    def half_rounded(x):
+        # rounds half away from zero, same as C integer division does
+        return -((-x + 1) // 2) if x < 0 else (x + 1) // 2
+    size = int(size)
+    if abs(size) < 10 * 1024:
+        return str(size) + " bytes"
+    # one extra bit is kept for rounding
+    size >>= 9
+    for unit in ["kB", "MB", "GB", "TB"]:
+        if abs(size) < 20 * 1024 - 1:
+            return str(half_rounded(size)) + " " + unit
+        size >>= 10
+    return str(half_rounded(size)) + " PB"
+
+
+def get_result_store():
+    """
+    Returns the SQLiteStore of --store_file when --store=sqlite is set, opening it on first use. Returns None when
+    the statistics tables in the database are used.
+    """
+    global result_store
+    if args.store != "sqlite":
+        return None
+    with result_store_lock:
+        if result_store == None or result_store.path != args.store_file:
+            if result_store != None:
+                result_store.close()
+            result_store = SQLiteStore(args.store_file)
+        return result_store
+
+
+def close_result_store():
+    global result_store
+    with result_store_lock:
+        if result_store != None:
+            result_store.close()
+            result_store = None
+
+
+def get_dbname(conn):
+    """
+    Returns the name of the database of the given connection. Without a connection (reports read from --store=sqlite),
+    returns the database --connection would connect to, worked out the same way libpq does.
+    """
+    if conn != None:
+        return conn.get_dsn_parameters()['dbname']
+    dsn = psycopg2.extensions.parse_dsn(args.connection)
+    return dsn.get('dbname') or os.environ.get('PGDATABASE') or dsn.get('user') or os.environ.get('PGUSER') or getpass.getuser()
+
+
+def needs_connection():
+    """
+    Whether this run has to connect to the database. Only the --noscan report & --timing summary read from
+    --store=sqlite can be output without a connection.
+    """
+    return args.store != "sqlite" or args.noscan == False or args.rebuild_index or args.create_stats_table or args.recovery_mode_norun
+
+
+def get_extension_schema(conn, extname, option_name):
+    """
+    Returns the schema the given extension is installed in. Raises BloatCheckError if it is not installed,
+    naming the option that requires it. If no option name is given, returns None instead.
+    """
+    sql = "SELECT n.nspname FROM pg_catalog.pg_extension e JOIN pg_catalog.pg_namespace n ON e.extnamespace = n.oid WHERE extname = %s"
+    cur = conn.cursor()
+    cur.execute(sql, [extname])
+    extension_info = cur.fetchone()
+    if extension_info == None and option_name == None:
+        # optional extension that is only used if available
+        cur.close()
+        return None
+    if extension_info == None:
+        raise BloatCheckError(extname + " extension not found. Please ensure it is installed in the database this script is connecting to before using " + option_name + ".")
+    conn.commit()
+    cur.close()
+    return extension_info[0]
+
+
+def bloat_table_name(table):
+    if args.bloat_schema != None and args.store != "sqlite":
+        return args.bloat_schema + "." + table
+    return table
+
+
+def check_object_changed(o, state):
+    """
+    Decide whether an object needs to be scanned again for --incremental by comparing
+    its current change counters from the catalog snapshot to those recorded when it was last scanned.
+    """
+    if state == None:
+        return True
+    if o['relfilenode'] != state['relfilenode']:
+        return True
+    for counter in ['n_tup_upd', 'n_tup_del', 'n_tup_hot_upd', 'vacuum_count', 'autovacuum_count']:
+        if o[counter] < state[counter]:
+            # statistics counters were reset since the last scan, so there's no way to know what changed
+            return True
+    churn = (o['n_tup_upd'] - state['n_tup_upd']) + (o['n_tup_del'] - state['n_tup_del'])
+    if o['relkind'] == 'i':
+        # heap only tuple updates do not add new index entries
+        churn -= (o['n_tup_hot_upd'] - state['n_tup_hot_upd'])
+    return churn > (args.incremental_threshold / 100) * max(o['parent_reltuples'], 1)
+
+
+def check_analyze_needed(o):
+    """
+    Decide whether the table an object belongs to needs to be analyzed before the object is scanned.
+    Only the row estimates depend on it, so a table is analyzed only if it never has been or enough
+    rows were modified since its last analyze.
+    """
+    if o['relkind'] == "t" or o['parent_nspname'] == "pg_toast":
+        # toast tables (or the indexes on them) cannot be analyzed
+        return False
+    if o['last_analyze'] == None or o['n_mod_since_analyze'] == None or o['parent_reltuples'] < 0:
+        return True
+    return o['n_mod_since_analyze'] > (args.analyze_threshold / 100) * max(o['parent_reltuples'], 1)
+
+
+def check_fsm_stale(o):
+    """
+    The free space map is only kept up to date by vacuum. Decide whether it should not be trusted
+    for --fsm and the table scanned in full instead.
+    """
+    if o['last_vacuum'] == None or o['fsm_size'] == 0:
+        return True
+    changed = o['n_ins_since_vacuum'] + o['n_dead_tup']
+    return changed > (args.fsm_stale_threshold / 100) * max(o['parent_reltuples'], 1)
+
+
+def start_run(cur, block_size):
+    """
+    Returns the run id to use for this scan along with whether it is resuming an unfinished run.
+    Unless --resume is set, any unfinished runs are abandoned and their partial results removed.
+    """
+    store = get_result_store()
+    sql = "SELECT run_id, mode FROM " + bloat_table_name("bloat_runs") + " WHERE finished_at IS NULL"
+    if store != None:
+        runs = store.query(sql + " AND database = %s ORDER BY run_id DESC LIMIT 1", [get_dbname(cur.connection)])
+        unfinished_run = runs[0] if runs else None
+    else:
+        cur.execute(sql + " ORDER BY run_id DESC LIMIT 1")
+        unfinished_run = cur.fetchone()
+
+    if args.resume and unfinished_run != None:
+        if unfinished_run['mode'] != args.mode:
+            raise BloatCheckError("Unfinished run " + str(unfinished_run['run_id']) + " was started with --mode=" + unfinished_run['mode'] + ". The same mode must be used to resume it.")
+        if args.debug:
+            print("Resuming unfinished run: " + str(unfinished_run['run_id']))
+        return unfinished_run['run_id'], True
+
+    if args.resume and args.debug:
+        print("No unfinished run found to resume. Starting a new run.")
 
-    sql = "SELECT current_setting('block_size')"
+    if store != None:
+        run_id = store.new_run(get_dbname(cur.connection), args.mode, block_size)
+        if args.debug:
+            print("Starting new run: " + str(run_id))
+        return run_id, False
+
+    unfinished_runs = "(SELECT run_id FROM " + bloat_table_name("bloat_runs") + " WHERE finished_at IS NULL)"
+    cur.execute("DELETE FROM " + bloat_table_name("bloat_stats") + " WHERE run_id IN " + unfinished_runs)
+    cur.execute("DELETE FROM " + bloat_table_name("bloat_scan_state") + " WHERE run_id IN " + unfinished_runs)
+    cur.execute("DELETE FROM " + bloat_table_name("bloat_runs") + " WHERE finished_at IS NULL")
+    sql = "INSERT INTO " + bloat_table_name("bloat_runs") + " (mode) VALUES (%s) RETURNING run_id"
+    cur.execute(sql, [args.mode])
+    run_id = cur.fetchone()[0]
+    if args.debug:
+        print("Starting new run: " + str(run_id))
+    return run_id, False
+
+
+def finish_run(cur, run_id, carried_oids, snapshot_oids):
+    """
+    Switch the report over to the given run once all of its objects have been scanned or the --time_budget ran out.
+    Only the rows of the given carried_oids (objects carried forward by --incremental, skipped or not reached before
+    the --time_budget ran out) are kept from previous runs.
+    """
+    store = get_result_store()
+    if store != None:
+        store.finish_run(get_dbname(cur.connection), run_id, carried_oids, snapshot_oids)
+        if args.debug:
+            print("Finished run: " + str(run_id))
+        return
+
+    clear_tables = []
+    if args.mode == "tables" or args.mode == "both":
+        clear_tables.append("bloat_tables")
+    if args.mode == "indexes" or args.mode == "both":
+        clear_tables.append("bloat_indexes")
+    for t in clear_tables:
+        sql = "DELETE FROM " + bloat_table_name(t) + " WHERE run_id <> %s AND NOT (oid = ANY(%s::oid[]))"
+        cur.execute(sql, [run_id, carried_oids])
+
+    # forget the state of objects that no longer exist or are no longer part of the scan
+    sql = "DELETE FROM " + bloat_table_name("bloat_scan_state") + " WHERE NOT (oid = ANY(%s::oid[]))"
+    if args.mode == "tables":
+        sql += " AND relkind <> 'i'"
+    elif args.mode == "indexes":
+        sql += " AND relkind = 'i'"
+    cur.execute(sql, [snapshot_oids])
+
+    sql = "UPDATE " + bloat_table_name("bloat_runs") + " SET finished_at = CURRENT_TIMESTAMP WHERE run_id = %s"
+    cur.execute(sql, [run_id])
+    if args.debug:
+        print("Finished run: " + str(run_id))
+
+    if args.history:
+        record_history(cur, run_id)
+
+
+def record_history(cur, run_id):
+    """
+    Copy the statistics of a finished run into the monthly partitions of the bloat_history table,
+    creating partitions as needed, then drop partitions older than --history_retention.
+    Objects carried forward by --incremental are not copied again since their row is from an earlier run.
+    """
+    sql = """SELECT to_char(m, 'YYYYMM') AS suffix, m AS range_start, m + interval '1 month' AS range_end
+             FROM generate_series( (SELECT date_trunc('month', min(stats_timestamp)) FROM """ + bloat_table_name("bloat_stats") + """ WHERE run_id = %(run_id)s)
+                                 , (SELECT date_trunc('month', max(stats_timestamp)) FROM """ + bloat_table_name("bloat_stats") + """ WHERE run_id = %(run_id)s)
+                                 , interval '1 month') m"""
+    cur.execute(sql, {'run_id': run_id})
+    for p in cur.fetchall():
+        sql = "CREATE TABLE IF NOT EXISTS " + bloat_table_name("bloat_history_p" + p['suffix']) + " PARTITION OF " + bloat_table_name("bloat_history") + " FOR VALUES FROM (%s) TO (%s)"
+        if args.debug:
+            print("history partition sql: " + str(cur.mogrify(sql, [p['range_start'], p['range_end']])))
+        cur.execute(sql, [p['range_start'], p['range_end']])
+
+    sql = "INSERT INTO " + bloat_table_name("bloat_history") + """ (run_id, oid, schemaname, objectname, objecttype, size_bytes, wasted_bytes, wasted_percent, method, stats_timestamp)
+             SELECT run_id, oid, schemaname, objectname, objecttype, size_bytes
+                , GREATEST(dead_tuple_size_bytes + (free_space_bytes - (relpages - (fillfactor/100) * relpages ) * current_setting('block_size')::int ), 0)::bigint
+                , GREATEST(dead_tuple_percent + (free_percent - (100-fillfactor)), 0)
+                , method
+                , stats_timestamp
+             FROM """ + bloat_table_name("bloat_stats") + """
+             WHERE run_id = %s"""
+    cur.execute(sql, [run_id])
+    if args.debug:
+        print("Rows added to history: " + str(cur.rowcount))
+
+    # partition names end in the YYYYMM they start at, so their upper bound is one month later
+    sql = """SELECT format('%%I.%%I', n.nspname, c.relname) AS partition_name
+             FROM pg_catalog.pg_inherits i
+             JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+             JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+             WHERE i.inhparent = pg_catalog.to_regclass(%s)
+             AND c.relname ~ '^bloat_history_p[0-9]{6}$'
+             AND to_date(right(c.relname, 6), 'YYYYMM') + interval '1 month' <= CURRENT_DATE - %s * interval '1 day'"""
+    cur.execute(sql, [bloat_table_name("bloat_history"), args.history_retention])
+    for p in cur.fetchall():
+        sql = "DROP TABLE " + p['partition_name']
+        if args.debug:
+            print("Dropping history partition past --history_retention: " + sql)
+        cur.execute(sql)
+
+
+def get_catalog_snapshot(cur, exclude_schema_list, include_schema_list, exclude_rules):
+    """
+    Build an in-memory snapshot of every object to be scanned along with all the catalog
+    details the scan loop needs (toast table, parent table, relpages, reloptions, indisprimary).
+    This is done with a few set based queries up front instead of several queries per object.
+    Objects excluded completely by the --exclude_object_file are left out.
+    """
+    sql = "SELECT current_setting('block_size')::int AS block_size, current_setting('server_version_num')::int AS server_version_num"
     cur.execute(sql)
-    block_size = int(cur.fetchone()[0])
+    result = cur.fetchone()
+    block_size = result['block_size']
+    server_version_num = result['server_version_num']
+
+    # pg_relation_size() takes a lock on the relation, so a catalog snapshot taken while an ALTER TABLE,
+    # VACUUM FULL, etc is holding or waiting on an ACCESS EXCLUSIVE lock would stall until it is done.
+    # Fall back to relpages for those objects. The scan itself then hits --lock_timeout and is deferred.
+    sql_locked = """c.oid IN (SELECT l.relation FROM pg_catalog.pg_locks l
+                        WHERE l.locktype = 'relation' AND l.mode = 'AccessExclusiveLock'
+                        AND l.database = (SELECT oid FROM pg_catalog.pg_database WHERE datname = current_database()))"""
+    sql_size = "CASE WHEN " + sql_locked + " THEN c.relpages::bigint * " + str(block_size) + " ELSE pg_catalog.pg_relation_size(c.oid) END"
+    sql_fsm_size = "CASE WHEN " + sql_locked + " THEN 0 ELSE pg_catalog.pg_relation_size(c.oid, 'fsm') END"
+
+    # Change counters used by --incremental. Indexes use the counters of the table they are on.
+    sql_counters = """, COALESCE(s.n_tup_upd, 0) AS n_tup_upd, COALESCE(s.n_tup_del, 0) AS n_tup_del, COALESCE(s.n_tup_hot_upd, 0) AS n_tup_hot_upd
+                        , COALESCE(s.vacuum_count, 0) AS vacuum_count, COALESCE(s.autovacuum_count, 0) AS autovacuum_count """
+
+    # Analyze activity of the parent table used to skip analyzing tables whose statistics are still current
+    sql_counters += ", GREATEST(s.last_analyze, s.last_autoanalyze) AS last_analyze "
+    if server_version_num >= 90400:
+        sql_counters += ", s.n_mod_since_analyze "
+    else:
+        sql_counters += ", NULL::bigint AS n_mod_since_analyze "
+
+    # Vacuum activity used by --fsm to decide if the free space map of a table can be trusted
+    sql_counters += """, GREATEST(s.last_vacuum, s.last_autovacuum) AS last_vacuum, COALESCE(s.n_dead_tup, 0) AS n_dead_tup
+                        , """ + sql_fsm_size + """ AS fsm_size """
+    if server_version_num >= 130000:
+        sql_counters += ", COALESCE(s.n_ins_since_vacuum, 0) AS n_ins_since_vacuum "
+    else:
+        sql_counters += ", 0 AS n_ins_since_vacuum "
 
+    # parent columns are the table that gets analyzed for the given object.
+    # For tables & mat views that is the object itself, for indexes it is the table the index is on.
     sql_tables = """ SELECT c.oid, c.relkind, c.relname, n.nspname, 'false' as indisprimary, c.reloptions
+                        , c.relpages, """ + sql_size + """ AS relation_size, c.reltoastrelid
+                        , c.oid AS parent_oid, n.nspname AS parent_nspname, c.relname AS parent_relname
+                        , c.relfilenode, c.reltuples AS parent_reltuples, NULL::text AS amname """ + sql_counters + """
                     FROM pg_catalog.pg_class c
                     JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+                    LEFT JOIN pg_catalog.pg_stat_all_tables s ON s.relid = c.oid
                     WHERE relkind IN ('r', 'm')
                     AND c.relpersistence <> 't' """
 
-    sql_indexes = """ SELECT c.oid, c.relkind, c.relname, n.nspname, i.indisprimary, c.reloptions 
+    sql_indexes = """ SELECT c.oid, c.relkind, c.relname, n.nspname, i.indisprimary, c.reloptions
+                        , c.relpages, """ + sql_size + """ AS relation_size, c.reltoastrelid
+                        , t.oid AS parent_oid, tn.nspname AS parent_nspname, t.relname AS parent_relname
+                        , c.relfilenode, t.reltuples AS parent_reltuples, a.amname::text AS amname """ + sql_counters + """
                     FROM pg_catalog.pg_class c
                     JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
                     JOIN pg_catalog.pg_index i ON c.oid = i.indexrelid
+                    JOIN pg_catalog.pg_class t ON t.oid = i.indrelid
+                    JOIN pg_catalog.pg_namespace tn ON t.relnamespace = tn.oid
+                    LEFT JOIN pg_catalog.pg_stat_all_tables s ON s.relid = t.oid
                     JOIN pg_catalog.pg_am a ON c.relam = a.oid
-                    WHERE c.relkind = 'i' 
+                    WHERE c.relkind = 'i'
                     AND c.relpersistence <> 't'
                     AND a.amname <> 'gin'
                     AND a.amname <> 'brin'
                     AND a.amname <> 'spgist' """
 
+    # Toast tables are gathered based on the table they belong to so that only toast tables relevant
+    # to either schema or table filtering are gathered. Object columns are the toast table itself.
+    sql_toast = """ SELECT c.oid, c.relkind, c.relname, n.nspname, 'false' as indisprimary, c.reloptions
+                        , c.relpages, """ + sql_size + """ AS relation_size, c.reltoastrelid
+                        , c.oid AS parent_oid, n.nspname AS parent_nspname, c.relname AS parent_relname
+                        , c.relfilenode, c.reltuples AS parent_reltuples, NULL::text AS amname """ + sql_counters + """
+                        , p.oid AS toast_owner_oid, pn.nspname||'.'||p.relname AS toast_owner_name
+                    FROM pg_catalog.pg_class c
+                    JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+                    LEFT JOIN pg_catalog.pg_stat_all_tables s ON s.relid = c.oid
+                    JOIN pg_catalog.pg_class p ON p.reltoastrelid = c.oid
+                    JOIN pg_catalog.pg_namespace pn ON p.relnamespace = pn.oid
+                    WHERE p.relkind IN ('r', 'm')
+                    AND p.relpersistence <> 't'
+                    AND c.relpersistence <> 't' """
 
-    cur.execute("SELECT current_setting('server_version_num')::int >= 90300")
-    if cur.fetchone()[0] == True:
+    if server_version_num >= 90300:
         sql_indexes += " AND indislive = 'true' "
 
+    sql_params = { 'tablename': args.tablename, 'min_size': convert_to_bytes(args.min_size) }
+
     if args.tablename != None:
-        sql_tables += " AND n.nspname||'.'||c.relname = %s "
-        sql_indexes += " AND i.indrelid::regclass = %s::regclass "
+        sql_tables += " AND n.nspname||'.'||c.relname = %(tablename)s "
+        sql_indexes += " AND i.indrelid::regclass = %(tablename)s::regclass "
+        sql_toast += " AND pn.nspname||'.'||p.relname = %(tablename)s "
 
         sql_class = sql_tables + """
                     UNION 
                     """ + sql_indexes
-
-        if args.debug:
-            print("sql_class: " + str(cur.mogrify(sql_class, [args.tablename, args.tablename])) )
-        cur.execute(sql_class, [args.tablename, args.tablename] )
     else:
         # IN clauses work with python tuples. lists were converted by get_bloat() call
         if include_schema_list:
-            sql_tables += " AND n.nspname IN %s"
-            sql_indexes += " AND n.nspname IN %s"
-            filter_list = include_schema_list
+            sql_tables += " AND n.nspname IN %(schema_list)s"
+            sql_indexes += " AND n.nspname IN %(schema_list)s"
+            sql_toast += " AND pn.nspname IN %(schema_list)s"
+            sql_params['schema_list'] = include_schema_list
         elif exclude_schema_list:
-            sql_tables += " AND n.nspname NOT IN %s"
-            sql_indexes += " AND n.nspname NOT IN %s"
-            filter_list = exclude_schema_list
-        else:
-            filter_list = ""
+            sql_tables += " AND n.nspname NOT IN %(schema_list)s"
+            sql_indexes += " AND n.nspname NOT IN %(schema_list)s"
+            sql_toast += " AND pn.nspname NOT IN %(schema_list)s"
+            sql_params['schema_list'] = exclude_schema_list
+
+        # Objects excluded by name or by wildcards that LIKE can handle never leave the server
+        if exclude_rules.full_names:
+            sql_exclude = " AND n.nspname||'.'||c.relname <> ALL(%(exclude_names)s::text[]) "
+            sql_tables += sql_exclude
+            sql_indexes += sql_exclude
+            sql_toast += sql_exclude
+            sql_params['exclude_names'] = list(exclude_rules.full_names)
+        if exclude_rules.full_like_patterns:
+            sql_exclude = " AND NOT (n.nspname||'.'||c.relname LIKE ANY(%(exclude_like_patterns)s::text[])) "
+            sql_tables += sql_exclude
+            sql_indexes += sql_exclude
+            sql_toast += sql_exclude
+            sql_params['exclude_like_patterns'] = exclude_rules.full_like_patterns
 
         if args.mode == 'tables':
             sql_class = sql_tables
@@ -224,264 +1124,1868 @@ def get_bloat(conn, exclude_schema_list, include_schema_list, exclude_object_lis
                     UNION 
                     """ + sql_indexes
 
-        if args.mode == "both":
-            if args.debug:
-                print("sql_class: " + str(cur.mogrify(sql_class, (filter_list,filter_list) )) )
-            cur.execute(sql_class, (filter_list,filter_list))
-        elif args.mode == "tables" or args.mode == "indexes":
-            if args.debug:
-                print("sql_class: " + str(cur.mogrify(sql_class, (filter_list,) )) )
-            cur.execute(sql_class, (filter_list,) )
-        else:
-            cur.execute(sql)
+        # Apply the --min_size filter here so undersized objects are never analyzed or scanned. With --debug it is
+        # applied once the snapshot is read instead, so that the objects it removes can be counted.
+        if not args.debug:
+            sql_class = "SELECT * FROM (" + sql_class + ") x WHERE x.relation_size > %(min_size)s"
+            sql_toast += " AND " + sql_size + " > %(min_size)s "
+
+    if args.debug:
+        print("sql_class: " + str(cur.mogrify(sql_class, sql_params)) )
+    cur.execute(sql_class, sql_params)
+    object_list_no_toast = [ dict(o) for o in cur.fetchall() ]
+    if args.tablename == None:
+        # remaining complete exclusions (regular expressions & [seq] wildcards) are matched here
+        object_list_no_toast = [ o for o in object_list_no_toast if not exclude_rules.is_excluded(o['nspname'] + "." + o['relname']) ]
+
+    toast_dict = {}
+    if args.tablename != None or args.mode == "tables" or args.mode == "both":
+        if args.debug:
+            print("sql_toast: " + str(cur.mogrify(sql_toast, sql_params)) )
+        cur.execute(sql_toast, sql_params)
+        for t in cur.fetchall():
+            if args.tablename == None and exclude_rules.is_excluded(t['nspname'] + "." + t['relname']):
+                continue
+            toast_dict[t['toast_owner_oid']] = dict(t)
 
-    object_list_no_toast = cur.fetchall()
+    if args.tablename == None and args.debug:
+        pruned_count = len(object_list_no_toast) + len(toast_dict)
+        object_list_no_toast = [ o for o in object_list_no_toast if o['relation_size'] > sql_params['min_size'] ]
+        toast_dict = dict( (k, t) for k, t in toast_dict.items() if t['relation_size'] > sql_params['min_size'] )
+        pruned_count -= len(object_list_no_toast) + len(toast_dict)
+        print("Objects pruned by --min_size during discovery: " + str(pruned_count))
 
-    # Gather associated toast tables after generating above list so that only toast tables relevant
-    # to either schema or table filtering are gathered
+    # Keep each toast table right after the object it belongs to. If the table itself was
+    # filtered out by --min_size but its toast table was not, the toast table goes at the end.
     object_list_with_toast = []
     for o in object_list_no_toast:
-        # Add existing objects to new list
         object_list_with_toast.append(o)
-
-        if o['relkind'] == 'r' or o['relkind'] == 'm':
-            # only run for tables or mat views to speed things up
-            # Note tables without a toast table have the value 0 for reltoastrelid, not NULL
-            sql_toast = """  WITH toast_data AS (
-                            SELECT reltoastrelid FROM pg_class WHERE oid = %s AND reltoastrelid != 0
-                        )
-                        SELECT c.oid, c.relkind, c.relname, n.nspname, 'false' as indisprimary, c.reloptions
-                        FROM pg_catalog.pg_class c
-                        JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
-                        JOIN toast_data ON c.oid = toast_data.reltoastrelid
-                        AND c.relpersistence <> 't' """
-            cur.execute(sql_toast, [ o['oid'] ])
-            # Add new toast table to list if one exists for given table
-            result = cur.fetchone()
-            if result != None: 
-                object_list_with_toast.append(result)
+        if o['relkind'] != 'i' and o['oid'] in toast_dict:
+            object_list_with_toast.append(toast_dict.pop(o['oid']))
+    object_list_with_toast.extend(toast_dict.values())
 
     if args.debug:
         for o in object_list_with_toast:
             print("object_list_with_toast: " + str(o))
 
-    sql = "TRUNCATE "
-    if args.bloat_schema:
-        sql += args.bloat_schema + "."
-    if args.mode == "tables" or args.mode == "both":
-        sql_table = sql + "bloat_tables"
-        cur.execute(sql_table)
-    if args.mode == "indexes" or args.mode == "both":
-        sql_index = sql + "bloat_indexes"
-        cur.execute(sql_index)
+    return block_size, object_list_with_toast
+## end get_catalog_snapshot()
+
+
+def apply_triage_estimates(cur, object_list, block_size):
+    """
+    Estimate the bloat of each table & btree index from catalog statistics only, similar to
+    the query used by check_postgres. Objects whose estimate is comfortably below the report
+    thresholds get an 'estimate' entry attached that is stored in place of a pgstattuple scan.
+    Returns the number of objects that will still be scanned.
+    """
+    table_oids = [ o['oid'] for o in object_list if o['relkind'] == 'r' or o['relkind'] == 'm' ]
+    index_oids = [ o['oid'] for o in object_list if o['relkind'] == 'i' ]
+
+    estimate_data = {}
+    if table_oids:
+        sql = """ SELECT c.oid
+                    , c.reltuples
+                    , count(a.attnum) AS att_count
+                    , count(s.attname) AS stats_count
+                    , COALESCE(sum((1 - s.null_frac) * s.avg_width), 0) AS data_width
+                    , COALESCE(max(s.null_frac), 0) > 0 AS has_nulls
+                FROM pg_catalog.pg_class c
+                JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid
+                JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+                LEFT JOIN pg_catalog.pg_stats s ON s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = a.attname AND NOT s.inherited
+                WHERE c.oid = ANY(%s::oid[])
+                GROUP BY c.oid, c.reltuples """
+        if args.debug:
+            print("triage table sql: " + str(cur.mogrify(sql, [table_oids])))
+        cur.execute(sql, [table_oids])
+        for r in cur.fetchall():
+            estimate_data[r['oid']] = r
+    if index_oids:
+        # key columns of expression indexes have an attnum of zero and have no statistics on the table
+        sql = """ SELECT i.indexrelid AS oid
+                    , ci.reltuples
+                    , count(*) AS att_count
+                    , count(s.attname) AS stats_count
+                    , COALESCE(sum((1 - s.null_frac) * s.avg_width), 0) AS data_width
+                    , COALESCE(max(s.null_frac), 0) > 0 AS has_nulls
+                    , am.amname
+                FROM pg_catalog.pg_index i
+                JOIN pg_catalog.pg_class ci ON ci.oid = i.indexrelid
+                JOIN pg_catalog.pg_am am ON am.oid = ci.relam
+                JOIN pg_catalog.pg_class ct ON ct.oid = i.indrelid
+                JOIN pg_catalog.pg_namespace n ON ct.relnamespace = n.oid
+                CROSS JOIN LATERAL unnest(i.indkey::int2[]) AS k(attnum)
+                LEFT JOIN pg_catalog.pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                LEFT JOIN pg_catalog.pg_stats s ON s.schemaname = n.nspname AND s.tablename = ct.relname AND s.attname = a.attname AND NOT s.inherited
+                WHERE i.indexrelid = ANY(%s::oid[])
+                GROUP BY i.indexrelid, ci.reltuples, am.amname """
+        if args.debug:
+            print("triage index sql: " + str(cur.mogrify(sql, [index_oids])))
+        cur.execute(sql, [index_oids])
+        for r in cur.fetchall():
+            if r['amname'] == 'btree':
+                estimate_data[r['oid']] = r
+
+    min_wasted_size = convert_to_bytes(args.min_wasted_size) * (1 - args.triage_margin / 100)
+    min_wasted_percentage = args.min_wasted_percentage * (1 - args.triage_margin / 100)
+    maxalign = 8
+    scan_count = 0
+    for o in object_list:
+        e = estimate_data.get(o['oid'])
+        if e == None or e['stats_count'] < e['att_count'] or e['reltuples'] < 0 or o['relation_size'] == 0:
+            # no usable statistics, so the object has to be scanned
+            scan_count += 1
+            continue
+
+        fillfactor = get_fillfactor(o)
+        if o['relkind'] == 'i':
+            # index tuple header + data, plus the line pointer. Page header (24) & btree special space (16) are not usable.
+            tuple_size = math.ceil((8 + float(e['data_width'])) / maxalign) * maxalign + 4
+            usable_space = (block_size - 24 - 16) * fillfactor / 100
+            # add one page for the metapage
+            overhead_pages = 1
+        else:
+            # heap tuple header including the null bitmap, plus the data and the line pointer
+            header_size = 23
+            if e['has_nulls']:
+                header_size += (e['att_count'] + 7) // 8
+            tuple_size = math.ceil(header_size / maxalign) * maxalign + math.ceil(float(e['data_width']) / maxalign) * maxalign + 4
+            usable_space = (block_size - 24) * fillfactor / 100
+            overhead_pages = 0
+        tuples_per_page = max(math.floor(usable_space / tuple_size), 1)
+        est_pages = math.ceil(e['reltuples'] / tuples_per_page) + overhead_pages
+
+        relpages = o['relation_size'] // block_size
+        wasted_space = max(relpages - est_pages, 0) * block_size
+        wasted_perc = wasted_space / o['relation_size'] * 100
+
+        if args.debug:
+            print("triage estimate for " + o['nspname'] + "." + o['relname'] + ": " + str(wasted_space) + " bytes (" + "{:.2f}".format(wasted_perc) + "%)")
+
+        if wasted_space >= min_wasted_size and wasted_perc >= min_wasted_percentage:
+            scan_count += 1
+            continue
+
+        # Free space includes the space reserved by fillfactor, same as pgstattuple reports it
+        tuple_len = min(int(e['reltuples'] * tuple_size), o['relation_size'])
+        free_space = int(wasted_space + (relpages - (fillfactor / 100 * relpages)) * block_size)
+        o['estimate'] = { 'table_len': o['relation_size']
+                        , 'tuple_count': int(e['reltuples'])
+                        , 'tuple_len': tuple_len
+                        , 'tuple_percent': tuple_len / o['relation_size'] * 100
+                        , 'dead_tuple_count': 0
+                        , 'dead_tuple_len': 0
+                        , 'dead_tuple_percent': 0
+                        , 'free_space': free_space
+                        , 'free_percent': free_space / o['relation_size'] * 100
+                        , 'relpages': relpages }
+    return scan_count
+## end apply_triage_estimates()
+
+
+def order_by_scan_priority(cur, object_list, block_size):
+    """
+    Order objects for a --time_budget scan so that those most likely to be worth scanning go first.
+    Objects with the most wasted space recorded by the previous run come first, followed by all
+    other objects from largest to smallest.
+    """
+    store = get_result_store()
+    sql = """ SELECT oid
+                , (dead_tuple_size_bytes + (free_space_bytes - (relpages - (fillfactor/100) * relpages ) * %s ) ) AS wasted_size
+            FROM """ + bloat_table_name("bloat_stats")
+    if store != None:
+        rows = store.query(sql + " WHERE database = %s", [block_size, get_dbname(cur.connection)])
+    else:
+        cur.execute(sql, [block_size])
+        rows = cur.fetchall()
+    previous_wasted = {}
+    for r in rows:
+        previous_wasted[r['oid']] = max(r['wasted_size'], 0)
+    return sorted(object_list, key=lambda o: (previous_wasted.get(o['oid'], 0), o['relation_size']), reverse=True)
+
+
+def check_raw_page_allowed(conn, dbname=None):
+    """
+    Returns whether get_raw_page() of pageinspect can be run on the server objects are read from. It always requires
+    a superuser, no matter what privileges have been granted on the function.
+    """
+    if args.scan_connection != None:
+        scan_conn = open_worker_conn(dbname, scan=True)
+        try:
+            return check_superuser(scan_conn)
+        finally:
+            release_worker_conn(scan_conn, dbname, scan=True)
+    return check_superuser(conn)
+
+
+def check_superuser(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT current_setting('is_superuser') = 'on'")
+    is_superuser = cur.fetchone()[0]
     conn.commit()
+    cur.close()
+    return is_superuser
+
+
+def get_bloat(conn, exclude_schema_list, include_schema_list, exclude_object_list, dbname=None):
+    catalog_start = time.time()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    scan_in_recovery = False
+    if args.scan_connection != None:
+        scan_conn = open_worker_conn(dbname, scan=True)
+        try:
+            scan_in_recovery = check_scan_server(conn, scan_conn)
+        finally:
+            release_worker_conn(scan_conn, dbname, scan=True)
+        if scan_in_recovery and args.debug:
+            print("Scan server is in recovery. Tables will not be analyzed.")
+
+    freespacemap_schema = None
+    if args.fsm:
+        freespacemap_schema = get_extension_schema(conn, "pg_freespacemap", "--fsm")
+    # pg_stat_progress_vacuum is only available in PostgreSQL 9.6+
+    cur.execute("SELECT pg_catalog.to_regclass('pg_catalog.pg_stat_progress_vacuum') IS NOT NULL")
+    check_vacuum = cur.fetchone()[0]
+
+    pageinspect_schema = None
+    if args.sample:
+        pageinspect_schema = get_extension_schema(conn, "pageinspect", "--sample")
+    elif args.max_read_rate != None:
+        pageinspect_schema = get_extension_schema(conn, "pageinspect", None)
+        if pageinspect_schema == None and args.debug:
+            print("pageinspect extension not found. Large tables will not be split into chunks for --max_read_rate.")
+        elif pageinspect_schema != None and check_raw_page_allowed(conn, dbname) == False:
+            pageinspect_schema = None
+            if args.quiet == 0 or args.debug:
+                print("get_raw_page() of the pageinspect extension requires a superuser, so large tables will not be split into chunks for --max_read_rate."
+                      + " They are read with pgstattuple() and paced once each has been read.", file=sys.stderr)
+
+    exclude_rules = ExcludeRules(exclude_object_list)
+    block_size, object_list_with_toast = get_catalog_snapshot(cur, exclude_schema_list, include_schema_list, exclude_rules)
+
+    snapshot_oids = [ o['oid'] for o in object_list_with_toast ]
+    run_id, resumed = start_run(cur, block_size)
+
+    store = get_result_store()
+    sql = "SELECT oid, relfilenode, n_tup_upd, n_tup_del, n_tup_hot_upd, vacuum_count, autovacuum_count, run_id FROM " + bloat_table_name("bloat_scan_state")
+    if store != None:
+        rows = store.query(sql + " WHERE database = %s", [get_dbname(conn)])
+    else:
+        cur.execute(sql)
+        rows = cur.fetchall()
+    scan_state = {}
+    for r in rows:
+        scan_state[r['oid']] = r
+
+    if resumed:
+        # skip objects the unfinished run already completed
+        object_list_with_toast = [ o for o in object_list_with_toast if o['oid'] not in scan_state or scan_state[o['oid']]['run_id'] != run_id ]
+        if args.debug:
+            print("Objects remaining in resumed run: " + str(len(object_list_with_toast)))
+
+    # objects carried forward from the previous run keep their existing rows in the stats tables
+    carried_oids = []
+    if args.incremental:
+        object_list_changed = []
+        for o in object_list_with_toast:
+            if check_object_changed(o, scan_state.get(o['oid'])):
+                object_list_changed.append(o)
+            else:
+                carried_oids.append(o['oid'])
+        if args.debug:
+            print("Incremental scan. Objects to scan: " + str(len(object_list_changed)) + ", objects carried forward: " + str(len(carried_oids)))
+        object_list_with_toast = object_list_changed
 
+    if args.triage:
+        scan_count = apply_triage_estimates(cur, object_list_with_toast, block_size)
+        if args.debug:
+            print("Triage estimate. Objects to scan: " + str(scan_count) + ", objects using estimate only: " + str(len(object_list_with_toast) - scan_count))
+
+    if args.time_budget != None:
+        object_list_with_toast = order_by_scan_priority(cur, object_list_with_toast, block_size)
+
+    conn.commit()
+
+    object_queue = queue.Queue()
     for o in object_list_with_toast:
+        object_queue.put(o)
+
+    # State shared between all scan workers
+    run_state = { 'block_size': block_size
+                , 'exclude_rules': exclude_rules
+                , 'run_id': run_id
+                , 'freespacemap_schema': freespacemap_schema
+                , 'pageinspect_schema': pageinspect_schema
+                , 'rate_limiter': read_rate_limiter
+                # maintain a set of analyzed tables so that if a table was already analyzed, it's not again (ex. multiple indexes on same table)
+                # shared between all workers, so it is guarded by a lock
+                , 'analyzed_tables': set()
+                , 'analyze_lock': threading.Lock()
+                , 'stop_event': threading.Event()
+                , 'deadline': None
+                # objects deferred because of a running vacuum or a lock/statement timeout. Retried once at the end of the run
+                , 'check_vacuum': check_vacuum
+                , 'retry_list': []
+                , 'skipped': []
+                , 'final_pass': False
+                , 'retry_lock': threading.Lock()
+                # objects are read from a hot standby with --scan_connection, where ANALYZE cannot run
+                , 'scan_in_recovery': scan_in_recovery
+                , 'dbname': dbname
+                # totals recorded in bloat_runs for the --format=openmetrics run metrics & --timing summary
+                , 'objects_scanned': 0
+                , 'bytes_scanned': 0
+                # per phase totals for the --timing summary
+                , 'catalog_seconds': 0.0
+                , 'analyze_seconds': 0.0
+                , 'scan_seconds': 0.0
+                , 'write_seconds': 0.0
+                , 'counts_lock': threading.Lock() }
+    if args.time_budget != None:
+        run_state['deadline'] = time.time() + args.time_budget
+
+    run_state['catalog_seconds'] = time.time() - catalog_start
+
+    run_scan_workers(conn, object_queue, len(object_list_with_toast), run_state, dbname)
+
+    if run_state['retry_list'] and not run_state['stop_event'].is_set():
         if args.debug:
-            print("begining of object list loop: " + str(o))
-        if exclude_object_list and args.tablename == None:
-            # completely skip object being scanned if it's in the excluded file list with max values equal to zero
-            match_found = False
-            for e in exclude_object_list:
-                if (e['objectname'] == o['nspname'] + "." + o['relname']) and (e['max_wasted'] == 0) and (e['max_perc'] == 0):
-                    match_found = True
-            if match_found:
-                continue
+            print("Retrying " + str(len(run_state['retry_list'])) + " deferred objects")
+        for o in run_state['retry_list']:
+            object_queue.put(o)
+        run_state['final_pass'] = True
+        run_scan_workers(conn, object_queue, len(run_state['retry_list']), run_state, dbname)
 
-        if o['relkind'] == "i": 
-            fillfactor = 90.0
-        else:
-            fillfactor = 100.0
-
-        if o['reloptions'] != None:
-            reloptions_dict = dict(o.split('=') for o in o['reloptions'])
-            if 'fillfactor' in reloptions_dict:
-                fillfactor = float(reloptions_dict['fillfactor'])
-        
-        sql = """ SELECT count(*) FROM pg_catalog.pg_class WHERE oid = %s """
-        cur.execute(sql, [ o['oid'] ])
-        exists = cur.fetchone()[0]
+    # anything left in the queue was not reached before the --time_budget ran out
+    not_scanned = []
+    while not object_queue.empty():
+        not_scanned.append(object_queue.get_nowait())
+
+    # skipped objects & objects not reached before the --time_budget ran out keep their statistics from the previous run
+    skipped = run_state['skipped']
+    kept_oids = carried_oids + [ o['oid'] for o, reason in skipped ] + [ o['oid'] for o in not_scanned ]
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    # added to the totals of any earlier attempts when resuming a run
+    sql = "UPDATE " + bloat_table_name("bloat_runs") + """ SET objects_scanned = objects_scanned + %s
+                , bytes_scanned = bytes_scanned + %s
+                , objects_skipped = %s
+                , catalog_seconds = catalog_seconds + %s
+                , analyze_seconds = analyze_seconds + %s
+                , scan_seconds = scan_seconds + %s
+                , write_seconds = write_seconds + %s
+             WHERE run_id = %s"""
+    run_totals = [ run_state['objects_scanned'], run_state['bytes_scanned'], len(skipped), run_state['catalog_seconds']
+                 , run_state['analyze_seconds'], run_state['scan_seconds'], run_state['write_seconds'], run_id ]
+    if store != None:
+        store.execute(sql, run_totals)
+    else:
+        cur.execute(sql, run_totals)
+    if not_scanned and args.debug:
+        print("Run " + str(run_id) + " ran out of time. " + str(len(not_scanned)) + " objects keep their statistics from the previous run.")
+    finish_run(cur, run_id, kept_oids, snapshot_oids)
+    conn.commit()
+    cur.close()
+    return not_scanned, skipped
+## end get_bloat()
+
+
+def run_scan_workers(conn, object_queue, object_count, run_state, dbname):
+    """
+    Scan the objects in the queue, either with the given connection or with --jobs workers that each open their own.
+    """
+    if args.jobs > 1 and object_count > 1:
+        worker_count = min(args.jobs, object_count)
         if args.debug:
-            print("Checking for table existence before scanning: " + str(exists))
-        if exists == 0:
-            continue  # just skip over it. object was dropped since initial list was made
+            print("Starting " + str(worker_count) + " scan workers")
+        worker_conns = []
+        try:
+            for i in range(worker_count):
+                worker_conns.append(open_worker_conn(dbname))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+                futures = [ executor.submit(scan_objects, c, object_queue, run_state)
+                            for c in worker_conns ]
+                for f in futures:
+                    # re-raises the first error encountered by a worker
+                    f.result()
+        finally:
+            for c in worker_conns:
+                release_worker_conn(c, dbname)
+    else:
+        scan_objects(conn, object_queue, run_state)
 
-        if args.noanalyze != True:
-            if o['relkind'] == "r" or o['relkind'] == "m" or o['relkind'] == "t":
-                quoted_table = "\"" + o['nspname'] + "\".\"" + o['relname'] + "\""
-            else:
-                # get table that index is a part of
-                sql = """SELECT n.nspname, c.relname
-                            FROM pg_catalog.pg_class c 
-                            JOIN pg_catalog.pg_index i ON c.oid = i.indrelid 
-                            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace 
-                            WHERE indexrelid = %s"""
-                cur.execute(sql, [ o['oid'] ] )
-                result = cur.fetchone()
-                quoted_table = "\"" + result[0] + "\".\"" + result[1] + "\""
-
-            # maintain a list of analyzed tables so that if a table was already analyzed, it's not again (ex. multiple indexes on same table)
-            if quoted_table in analyzed_tables:
+
+def check_scan_server(conn, scan_conn):
+    """
+    Check that the --scan_connection server is a physical replica of the --connection server (or that server itself)
+    connected to the same database, since objects are looked up on one by their oid and read on the other.
+    Returns whether the scan server is in recovery.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT current_setting('server_version_num')::int")
+    server_version_num = cur.fetchone()[0]
+    scan_cur = scan_conn.cursor()
+    sql = "SELECT oid FROM pg_catalog.pg_database WHERE datname = current_database()"
+    # pg_control_system() is only available in PostgreSQL 9.6+
+    if server_version_num >= 90600:
+        sql = "SELECT d.oid, c.system_identifier FROM pg_catalog.pg_database d, pg_catalog.pg_control_system() c WHERE d.datname = current_database()"
+    cur.execute(sql)
+    scan_cur.execute(sql)
+    if scan_cur.fetchone() != cur.fetchone():
+        raise BloatCheckError("The --scan_connection server is not a physical replica of the --connection server or is connected to a different database. Objects can only be read from a hot standby of the same cluster.")
+    conn.commit()
+    cur.close()
+    scan_cur.close()
+    return check_recovery_status(scan_conn)
+
+
+
+def defer_object(o, reason, run_state):
+    """
+    Move an object that could not be scanned right now to the retry queue. If this is already the retry pass,
+    the object is skipped for this run.
+    """
+    with run_state['retry_lock']:
+        if run_state['final_pass']:
+            run_state['skipped'].append((o, reason))
+        else:
+            run_state['retry_list'].append(o)
+    if args.debug:
+        print("Deferring " + o['nspname'] + "." + o['relname'] + ": " + reason)
+
+
+class ReadRateLimiter:
+    """
+    Paces reads for --max_read_rate. Callers report the bytes they just read and are made to wait until
+    the average rate since the limiter was created is back under the limit. Safe to share between workers.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.next_time = self.start_time
+        self.bytes_read = 0
+        self.seconds_paced = 0.0
+
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + nbytes / self.bytes_per_second
+            self.bytes_read += nbytes
+            wait = self.next_time - now
+            if wait > 0:
+                self.seconds_paced += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+    def summary(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        return ("Read " + "{:.1f}".format(self.bytes_read / 1048576) + " MB in " + "{:.1f}".format(elapsed) + " seconds ("
+                + "{:.2f}".format(self.bytes_read / 1048576 / elapsed) + " MB/s, limit " + "{:.2f}".format(self.bytes_per_second / 1048576)
+                + " MB/s). Waited " + "{:.1f}".format(self.seconds_paced) + " seconds to stay under --max_read_rate.")
+## end class ReadRateLimiter
+
+
+class StatsWriter:
+    """
+    Buffers the statistics rows and scan state of scanned objects for one connection and writes them
+    with multi-row inserts. Buffered rows are written & committed together once --commit_interval seconds
+    have passed or --commit_size bytes have been scanned since the last commit, so an object is never
+    marked as completed for the run without its statistics row.
+    """
+
+    stats_cols = """(oid
+                    , schemaname
+                    , objectname
+                    , objecttype
+                    , size_bytes
+                    , live_tuple_count
+                    , live_tuple_percent
+                    , dead_tuple_count
+                    , dead_tuple_size_bytes
+                    , dead_tuple_percent
+                    , free_space_bytes
+                    , free_percent
+                    , approximate
+                    , relpages
+                    , fillfactor
+                    , method
+                    , avg_leaf_density
+                    , leaf_fragmentation
+                    , leaf_pages
+                    , internal_pages
+                    , empty_pages
+                    , deleted_pages
+                    , sample_blocks
+                    , wasted_error_bytes
+                    , scan_started_at
+                    , analyze_seconds
+                    , scan_seconds
+                    , write_seconds
+                    , bytes_read
+                    , run_id)"""
+
+    def __init__(self, conn, run_id):
+        self.conn = conn
+        self.run_id = run_id
+        self.stats_rows = { 'bloat_tables': [], 'bloat_indexes': [] }
+        self.state_rows = []
+        self.commit_interval = args.commit_interval
+        self.commit_size = convert_to_bytes(args.commit_size)
+        self.bytes_scanned = 0
+        self.last_commit = time.time()
+        # total time spent writing & committing, for the --timing summary
+        self.write_seconds = 0.0
+        # rows are written to the local file instead with --store=sqlite
+        self.store = get_result_store()
+        if self.store != None:
+            self.dbname = get_dbname(conn)
+
+
+    def add_stats(self, table, row, real_table=None):
+        row = row + [self.run_id]
+        if self.store != None:
+            # the catalog is not there to look up the table a toast table belongs to when the report is read from the file
+            row.append(real_table)
+        self.stats_rows[table].append(row)
+
+
+    def commit_if_due(self):
+        """
+        Write & commit the buffered rows if --commit_interval or --commit_size has been reached.
+        Returns the seconds spent doing so.
+        """
+        if self.commit_interval > 0 and (time.time() - self.last_commit) >= self.commit_interval:
+            return self.commit()
+        elif self.commit_size > 0 and self.bytes_scanned >= self.commit_size:
+            return self.commit()
+        return 0.0
+
+
+    def add_scan_state(self, o, bytes_scanned):
+        self.state_rows.append([ o['oid']
+                               , o['relkind']
+                               , o['relfilenode']
+                               , o['n_tup_upd']
+                               , o['n_tup_del']
+                               , o['n_tup_hot_upd']
+                               , o['vacuum_count']
+                               , o['autovacuum_count']
+                               , self.run_id ])
+        self.bytes_scanned += bytes_scanned
+        self.commit_if_due()
+
+
+    def flush(self):
+        if self.store != None:
+            self.store.write(self.dbname, self.stats_rows.values(), self.state_rows)
+            if args.debug:
+                print("Wrote " + str(sum(len(rows) for rows in self.stats_rows.values())) + " statistics rows to " + self.store.path)
+            for rows in self.stats_rows.values():
+                rows.clear()
+            self.state_rows.clear()
+            return
+        cur = self.conn.cursor()
+        if args.lock_timeout != None or args.statement_timeout != None:
+            # Without --scan_connection objects are scanned over this connection with the session level timeouts of
+            # set_scan_timeouts(). Writes are not scans, so they get the defaults of the role until the commit.
+            cur.execute("SET LOCAL lock_timeout TO DEFAULT")
+            cur.execute("SET LOCAL statement_timeout TO DEFAULT")
+        for table, rows in self.stats_rows.items():
+            if rows:
+                sql = "INSERT INTO " + bloat_table_name(table) + " " + self.stats_cols + " VALUES %s"
+                psycopg2.extras.execute_values(cur, sql, rows, page_size=1000)
                 if args.debug:
-                    print("Table already analyzed. Skipping...")
-                pass
-            else:
-                sql = "ANALYZE " + quoted_table
+                    print("Inserted " + str(len(rows)) + " rows into " + table)
+                rows.clear()
+        if self.state_rows:
+            sql = "INSERT INTO " + bloat_table_name("bloat_scan_state") + """ (oid
+                        , relkind
+                        , relfilenode
+                        , n_tup_upd
+                        , n_tup_del
+                        , n_tup_hot_upd
+                        , vacuum_count
+                        , autovacuum_count
+                        , run_id)
+                    VALUES %s
+                    ON CONFLICT (oid) DO UPDATE SET relkind = EXCLUDED.relkind
+                        , relfilenode = EXCLUDED.relfilenode
+                        , n_tup_upd = EXCLUDED.n_tup_upd
+                        , n_tup_del = EXCLUDED.n_tup_del
+                        , n_tup_hot_upd = EXCLUDED.n_tup_hot_upd
+                        , vacuum_count = EXCLUDED.vacuum_count
+                        , autovacuum_count = EXCLUDED.autovacuum_count
+                        , scan_timestamp = CURRENT_TIMESTAMP
+                        , run_id = EXCLUDED.run_id """
+            psycopg2.extras.execute_values(cur, sql, self.state_rows, page_size=1000)
+            self.state_rows.clear()
+        cur.close()
+
+
+    def commit(self):
+        start_time = time.time()
+        self.flush()
+        self.conn.commit()
+        if args.debug:
+            print("Batch committed. Bytes scanned since last commit: " + str(self.bytes_scanned) + ", seconds since last commit: " + str(round(time.time() - self.last_commit, 2)))
+        self.bytes_scanned = 0
+        self.last_commit = time.time()
+        self.write_seconds += self.last_commit - start_time
+        return self.last_commit - start_time
+## end class StatsWriter
+
+
+def set_scan_timeouts(scan_conn):
+    """
+    Set the --lock_timeout & --statement_timeout of the connection objects are read with. Session level so they apply
+    to every analyze & scan. Committed right away since a rollback would revert them.
+    """
+    cur = scan_conn.cursor()
+    if args.lock_timeout != None:
+        cur.execute("SET lock_timeout = %s", [args.lock_timeout])
+    if args.statement_timeout != None:
+        cur.execute("SET statement_timeout = %s", [args.statement_timeout])
+    scan_conn.commit()
+    cur.close()
+
+
+def reset_scan_timeouts(scan_conn):
+    """
+    Reset the timeouts set by set_scan_timeouts() so they do not apply to later use of the connection (ex. the report
+    & history queries of --daemon or a program using this module). Anything left uncommitted by a failed scan is rolled
+    back first, since an aborted transaction would refuse the reset.
+    """
+    if args.lock_timeout == None and args.statement_timeout == None:
+        return
+    scan_conn.rollback()
+    cur = scan_conn.cursor()
+    cur.execute("RESET lock_timeout")
+    cur.execute("RESET statement_timeout")
+    scan_conn.commit()
+    cur.close()
+
+
+def scan_objects(conn, object_queue, run_state):
+    """
+    Scan loop run by each worker. Takes objects from the shared queue until it is empty
+    (or the --time_budget is used up) and writes their statistics in batches using the given connection.
+    With --scan_connection, the objects are read over a connection of its own to that server.
+    """
+    scan_conn = conn
+    if args.scan_connection != None:
+        scan_conn = open_worker_conn(run_state['dbname'], scan=True)
+    try:
+        cur = scan_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        # vacuum runs on the primary, so its progress is checked there
+        stats_cur = conn.cursor()
+        writer = StatsWriter(conn, run_state['run_id'])
+        set_scan_timeouts(scan_conn)
+
+        vacuum_oids = set()
+        vacuum_checked = 0
+        while not run_state['stop_event'].is_set():
+            if run_state['deadline'] != None and time.time() >= run_state['deadline']:
                 if args.debug:
-                    print(cur.mogrify(sql, [quoted_table]))
-                cur.execute(sql)
-                analyzed_tables.append(quoted_table)
-        # end noanalyze check
-
-        sql = """ SELECT c.relpages FROM pg_catalog.pg_class c 
-                    JOIN pg_catalog.pg_namespace n ON c.relnamespace = n.oid 
-                    WHERE n.nspname = %s
-                    AND c.relname = %s """
-        cur.execute(sql, [o['nspname'], o['relname']])
-        relpages = int(cur.fetchone()[0])
-
-        if args.quick and (o['relkind'] == "r" or o['relkind'] == "m"):
-            # pgstattuple_approx() does not work against toast tables
-            approximate = True
-            sql = "SELECT table_len, approx_tuple_count AS tuple_count, approx_tuple_len AS tuple_len, approx_tuple_percent AS tuple_percent, dead_tuple_count,  "
-            sql += "dead_tuple_len, dead_tuple_percent, approx_free_space AS free_space, approx_free_percent AS free_percent FROM "
-        else:
-            approximate = False
-            sql = "SELECT table_len, tuple_count, tuple_len, tuple_percent, dead_tuple_count, dead_tuple_len, dead_tuple_percent, free_space, free_percent FROM "
-        if args.pgstattuple_schema != None:
-            sql += " \"" + args.pgstattuple_schema + "\"."
-        if args.quick and (o['relkind'] == "r" or o['relkind'] == "m"):
-            sql += "pgstattuple_approx(%s::regclass) "
-            if args.tablename == None:
-                sql += " WHERE table_len > %s"
-                sql += " AND ( (dead_tuple_len + approx_free_space) > %s OR (dead_tuple_percent + approx_free_percent) > %s )"
-        else:
-            sql += "pgstattuple(%s::regclass) "
-            if args.tablename == None:
-                sql += " WHERE table_len > %s"
-                sql += " AND ( (dead_tuple_len + free_space) > %s OR (dead_tuple_percent + free_percent) > %s )"
+                    print("Time budget reached. Stopping scan worker.")
+                break
+            try:
+                o = object_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if run_state['check_vacuum'] and o.get('estimate') == None:
+                # refreshed every few seconds rather than checked for every object
+                if time.time() - vacuum_checked >= 5:
+                    # oids are only unique within a database, so vacuums of other databases are left out
+                    stats_cur.execute("""SELECT relid FROM pg_catalog.pg_stat_progress_vacuum
+                                         WHERE datid = (SELECT oid FROM pg_catalog.pg_database WHERE datname = current_database())""")
+                    vacuum_oids = set( r[0] for r in stats_cur.fetchall() )
+                    vacuum_checked = time.time()
+                # a vacuum of a table also vacuums its toast table, whose parent is the toast table itself
+                if o['parent_oid'] in vacuum_oids or o['oid'] in vacuum_oids or o.get('toast_owner_oid') in vacuum_oids:
+                    defer_object(o, "vacuum in progress", run_state)
+                    continue
 
+            try:
+                bytes_scanned = scan_object(cur, writer, o, run_state)
+                writer.add_scan_state(o, bytes_scanned)
+                with run_state['counts_lock']:
+                    run_state['objects_scanned'] += 1
+                    run_state['bytes_scanned'] += bytes_scanned
+            except (psycopg2.errors.LockNotAvailable, psycopg2.errors.QueryCanceled, psycopg2.errors.SerializationFailure) as e:
+                if scan_conn is not conn and scan_conn.closed:
+                    # a hot standby ends the whole session for some conflicts with recovery, so reconnect and carry on
+                    release_worker_conn(scan_conn, run_state['dbname'], scan=True)
+                    scan_conn = open_worker_conn(run_state['dbname'], scan=True)
+                    cur = scan_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                    set_scan_timeouts(scan_conn)
+                else:
+                    # buffered statistics are only sent on commit, so this just ends the failed analyze or scan
+                    scan_conn.rollback()
+                if isinstance(e, psycopg2.errors.LockNotAvailable):
+                    defer_object(o, "lock timeout", run_state)
+                elif isinstance(e, psycopg2.errors.SerializationFailure):
+                    # canceled on a hot standby because of a conflict with the WAL being replayed (ex. vacuum cleanup on the primary)
+                    defer_object(o, "conflict with recovery", run_state)
+                else:
+                    defer_object(o, "statement timeout", run_state)
+            except Exception:
+                # tell all other workers to stop taking new objects
+                run_state['stop_event'].set()
+                raise
+        writer.commit()
+        with run_state['counts_lock']:
+            run_state['write_seconds'] += writer.write_seconds
+        cur.close()
+        stats_cur.close()
+        conn.commit()
+    finally:
+        # also when a scan error ends the loop, since the connection may be used again
+        if not scan_conn.closed:
+            reset_scan_timeouts(scan_conn)
+        if scan_conn is not conn:
+            release_worker_conn(scan_conn, run_state['dbname'], scan=True)
+## end scan_objects()
+
+
+def get_fillfactor(o):
+    if o['relkind'] == "i": 
+        fillfactor = 90.0
+    else:
+        fillfactor = 100.0
+
+    if o['reloptions'] != None:
+        reloptions_dict = dict(o.split('=') for o in o['reloptions'])
+        if 'fillfactor' in reloptions_dict:
+            fillfactor = float(reloptions_dict['fillfactor'])
+    return fillfactor
+
+
+def analyze_object(cur, o, run_state):
+    # parent table comes from the catalog snapshot. For tables it is the object itself.
+    quoted_table = "\"" + o['parent_nspname'] + "\".\"" + o['parent_relname'] + "\""
+
+    # claim the table under the lock so two workers never analyze the same table
+    with run_state['analyze_lock']:
+        already_analyzed = quoted_table in run_state['analyzed_tables']
+        run_state['analyzed_tables'].add(quoted_table)
+    if already_analyzed:
+        if args.debug:
+            print("Table already analyzed. Skipping...")
+    elif check_analyze_needed(o) == False:
+        if args.debug:
+            print("Table statistics are current. Skipping analyze of " + quoted_table)
+        with analyze_counts_lock:
+            analyze_counts['skipped'] += 1
+    else:
+        # object may have been dropped since the catalog snapshot was taken, so only analyze it if it still exists
+        sql = """DO $$
+                 BEGIN
+                    IF EXISTS (SELECT 1 FROM pg_catalog.pg_class WHERE oid = %s) THEN
+                        EXECUTE 'ANALYZE ' || %s;
+                    END IF;
+                 END $$"""
+        if args.debug:
+            print(cur.mogrify(sql, [o['parent_oid'], quoted_table]))
+        cur.execute(sql, [o['parent_oid'], quoted_table])
+        with analyze_counts_lock:
+            analyze_counts['analyzed'] += 1
+## end analyze_object()
+
+
+def check_wasted_filter():
+    """
+    Whether objects whose wasted space is below the -z & -p thresholds are left out when they are scanned, so they are
+    never stored. With --history every scanned object is stored instead so that trends can be calculated before an
+    object crosses the thresholds. The report applies the thresholds either way.
+    """
+    return args.history == False
+
+
+def run_pgstattuple(cur, o):
+    """
+    Returns the pgstattuple() (or pgstattuple_approx() for --quick) results for the given object
+    along with whether they are approximate and the name of the method used.
+    """
+    # relpages is calculated from the actual size of the object so the fillfactor math does not depend on an analyze.
+    # The EXISTS condition skips the scan entirely if the object was dropped since the catalog snapshot was taken.
+    if args.quick and (o['relkind'] == "r" or o['relkind'] == "m"):
+        # pgstattuple_approx() does not work against toast tables
+        approximate = True
+        sql = "SELECT table_len, approx_tuple_count AS tuple_count, approx_tuple_len AS tuple_len, approx_tuple_percent AS tuple_percent, dead_tuple_count,  "
+        sql += "dead_tuple_len, dead_tuple_percent, approx_free_space AS free_space, approx_free_percent AS free_percent"
+    else:
+        approximate = False
+        sql = "SELECT table_len, tuple_count, tuple_len, tuple_percent, dead_tuple_count, dead_tuple_len, dead_tuple_percent, free_space, free_percent"
+    sql += ", table_len / current_setting('block_size')::int AS relpages FROM "
+    if args.pgstattuple_schema != None:
+        sql += " \"" + args.pgstattuple_schema + "\"."
+    if args.quick and (o['relkind'] == "r" or o['relkind'] == "m"):
+        sql += "pgstattuple_approx(%(oid)s::regclass) "
+        sql += " WHERE EXISTS (SELECT 1 FROM pg_catalog.pg_class WHERE oid = %(oid)s)"
         if args.tablename == None:
+            sql += " AND table_len > %(min_size)s"
+            if check_wasted_filter():
+                sql += " AND ( (dead_tuple_len + approx_free_space) > %(min_wasted_size)s OR (dead_tuple_percent + approx_free_percent) > %(min_wasted_percentage)s )"
+    else:
+        sql += "pgstattuple(%(oid)s::regclass) "
+        sql += " WHERE EXISTS (SELECT 1 FROM pg_catalog.pg_class WHERE oid = %(oid)s)"
+        if args.tablename == None:
+            sql += " AND table_len > %(min_size)s"
+            if check_wasted_filter():
+                sql += " AND ( (dead_tuple_len + free_space) > %(min_wasted_size)s OR (dead_tuple_percent + free_percent) > %(min_wasted_percentage)s )"
+
+    sql_params = { 'oid': o['oid']
+                 , 'min_size': convert_to_bytes(args.min_size)
+                 , 'min_wasted_size': convert_to_bytes(args.min_wasted_size)
+                 , 'min_wasted_percentage': args.min_wasted_percentage }
+    if args.debug:
+        print("sql: " + str(cur.mogrify(sql, sql_params)) )
+    cur.execute(sql, sql_params)
+
+    stats = cur.fetchall()
+    if approximate:
+        method = "pgstattuple_approx"
+    else:
+        method = "pgstattuple"
+    return stats, approximate, method
+## end run_pgstattuple()
+
+
+def run_pgstatindex(cur, o):
+    """
+    Returns the pgstatindex() results for the given btree index in the same form as run_pgstattuple().
+    Free space is the unused space on leaf pages plus all empty & deleted pages. pgstatindex() does not
+    count tuples, so the row estimate from pg_class is used for the tuple count and no dead tuples are reported.
+    """
+    sql = """SELECT index_size AS table_len
+                , (SELECT GREATEST(c.reltuples, 0)::bigint FROM pg_catalog.pg_class c WHERE c.oid = %(oid)s) AS tuple_count
+                , leaf_used * 100 / index_size AS tuple_percent
+                , 0 AS dead_tuple_count
+                , 0 AS dead_tuple_len
+                , 0.0 AS dead_tuple_percent
+                , free_space
+                , free_space * 100 / index_size AS free_percent
+                , index_size / current_setting('block_size')::int AS relpages
+                , avg_leaf_density
+                , leaf_fragmentation
+                , leaf_pages
+                , internal_pages
+                , empty_pages
+                , deleted_pages
+             FROM (
+                SELECT s.*
+                    , s.leaf_pages * current_setting('block_size')::int * COALESCE(NULLIF(s.avg_leaf_density, 'NaN'), 0) / 100 AS leaf_used
+                    , s.leaf_pages * current_setting('block_size')::int * (100 - COALESCE(NULLIF(s.avg_leaf_density, 'NaN'), 100)) / 100
+                        + (s.empty_pages + s.deleted_pages) * current_setting('block_size')::int AS free_space
+                FROM """
+    if args.pgstattuple_schema != None:
+        sql += " \"" + args.pgstattuple_schema + "\"."
+    sql += """pgstatindex(%(oid)s::regclass) s
+                WHERE EXISTS (SELECT 1 FROM pg_catalog.pg_class WHERE oid = %(oid)s) ) x
+             WHERE index_size > 0"""
+    if args.tablename == None:
+        sql += " AND index_size > %(min_size)s"
+        if check_wasted_filter():
+            sql += " AND ( free_space > %(min_wasted_size)s OR free_space * 100 / index_size > %(min_wasted_percentage)s )"
+
+    sql_params = { 'oid': o['oid']
+                 , 'min_size': convert_to_bytes(args.min_size)
+                 , 'min_wasted_size': convert_to_bytes(args.min_wasted_size)
+                 , 'min_wasted_percentage': args.min_wasted_percentage }
+    if args.debug:
+        print("sql: " + str(cur.mogrify(sql, sql_params)) )
+    cur.execute(sql, sql_params)
+
+    stats = cur.fetchall()
+    return stats, False, "pgstatindex"
+## end run_pgstatindex()
+
+
+def run_fsm_estimate(cur, o, freespacemap_schema):
+    """
+    Returns free space for the given table read from its free space map with pg_freespacemap, in the same
+    form as run_pgstattuple(). Used space is split between live & dead tuples based on the catalog statistics.
+    Those statistics are the ones taken from the --connection server with the catalog snapshot, since a hot standby
+    used by --scan_connection does not maintain them.
+    """
+    sql = """SELECT table_len
+                , tuple_count
+                , tuple_len
+                , CASE WHEN table_len > 0 THEN tuple_len * 100.0 / table_len ELSE 0 END AS tuple_percent
+                , dead_tuple_count
+                , used_len - tuple_len AS dead_tuple_len
+                , CASE WHEN table_len > 0 THEN (used_len - tuple_len) * 100.0 / table_len ELSE 0 END AS dead_tuple_percent
+                , free_space
+                , CASE WHEN table_len > 0 THEN free_space * 100.0 / table_len ELSE 0 END AS free_percent
+                , relpages
+             FROM (
+                SELECT table_len
+                    , tuple_count
+                    , dead_tuple_count
+                    , free_space
+                    , relpages
+                    , GREATEST(table_len - free_space, 0) AS used_len
+                    , CASE WHEN tuple_count + dead_tuple_count > 0
+                        THEN (GREATEST(table_len - free_space, 0) * tuple_count / (tuple_count + dead_tuple_count))::bigint
+                        ELSE GREATEST(table_len - free_space, 0)
+                      END AS tuple_len
+                FROM (
+                    SELECT pg_catalog.pg_relation_size(c.oid) AS table_len
+                        , GREATEST(%(reltuples)s::float8, 0)::bigint AS tuple_count
+                        , %(n_dead_tup)s::bigint AS dead_tuple_count
+                        , pg_catalog.pg_relation_size(c.oid) / current_setting('block_size')::int AS relpages
+                        , (SELECT COALESCE(sum(f.avail), 0) FROM """
+    if freespacemap_schema != None:
+        sql += " \"" + freespacemap_schema + "\"."
+    sql += """pg_freespace(%(oid)s::regclass) f
+                            WHERE EXISTS (SELECT 1 FROM pg_catalog.pg_class WHERE oid = %(oid)s) ) AS free_space
+                    FROM pg_catalog.pg_class c
+                    WHERE c.oid = %(oid)s ) x ) y """
+    if args.tablename == None:
+        sql += " WHERE table_len > %(min_size)s"
+        if check_wasted_filter():
+            sql += " AND ( (used_len - tuple_len + free_space) > %(min_wasted_size)s OR (used_len - tuple_len + free_space) * 100.0 / table_len > %(min_wasted_percentage)s )"
+
+    sql_params = { 'oid': o['oid']
+                 , 'reltuples': o['parent_reltuples']
+                 , 'n_dead_tup': o['n_dead_tup']
+                 , 'min_size': convert_to_bytes(args.min_size)
+                 , 'min_wasted_size': convert_to_bytes(args.min_wasted_size)
+                 , 'min_wasted_percentage': args.min_wasted_percentage }
+    if args.debug:
+        print("sql: " + str(cur.mogrify(sql, sql_params)) )
+    cur.execute(sql, sql_params)
+
+    stats = cur.fetchall()
+    return stats, True, "freespacemap"
+## end run_fsm_estimate()
+
+
+def read_sample_blocks(cur, o, blocks, pageinspect_schema):
+    """
+    Returns the live tuple, dead tuple & free space statistics of each of the given heap blocks read with pageinspect.
+    Tuples deleted or updated by a transaction that did not abort are counted as dead.
+    """
+    if pageinspect_schema != None:
+        schema_prefix = "\"" + pageinspect_schema + "\"."
+    else:
+        schema_prefix = ""
+    sql = """SELECT b.blkno
+                , (p.upper - p.lower) AS free_space
+                , COALESCE(i.tuple_count, 0) AS tuple_count
+                , COALESCE(i.tuple_len, 0) AS tuple_len
+                , COALESCE(i.dead_tuple_count, 0) AS dead_tuple_count
+                , COALESCE(i.dead_tuple_len, 0) AS dead_tuple_len
+             FROM unnest(%(blocks)s::int[]) b(blkno)
+             CROSS JOIN LATERAL (SELECT """ + schema_prefix + """get_raw_page(%(oid)s::regclass::text, b.blkno) AS raw) r
+             CROSS JOIN LATERAL """ + schema_prefix + """page_header(r.raw) p
+             LEFT JOIN LATERAL (
+                SELECT count(*) FILTER (WHERE NOT dead) AS tuple_count
+                    , sum(lp_len) FILTER (WHERE NOT dead) AS tuple_len
+                    , count(*) FILTER (WHERE dead) AS dead_tuple_count
+                    , sum(lp_len) FILTER (WHERE dead) AS dead_tuple_len
+                FROM (
+                    SELECT lp_len
+                        , (lp_flags = 3 OR (t_xmax <> '0' AND (t_infomask & 2048) = 0 AND (t_infomask & 128) = 0)) AS dead
+                    FROM """ + schema_prefix + """heap_page_items(r.raw)
+                    WHERE lp_flags IN (1, 3) ) t
+                ) i ON true
+             WHERE EXISTS (SELECT 1 FROM pg_catalog.pg_class WHERE oid = %(oid)s)"""
+    sql_params = { 'oid': o['oid'], 'blocks': blocks }
+    if args.debug:
+        print("sample sql: " + str(cur.mogrify(sql, sql_params)) )
+    cur.execute(sql, sql_params)
+    return cur.fetchall()
+
+
+def run_block_sample(cur, o, block_size, pageinspect_schema):
+    """
+    Returns bloat statistics for a table extrapolated from a random sample of its blocks, in the same form as
+    run_pgstattuple(). Returns None if the table is small enough that scanning all of it is about as cheap.
+    The sample grows until the 95% confidence interval of the wasted space is within --sample_error percent.
+    """
+    cur.execute("SELECT pg_catalog.pg_relation_size(oid) / %s FROM pg_catalog.pg_class WHERE oid = %s", [block_size, o['oid']])
+    result = cur.fetchone()
+    if result == None:
+        # object was dropped since the catalog snapshot was taken
+        return [], True, "sample"
+    total_blocks = int(result[0])
+
+    z = 1.96
+    batch_size = 1000
+    sampled_blocks = set()
+    samples = []
+    target = batch_size
+    while True:
+        if target > total_blocks * 0.5:
+            # once the sample would need to cover most of the table, a full scan is the better choice
             if args.debug:
-                print("sql: " + str(cur.mogrify(sql, [ o['oid']
-                                                    , convert_to_bytes(args.min_size)
-                                                    , convert_to_bytes(args.min_wasted_size)
-                                                    , args.min_wasted_percentage])) )
-            cur.execute(sql, [ o['oid']
-                                , convert_to_bytes(args.min_size)
-                                , convert_to_bytes(args.min_wasted_size)
-                                , args.min_wasted_percentage ])
+                print("Sample of " + str(target) + " blocks needed out of " + str(total_blocks) + ". Scanning " + o['nspname'] + "." + o['relname'] + " in full instead.")
+            return None
+        if target > len(samples):
+            # draw blocks without replacement. The sample never covers more than half the table so retries are cheap
+            new_blocks = []
+            while len(sampled_blocks) < target:
+                b = randrange(total_blocks)
+                if b not in sampled_blocks:
+                    sampled_blocks.add(b)
+                    new_blocks.append(b)
+            for i in range(0, len(new_blocks), batch_size):
+                samples += read_sample_blocks(cur, o, new_blocks[i:i+batch_size], pageinspect_schema)
+            if len(samples) == 0:
+                return [], True, "sample"
+
+        n = len(samples)
+        wasted = [ float(r['dead_tuple_len'] + r['free_space']) for r in samples ]
+        mean = sum(wasted) / n
+        variance = sum( (w - mean) ** 2 for w in wasted ) / max(n - 1, 1)
+        # standard error of the total with finite population correction
+        error_bytes = z * math.sqrt(variance / n) * math.sqrt(max(1 - n / total_blocks, 0)) * total_blocks
+        estimate_bytes = mean * total_blocks
+        if estimate_bytes == 0 or error_bytes <= (args.sample_error / 100) * estimate_bytes:
+            break
+        # sample size needed for the target error, corrected for the finite number of blocks
+        needed = (z * math.sqrt(variance) / ((args.sample_error / 100) * mean)) ** 2
+        needed = math.ceil(needed / (1 + needed / total_blocks))
+        target = max(needed, n + batch_size)
+
+    stats = sum_block_stats(samples, total_blocks, block_size)
+    stats['sample_blocks'] = n
+    stats['wasted_error_bytes'] = int(error_bytes)
+    if args.debug:
+        print("Sampled " + str(n) + " of " + str(total_blocks) + " blocks. Wasted space estimate: " + str(int(estimate_bytes)) + " +/- " + str(int(error_bytes)) + " bytes")
+
+    if check_block_stats_filter(stats) == False:
+        return [], True, "sample"
+    return [ stats ], True, "sample"
+## end run_block_sample()
+
+
+def sum_block_stats(block_rows, total_blocks, block_size):
+    """
+    Returns statistics for a whole table from the per block rows of read_sample_blocks(), scaled up
+    when only some of its blocks were read.
+    """
+    table_len = total_blocks * block_size
+    scale = total_blocks / len(block_rows)
+    stats = {}
+    stats['table_len'] = table_len
+    stats['relpages'] = total_blocks
+    for col in ['tuple_count', 'tuple_len', 'dead_tuple_count', 'dead_tuple_len', 'free_space']:
+        stats[col] = int(sum(r[col] for r in block_rows) * scale)
+    stats['tuple_percent'] = stats['tuple_len'] * 100.0 / table_len
+    stats['dead_tuple_percent'] = stats['dead_tuple_len'] * 100.0 / table_len
+    stats['free_percent'] = stats['free_space'] * 100.0 / table_len
+    return stats
+
+
+def check_block_stats_filter(stats):
+    """
+    Apply the same filters to statistics calculated from blocks that run_pgstattuple() applies in its query.
+    Returns False if the object should not be stored.
+    """
+    if args.tablename != None:
+        return True
+    if stats['table_len'] <= convert_to_bytes(args.min_size):
+        return False
+    if check_wasted_filter() and ( (stats['dead_tuple_len'] + stats['free_space']) <= convert_to_bytes(args.min_wasted_size)
+            and (stats['dead_tuple_percent'] + stats['free_percent']) <= args.min_wasted_percentage ):
+        return False
+    return True
+
+
+def run_chunked_scan(cur, o, block_size, pageinspect_schema, rate_limiter):
+    """
+    Read every block of a table in chunks of --read_chunk_size with pageinspect so that reads of a large
+    table can be paced by --max_read_rate. Returns results in the same form as run_pgstattuple().
+    """
+    cur.execute("SELECT pg_catalog.pg_relation_size(oid) / %s FROM pg_catalog.pg_class WHERE oid = %s", [block_size, o['oid']])
+    result = cur.fetchone()
+    if result == None:
+        # object was dropped since the catalog snapshot was taken
+        return [], True, "pageinspect"
+    total_blocks = int(result[0])
+    chunk_blocks = max(int(convert_to_bytes(args.read_chunk_size) / block_size), 1)
+
+    block_rows = []
+    for start in range(0, total_blocks, chunk_blocks):
+        blocks = list(range(start, min(start + chunk_blocks, total_blocks)))
+        block_rows += read_sample_blocks(cur, o, blocks, pageinspect_schema)
+        rate_limiter.consume(len(blocks) * block_size)
+    if args.debug:
+        print("Read " + str(total_blocks) + " blocks of " + o['nspname'] + "." + o['relname'] + " in chunks of " + str(chunk_blocks) + " blocks")
+    if len(block_rows) == 0:
+        return [], True, "pageinspect"
+
+    stats = sum_block_stats(block_rows, total_blocks, block_size)
+    if check_block_stats_filter(stats) == False:
+        return [], True, "pageinspect"
+    return [ stats ], True, "pageinspect"
+## end run_chunked_scan()
+
+
+def scan_object(cur, writer, o, run_state):
+    """
+    Scan a single object and buffer its statistics row in the given StatsWriter.
+    Returns the number of bytes read from the object so commits can be driven by --commit_size.
+    """
+    block_size = run_state['block_size']
+    if args.debug:
+        print("begining of object list loop: " + str(o))
+
+    fillfactor = get_fillfactor(o)
+
+    scan_started_at = datetime.datetime.now(datetime.timezone.utc)
+    analyze_seconds = 0.0
+    scan_seconds = 0.0
+    bytes_scanned = 0
+    if o.get('estimate') != None:
+        # --triage estimated this object to be well below the report thresholds so it is not scanned
+        stats = [ o['estimate'] ]
+        approximate = True
+        method = "estimate"
+    else:
+        if args.noanalyze != True and run_state['scan_in_recovery'] == False:
+            analyze_start = time.time()
+            analyze_object(cur, o, run_state)
+            analyze_seconds = time.time() - analyze_start
+        scan_start = time.time()
+        sampled = None
+        if args.sample and o['relkind'] != "i" and o['relation_size'] >= convert_to_bytes(args.sample_min_size):
+            sampled = run_block_sample(cur, o, block_size, run_state['pageinspect_schema'])
+        rate_limiter = run_state['rate_limiter']
+        if sampled != None:
+            stats, approximate, method = sampled
+        elif (rate_limiter != None and run_state['pageinspect_schema'] != None and o['relkind'] != "i"
+                and o['relation_size'] > convert_to_bytes(args.read_chunk_size)):
+            stats, approximate, method = run_chunked_scan(cur, o, block_size, run_state['pageinspect_schema'], rate_limiter)
+        elif args.fsm and o['relkind'] != "i" and check_fsm_stale(o) == False:
+            stats, approximate, method = run_fsm_estimate(cur, o, run_state['freespacemap_schema'])
+        elif args.index_method == "pgstatindex" and o['relkind'] == "i" and o['amname'] == "btree":
+            stats, approximate, method = run_pgstatindex(cur, o)
         else:
-            if args.debug:
-                print("sql: " + str(cur.mogrify(sql, [ o['oid'] ])) )
-            cur.execute(sql, [ o['oid'] ])
+            stats, approximate, method = run_pgstattuple(cur, o)
+        if method == "freespacemap":
+            bytes_scanned = o['fsm_size']
+        elif method == "sample":
+            bytes_scanned = stats[0]['sample_blocks'] * block_size if stats else 0
+        else:
+            bytes_scanned = o['relation_size']
+        # pacing for --max_read_rate below is not counted as scan time. Chunked scans include it since they are paced while reading.
+        scan_seconds = time.time() - scan_start
+        if rate_limiter != None and method != "pageinspect":
+            # chunked scans are paced as each chunk is read
+            rate_limiter.consume(bytes_scanned)
+        with run_state['counts_lock']:
+            run_state['analyze_seconds'] += analyze_seconds
+            run_state['scan_seconds'] += scan_seconds
 
-        stats = cur.fetchall()
+    if args.debug:
+        print(stats)
 
-        if args.debug:
-            print(stats)
+    if stats: # completely empty objects will be zero for all stats, so this would be an empty set
 
-        if stats: # completely empty objects will be zero for all stats, so this would be an empty set
+        relpages = int(stats[0]['relpages'])
 
-            # determine byte size of fillfactor pages 
-            ff_relpages_size = (relpages - ( fillfactor/100 * relpages ) ) * block_size
+        # determine byte size of fillfactor pages 
+        ff_relpages_size = (relpages - ( fillfactor/100 * relpages ) ) * block_size
 
-            if exclude_object_list and args.tablename == None:
-                # If object in the exclude list has max values, compare them to see if it should be left out of report
+        if args.tablename == None:
+            # If object in the exclude list has max values, compare them to see if it should be left out of report
+            limits = run_state['exclude_rules'].get_limits(o['nspname'] + "." + o['relname'])
+            if limits != None:
                 wasted_space = stats[0]['dead_tuple_len'] + (stats[0]['free_space'] - ff_relpages_size)
                 wasted_perc = stats[0]['dead_tuple_percent'] + (stats[0]['free_percent'] - (100-fillfactor))
-                for e in exclude_object_list:
-                    if (e['objectname'] == o['nspname'] + "." + o['relname']):
-                        if ( (e['max_wasted'] < wasted_space ) or (e['max_perc'] < wasted_perc ) ):
-                            match_found = False
-                        else:
-                            match_found = True
-                if match_found:
-                    continue
+                if wasted_space <= limits[0] and wasted_perc <= limits[1]:
+                    return bytes_scanned
+
+        if o['relkind'] == "r" or o['relkind'] == "m" or o['relkind'] == "t":
+            stats_table = "bloat_tables"
+            if o['relkind'] == "r":
+                objecttype = "table"
+            elif o['relkind'] == "t":
+                objecttype = "toast_table"
+            else:
+                objecttype = "materialized_view"
+        elif o['relkind'] == "i":
+            stats_table = "bloat_indexes"
+            if o['indisprimary'] == True:
+                objecttype = "index_pk"
+            else:
+                objecttype = "index"
+
+        stats_row = [ o['oid']
+                    , o['nspname']
+                    , o['relname']
+                    , objecttype
+                    , stats[0]['table_len']
+                    , stats[0]['tuple_count']
+                    , stats[0]['tuple_percent']
+                    , stats[0]['dead_tuple_count']
+                    , stats[0]['dead_tuple_len']
+                    , stats[0]['dead_tuple_percent']
+                    , stats[0]['free_space']
+                    , stats[0]['free_percent']
+                    , approximate
+                    , relpages
+                    , fillfactor
+                    , method ]
+        # columns only returned by some methods (pgstatindex, block sampling)
+        for col in ['avg_leaf_density', 'leaf_fragmentation', 'leaf_pages', 'internal_pages', 'empty_pages', 'deleted_pages', 'sample_blocks', 'wasted_error_bytes']:
+            stats_row.append(stats[0].get(col))
+        # Rows are written in batches, so the write time of a row is the time spent writing & committing
+        # the buffered batch when this object's row was added, if one was due. Usually zero.
+        write_seconds = writer.commit_if_due()
+        stats_row += [ scan_started_at, analyze_seconds, scan_seconds, write_seconds, bytes_scanned ]
+        if args.debug:
+            print("buffered " + stats_table + " row: " + str(stats_row))
+        writer.add_stats(stats_table, stats_row, o.get('toast_owner_name'))
+
+    return bytes_scanned
+## end scan_object()
+
+
+def trend_report(cur):
+    """
+    Build the --trend report from the bloat_history table. Growth rates are the least squares slope of
+    wasted space over the last --trend_days days for each object, which only reads the partitions in that window.
+    """
+    sql = """SELECT schemaname
+                , objectname
+                , objecttype
+                , count(*) AS samples
+                , regr_slope(wasted_bytes, extract(epoch FROM stats_timestamp) / 86400) AS wasted_bytes_per_day
+                , regr_slope(wasted_percent, extract(epoch FROM stats_timestamp) / 86400) AS wasted_percent_per_day
+                , (array_agg(wasted_bytes ORDER BY stats_timestamp DESC))[1] AS wasted_bytes
+                , (array_agg(wasted_percent ORDER BY stats_timestamp DESC))[1] AS wasted_percent
+                , (array_agg(size_bytes ORDER BY stats_timestamp DESC))[1] AS size_bytes
+                , max(stats_timestamp) AS last_timestamp
+                , pg_size_pretty(regr_slope(wasted_bytes, extract(epoch FROM stats_timestamp) / 86400)::bigint) AS wasted_size_per_day
+                , pg_size_pretty((array_agg(wasted_bytes ORDER BY stats_timestamp DESC))[1]) AS wasted_size
+             FROM """ + bloat_table_name("bloat_history") + """
+             WHERE stats_timestamp >= CURRENT_TIMESTAMP - %(trend_days)s * interval '1 day' """
+    if args.mode == "tables":
+        sql += " AND objecttype IN ('table', 'toast_table', 'materialized_view') "
+    elif args.mode == "indexes":
+        sql += " AND objecttype IN ('index', 'index_pk') "
+    sql += """ GROUP BY schemaname, objectname, objecttype
+               HAVING count(DISTINCT stats_timestamp) > 1
+               ORDER BY wasted_bytes_per_day DESC NULLS LAST, schemaname, objectname"""
+    if args.debug:
+        print("trend sql: " + str(cur.mogrify(sql, {'trend_days': args.trend_days})))
+    cur.execute(sql, {'trend_days': args.trend_days})
+    result = cur.fetchall()
 
-            sql = "INSERT INTO "
-            if args.bloat_schema != None:
-                sql += args.bloat_schema + "."
+    min_wasted_size = convert_to_bytes(args.min_wasted_size)
+    result_list = []
+    counter = 1
+    for r in result:
+        # an object is reported once it exceeds both thresholds, so it crosses them when the slower of the two is reached
+        days_until = 0.0
+        for current, per_day, threshold in [ (r['wasted_bytes'], r['wasted_bytes_per_day'], min_wasted_size)
+                                           , (r['wasted_percent'], r['wasted_percent_per_day'], args.min_wasted_percentage) ]:
+            if current > threshold:
+                continue
+            if per_day == None or per_day <= 0:
+                days_until = None
+                break
+            days_until = max(days_until, (threshold - current) / per_day)
+
+        if args.format == "simple":
+            type_label = { 'table': 't', 'toast_table': 't', 'index': 'i', 'index_pk': 'p', 'materialized_view': 'mv' }.get(r['objecttype'], r['objecttype'])
+            if days_until == None:
+                threshold_text = "not growing toward thresholds"
+            elif days_until == 0:
+                threshold_text = "over thresholds"
+            else:
+                threshold_text = "exceeds thresholds in " + "{:.0f}".format(math.ceil(days_until)) + " days"
+            output_line = (str(counter) + ". " + r['schemaname'] + "." + r['objectname'] + " (" + type_label + ") "
+                           + r['wasted_size_per_day'] + "/day (" + "{:+.2f}".format(r['wasted_percent_per_day']) + "%/day), "
+                           + r['wasted_size'] + " (" + "{:.2f}".format(r['wasted_percent']) + "%) wasted, " + threshold_text)
+            result_list.append(output_line)
+            counter += 1
+        else:
+            result_dict = dict([  ('schemaname', r['schemaname'])
+                                , ('objectname', r['objectname'])
+                                , ('objecttype', r['objecttype'])
+                                , ('samples', int(r['samples']))
+                                , ('size_bytes', int(r['size_bytes']))
+                                , ('wasted_bytes', int(r['wasted_bytes']))
+                                , ('wasted_percent', "{:.2f}".format(r['wasted_percent'])+"%" )
+                                , ('wasted_bytes_per_day', round(r['wasted_bytes_per_day'], 2))
+                                , ('wasted_percent_per_day', "{:.4f}".format(r['wasted_percent_per_day'])+"%" )
+                                , ('days_until_thresholds', None if days_until == None else math.ceil(days_until))
+                                , ('last_timestamp', r['last_timestamp'].isoformat())
+                               ])
+            result_list.append(result_dict)
+
+    if args.format == "json":
+        result_list = json.dumps(result_list)
+    elif args.format == "jsonpretty":
+        result_list = json.dumps(result_list, indent=4, separators=(',',': '))
+    return result_list
+## end trend_report()
+
+
+def check_requirements(conn):
+    """
+    Check that the pgstattuple version supports the chosen options and that the statistics tables exist.
+    Raises BloatCheckError if they do not. The table checks are skipped when --create_stats_table or --store=sqlite is set.
+    """
+    # the statistics tables are written with INSERT ... ON CONFLICT
+    if conn.server_version < 90500:
+        raise BloatCheckError("PostgreSQL 9.5 or greater is required. Found version " + str(conn.server_version))
 
-            if o['relkind'] == "r" or o['relkind'] == "m" or o['relkind'] == "t":
-                sql+= "bloat_tables"
-                if o['relkind'] == "r":
-                    objecttype = "table"
-                elif o['relkind'] == "t":
-                    objecttype = "toast_table"
-                else:
-                    objecttype = "materialized_view"
-            elif o['relkind'] == "i":
-                sql+= "bloat_indexes"
-                if o['indisprimary'] == True:
-                    objecttype = "index_pk"
-                else:
-                    objecttype = "index"
-                
-            sql += """ (oid
-                        , schemaname
-                        , objectname 
-                        , objecttype
-                        , size_bytes
-                        , live_tuple_count
-                        , live_tuple_percent
-                        , dead_tuple_count
-                        , dead_tuple_size_bytes
-                        , dead_tuple_percent
-                        , free_space_bytes
-                        , free_percent
-                        , approximate
-                        , relpages
-                        , fillfactor)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) """
-            if args.debug:
-                print("insert sql: " + str(cur.mogrify(sql, [ o['oid']
-                                                            , o['nspname']
-                                                            , o['relname']
-                                                            , objecttype 
-                                                            , stats[0]['table_len']
-                                                            , stats[0]['tuple_count']
-                                                            , stats[0]['tuple_percent']
-                                                            , stats[0]['dead_tuple_count']
-                                                            , stats[0]['dead_tuple_len']
-                                                            , stats[0]['dead_tuple_percent']
-                                                            , stats[0]['free_space']
-                                                            , stats[0]['free_percent']
-                                                            , approximate
-                                                            , relpages
-                                                            , fillfactor
-                                                        ])) ) 
-            cur.execute(sql, [   o['oid'] 
-                               , o['nspname']
-                               , o['relname']
-                               , objecttype
-                               , stats[0]['table_len']
-                               , stats[0]['tuple_count']
-                               , stats[0]['tuple_percent']
-                               , stats[0]['dead_tuple_count']
-                               , stats[0]['dead_tuple_len']
-                               , stats[0]['dead_tuple_percent']
-                               , stats[0]['free_space']
-                               , stats[0]['free_percent']
-                               , approximate
-                               , relpages
-                               , fillfactor
-                             ]) 
-
-        commit_counter += 1
-        if args.commit_rate > 0 and (commit_counter % args.commit_rate == 0):
-            if args.debug:
-                print("Batch committed. Object scanned count: " + str(commit_counter))
+    pgstattuple_version = float(check_pgstattuple(conn))
+    if args.quick:
+        if pgstattuple_version < 1.3:
+            raise BloatCheckError("--quick option requires pgstattuple version 1.3 or greater (PostgreSQL 9.5)")
+
+    if args.index_method == "pgstatindex":
+        if pgstattuple_version < 1.4:
+            raise BloatCheckError("--index_method=pgstatindex requires pgstattuple version 1.4 or greater (PostgreSQL 9.6)")
+
+    if args.create_stats_table or args.store == "sqlite":
+        return
+
+    cur = conn.cursor()
+    sql = "SELECT tablename FROM pg_catalog.pg_tables WHERE tablename = %s"
+    if args.bloat_schema != None:
+        sql += " AND schemaname = %s"
+        cur.execute(sql, ['bloat_stats', args.bloat_schema])
+    else:
+        cur.execute(sql, ['bloat_stats'])
+    table_exists = cur.fetchone()
+    if table_exists == None:
+        raise BloatCheckError("Required statistics table does not exist. Please run --create_stats_table first before running a bloat scan.")
+
+    if args.history or args.trend:
+        cur.execute("SELECT pg_catalog.to_regclass(%s) IS NOT NULL", [bloat_table_name("bloat_history")])
+        if cur.fetchone()[0] == False:
+            raise BloatCheckError("--history and --trend require the bloat_history table (PostgreSQL 11+). Please run --create_stats_table to create it.")
+
+    cur.execute("SELECT pg_catalog.to_regclass(%s) IS NOT NULL", [bloat_table_name("bloat_runs")])
+    if cur.fetchone()[0] == False:
+        raise BloatCheckError("Required bloat_runs table does not exist. The statistics tables were likely created by an older version of this script. Please run --create_stats_table again.")
+    conn.commit()
+    cur.close()
+## end check_requirements()
+
+
+def print_not_scanned(not_scanned, dbname=None):
+    if not_scanned and (args.quiet <= 1 or args.debug == True):
+        if dbname != None:
+            print("Database " + dbname + ": ", end="", file=sys.stderr)
+        print("Time budget of " + str(args.time_budget) + " seconds was reached before all objects were scanned. The following " + str(len(not_scanned)) + " objects were not scanned:", file=sys.stderr)
+        for o in not_scanned:
+            print("    " + o['nspname'] + "." + o['relname'], file=sys.stderr)
+        print("Statistics of these objects from the previous run are still being reported.", file=sys.stderr)
+
+
+def print_skipped(skipped, dbname=None):
+    if skipped and (args.quiet <= 1 or args.debug == True):
+        if dbname != None:
+            print("Database " + dbname + ": ", end="", file=sys.stderr)
+        print("The following " + str(len(skipped)) + " objects were skipped after being retried. Their statistics from the previous run are still being reported:", file=sys.stderr)
+        for o, reason in skipped:
+            print("    " + o['nspname'] + "." + o['relname'] + " (" + reason + ")", file=sys.stderr)
+
+
+def print_analyze_summary():
+    # nothing is analyzed when objects are read from a hot standby with --scan_connection
+    if args.noanalyze == False and args.noscan == False and analyze_counts['analyzed'] + analyze_counts['skipped'] > 0 and (args.quiet == 0 or args.debug == True):
+        print("Analyzed " + str(analyze_counts['analyzed']) + " tables, skipped " + str(analyze_counts['skipped'])
+              + " analyzes of tables with current statistics", file=sys.stderr)
+
+
+def print_timing_summary(conn, dbname=None):
+    if args.timing == False:
+        return
+    store = get_result_store()
+    if store != None:
+        sql = """SELECT run_id
+                    , finished_at
+                    , COALESCE(finished_at, %s) - started_at AS run_seconds
+                    , catalog_seconds
+                    , analyze_seconds
+                    , scan_seconds
+                    , write_seconds
+                 FROM bloat_runs
+                 WHERE database = %s
+                 ORDER BY run_id DESC LIMIT 1"""
+        runs = store.query(sql, [time.time(), dbname if dbname != None else get_dbname(conn)])
+        run = runs[0] if runs else None
+    else:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        sql = """SELECT run_id
+                    , finished_at
+                    , extract(epoch FROM COALESCE(finished_at, CURRENT_TIMESTAMP) - started_at) AS run_seconds
+                    , catalog_seconds
+                    , analyze_seconds
+                    , scan_seconds
+                    , write_seconds
+                 FROM """ + bloat_table_name("bloat_runs") + """
+                 ORDER BY run_id DESC LIMIT 1"""
+        cur.execute(sql)
+        run = cur.fetchone()
+    if run == None:
+        if store == None:
             conn.commit()
+            cur.close()
+        return
+    sql = """SELECT schemaname
+                , objectname
+                , objecttype
+                , analyze_seconds
+                , scan_seconds
+                , write_seconds
+                , analyze_seconds + scan_seconds + write_seconds AS total_seconds
+                , bytes_read
+             FROM """ + bloat_table_name("bloat_stats") + """
+             WHERE run_id = %s
+             AND scan_started_at IS NOT NULL
+             ORDER BY analyze_seconds + scan_seconds + write_seconds DESC, schemaname, objectname
+             LIMIT 10"""
+    if store != None:
+        # run ids are unique across all databases in the file
+        slowest = store.query(sql, [run['run_id']])
+    else:
+        cur.execute(sql, [run['run_id']])
+        slowest = cur.fetchall()
+        conn.commit()
+        cur.close()
+
+    if dbname != None:
+        print("Database " + dbname + ": ", end="", file=sys.stderr)
+    print("Timing of run " + str(run['run_id']) + ("" if run['finished_at'] != None else " (unfinished)") + ": "
+          + "{:.2f}".format(run['run_seconds']) + " seconds", file=sys.stderr)
+    for phase in ['catalog', 'analyze', 'scan', 'write']:
+        print("    " + phase.ljust(10) + "{:.2f}".format(run[phase + '_seconds']) + " seconds", file=sys.stderr)
+    if slowest:
+        print("  Slowest objects:", file=sys.stderr)
+    for r in slowest:
+        print("    " + r['schemaname'] + "." + r['objectname'] + " (" + r['objecttype'] + "): " + "{:.2f}".format(r['total_seconds']) + " seconds"
+              + " (analyze " + "{:.2f}".format(r['analyze_seconds']) + ", scan " + "{:.2f}".format(r['scan_seconds'])
+              + ", write " + "{:.2f}".format(r['write_seconds']) + "), " + "{:.1f}".format(r['bytes_read'] / 1048576) + " MB read", file=sys.stderr)
+
+
+def print_read_rate():
+    if read_rate_limiter != None and (args.quiet == 0 or args.debug == True):
+        print(read_rate_limiter.summary(), file=sys.stderr)
+
+
+def get_report_rows(conn, dbname=None):
+    """
+    Yields the rows of the bloat report from the statistics tables of the given connection's database,
+    ordered by wasted space. Rows are streamed from a named server side cursor so memory use does not
+    grow with the size of the statistics tables. Toast tables have the name of the table they belong to in real_table.
+    With --store=sqlite the rows are read from the file instead, for the given dbname when there is no connection.
+    """
+    store = get_result_store()
+    if store != None:
+        # the block size of the scanned database is recorded with each run
+        block_size = "r.block_size"
+        wasted_bigint = "CAST(round({}) AS integer)"
+    else:
+        block_size = "current_setting('block_size')::int"
+        wasted_bigint = "{}::bigint"
+    wasted_bytes = "(s.dead_tuple_size_bytes + (s.free_space_bytes - ((s.relpages - (s.fillfactor/100) * s.relpages ) * " + block_size + " ) ))"
+    simple_cols = """s.oid
+                     , s.schemaname
+                     , s.objectname
+                     , s.objecttype
+                     , CASE 
+                        WHEN (s.dead_tuple_percent + (s.free_percent - (100-s.fillfactor))) < 0 THEN 0
+                        ELSE (s.dead_tuple_percent + (s.free_percent - (100-s.fillfactor)))
+                       END AS total_waste_percent
+                     , CASE
+                        WHEN """ + wasted_bytes + """ < 0 THEN '0 bytes'
+                        ELSE pg_size_pretty(""" + wasted_bigint.format(wasted_bytes) + """)
+                       END AS total_wasted_size"""
+    dict_cols = "s.oid, s.schemaname, s.objectname, s.objecttype, s.size_bytes, s.live_tuple_count, s.live_tuple_percent, s.dead_tuple_count, s.dead_tuple_size_bytes, s.dead_tuple_percent, s.free_space_bytes, s.free_percent, s.approximate, s.relpages, s.fillfactor, s.method, s.avg_leaf_density, s.leaf_fragmentation, s.leaf_pages, s.internal_pages, s.empty_pages, s.deleted_pages, s.sample_blocks, s.wasted_error_bytes"
+    if args.format == "dict" or args.format=="json" or args.format=="jsonpretty" or args.format=="ndjson" or args.format=="openmetrics" or args.rebuild_index:
+        # Since "simple" is the default, this check needs to be first so that if args.rebuild_index is set, the proper columns are chosen
+        sql = "SELECT " + dict_cols
+    else:
+        sql = "SELECT " + simple_cols
+    # wasted bytes are used to merge the reports of several databases in order
+    sql += ", " + wasted_bytes + " AS wasted_bytes"
+    sql_params = []
+    if store != None:
+        # tables & indexes share one table in the file. Only statistics from runs that have finished are reported
+        sql += """, s.real_table FROM bloat_stats s
+                    JOIN bloat_runs r ON r.run_id = s.run_id AND r.finished_at IS NOT NULL
+                    WHERE s.database = %s """
+        sql_params.append(dbname if dbname != None else get_dbname(conn))
+        if args.mode == "tables":
+            sql += " AND s.objecttype NOT IN ('index', 'index_pk') "
+        elif args.mode == "indexes" or args.rebuild_index:
+            sql += " AND s.objecttype IN ('index', 'index_pk') "
+    else:
+        # the table a toast table belongs to is looked up in the same query
+        sql += ", tn.nspname||'.'||t.relname AS real_table FROM "
+        if args.mode == "tables":
+            sql += bloat_table_name("bloat_tables")
+        elif args.mode == "indexes" or args.rebuild_index:
+            sql += bloat_table_name("bloat_indexes")
+        else:
+            sql += bloat_table_name("bloat_stats")
+        sql += """ s
+                    LEFT JOIN pg_catalog.pg_class t ON t.reltoastrelid = s.oid AND s.objecttype = 'toast_table'
+                    LEFT JOIN pg_catalog.pg_namespace tn ON tn.oid = t.relnamespace """
+        # only report statistics from runs that have finished
+        sql += " WHERE s.run_id IN (SELECT run_id FROM " + bloat_table_name("bloat_runs") + " WHERE finished_at IS NOT NULL) "
+    sql += " AND " + wasted_bytes + " > %s "
+    sql += " AND (s.dead_tuple_percent + (s.free_percent - (100-s.fillfactor))) > %s "
+    sql += " ORDER BY " + wasted_bytes + " DESC, s.schemaname, s.objectname"
+    sql_params += [convert_to_bytes(args.min_wasted_size), args.min_wasted_percentage]
+
+    if store != None:
+        if args.debug:
+            print("report sql: " + sql + " params: " + str(sql_params))
+        for r in store.stream(sql, sql_params):
+            if 'approximate' in r:
+                r['approximate'] = bool(r['approximate'])
+            yield r
+        return
+
+    cur = conn.cursor(name="pg_bloat_check_report", cursor_factory=psycopg2.extras.DictCursor)
+    cur.itersize = 1000
+    if args.debug:
+        print("report sql: " + str(cur.mogrify(sql, sql_params)))
+    try:
+        cur.execute(sql, sql_params)
+        for r in cur:
+            yield dict(r)
+    finally:
+        cur.close()
+        conn.commit()
+## end get_report_rows()
+
+
+def format_report_row(r, counter):
+    """
+    Format a single report row from get_report_rows() for the chosen --format. Simple format returns the
+    output line, all others return a dictionary. Rows that have a 'database' key (from --all_databases)
+    have the database name included.
+    """
+    if args.format == "simple":
+        if r['objecttype'] == 'table' or r['objecttype'] == 'toast_table':
+            type_label = 't'
+        elif r['objecttype'] == 'index':
+            type_label = 'i'
+        elif r['objecttype'] == 'index_pk':
+            type_label = 'p'
+        elif r['objecttype'] == 'materialized_view':
+            type_label = 'mv'
+        else:
+            raise BloatCheckError("Unexpected object type encountered in stats table. Please report this bug to author with value found: " + str(r['objecttype']))
+
+        object_label = r['schemaname'] + "." + r['objectname']
+        if 'database' in r:
+            object_label = r['database'] + ": " + object_label
+
+        justify_space = 100 - len(str(counter) + ". " + object_label + " (" + type_label + ") " + "(" + "{:.2f}".format(r['total_waste_percent']) + "%)" + r['total_wasted_size'] + " wasted")
+
+        output_line = str(counter) + ". " + object_label + " (" + type_label + ") " + "."*justify_space + "(" + "{:.2f}".format(r['total_waste_percent']) + "%) " + r['total_wasted_size'] + " wasted"
+
+        if r['objecttype'] == 'toast_table':
+            output_line = output_line + "\n      Real table: " + str(r.get('real_table'))
+        return output_line
+
+    result_dict = dict([  ('oid', r['oid'])
+                        , ('schemaname', r['schemaname'])
+                        , ('objectname', r['objectname'])
+                        , ('objecttype', r['objecttype'])
+                        , ('size_bytes', int(r['size_bytes']))
+                        , ('live_tuple_count', int(r['live_tuple_count']))
+                        , ('live_tuple_percent', "{:.2f}".format(r['live_tuple_percent'])+"%" )
+                        , ('dead_tuple_count', int(r['dead_tuple_count']))
+                        , ('dead_tuple_size_bytes', int(r['dead_tuple_size_bytes']))
+                        , ('dead_tuple_percent', "{:.2f}".format(r['dead_tuple_percent'])+"%" )
+                        , ('free_space_bytes', int(r['free_space_bytes']))
+                        , ('free_percent', "{:.2f}".format(r['free_percent'])+"%" )
+                        , ('approximate', r['approximate'])
+                        , ('method', r['method'])
+                       ])
+    if 'database' in r:
+        result_dict = dict([('database', r['database'])] + list(result_dict.items()))
+    if r['method'] == 'pgstatindex':
+        result_dict['avg_leaf_density'] = "{:.2f}".format(r['avg_leaf_density'])+"%"
+        result_dict['leaf_fragmentation'] = "{:.2f}".format(r['leaf_fragmentation'])+"%"
+        result_dict['leaf_pages'] = int(r['leaf_pages'])
+        result_dict['internal_pages'] = int(r['internal_pages'])
+        result_dict['empty_pages'] = int(r['empty_pages'])
+        result_dict['deleted_pages'] = int(r['deleted_pages'])
+    elif r['method'] == 'sample':
+        result_dict['sample_blocks'] = int(r['sample_blocks'])
+        result_dict['wasted_error_bytes'] = int(r['wasted_error_bytes'])
+    return result_dict
+## end format_report_row()
+
+
+def print_report_rows(rows):
+    """
+    Format & output report rows as they are read so the first line is output right away and the whole
+    report is never held in memory. The json, jsonpretty & dict formats output the same document as
+    before, one element at a time. ndjson outputs one json object per line. If there are no rows, json &
+    jsonpretty output an empty array, ndjson outputs nothing and the other formats a message unless -u is set.
+    Returns the number of rows output.
+    """
+    counter = 0
+    for r in rows:
+        counter += 1
+        row = format_report_row(r, counter)
+        if args.format == "simple":
+            print(row)
+        elif args.format == "ndjson":
+            print(json.dumps(row))
+        elif args.format == "json":
+            print(("[" if counter == 1 else ", ") + json.dumps(row), end="")
+        elif args.format == "jsonpretty":
+            element = "\n".join("    " + line for line in json.dumps(row, indent=4, separators=(',',': ')).split("\n"))
+            print(("[\n" if counter == 1 else ",\n") + element, end="")
+        else:
+            print(("[" if counter == 1 else ", ") + repr(row), end="")
+        if counter == 1:
+            sys.stdout.flush()
+    if counter > 0:
+        if args.format == "json" or args.format == "dict":
+            print("]")
+        elif args.format == "jsonpretty":
+            print("\n]")
+    elif args.format == "json" or args.format == "jsonpretty":
+        # consumers of json always get a valid document
+        print("[]")
+    elif args.format != "ndjson" and args.quiet == 0:
+        print("No bloat found for given parameters")
+    return counter
+## end print_report_rows()
+
+
+def get_last_run(conn, dbname=None):
+    """
+    Returns the totals of the most recently finished run of the given connection's database for the
+    --format=openmetrics run metrics, or None if no run has finished yet. With --store=sqlite the run is
+    read from the file instead, for the given dbname when there is no connection.
+    """
+    store = get_result_store()
+    if store != None:
+        sql = """SELECT database
+                    , run_id
+                    , finished_at - started_at AS duration_seconds
+                    , finished_at AS finished_timestamp
+                    , objects_scanned
+                    , bytes_scanned
+                    , objects_skipped
+                 FROM bloat_runs
+                 WHERE database = %s
+                 AND finished_at IS NOT NULL
+                 ORDER BY run_id DESC LIMIT 1"""
+        runs = store.query(sql, [dbname if dbname != None else get_dbname(conn)])
+        return runs[0] if runs else None
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    sql = """SELECT current_database() AS database
+                , run_id
+                , extract(epoch FROM finished_at - started_at) AS duration_seconds
+                , extract(epoch FROM finished_at) AS finished_timestamp
+                , objects_scanned
+                , bytes_scanned
+                , objects_skipped
+             FROM """ + bloat_table_name("bloat_runs") + """
+             WHERE finished_at IS NOT NULL
+             ORDER BY run_id DESC LIMIT 1"""
+    cur.execute(sql)
+    run = cur.fetchone()
     conn.commit()
     cur.close()
-## end get_bloat()            
+    return dict(run) if run != None else None
+
+
+def format_openmetrics(rows, run_list):
+    """
+    Returns the OpenMetrics text exposition lines for the given report rows (from get_report_rows()) and
+    runs (from get_last_run()). Values are the raw numbers from the statistics tables, not formatted strings.
+    """
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    object_metrics = [ ("size_bytes", "Size of the object")
+                     , ("dead_tuple_bytes", "Space used by dead tuples")
+                     , ("free_bytes", "Free space, including space reserved by fillfactor")
+                     , ("wasted_bytes", "Dead tuple & free space not reserved by fillfactor")
+                     , ("wasted_percent", "Wasted space as a percentage of the object size") ]
+    run_metrics = [ ("run_duration_seconds", "Time taken by the last completed run", 'duration_seconds')
+                  , ("run_finished_timestamp_seconds", "Time the last completed run finished", 'finished_timestamp')
+                  , ("run_objects_scanned", "Objects scanned by the last completed run", 'objects_scanned')
+                  , ("run_read_bytes", "Bytes read by the last completed run", 'bytes_scanned')
+                  , ("run_objects_skipped", "Objects skipped by the last completed run after lock or statement timeouts", 'objects_skipped') ]
+
+    samples = dict( (name, []) for name, help_text in object_metrics )
+    for r in rows:
+        labels = ('{database="' + escape(r['database']) + '",schema="' + escape(r['schemaname']) + '",object="' + escape(r['objectname'])
+                  + '",type="' + escape(r['objecttype']) + '"}')
+        wasted_percent = max(r['dead_tuple_percent'] + (r['free_percent'] - (100 - r['fillfactor'])), 0)
+        samples['size_bytes'].append(labels + " " + str(int(r['size_bytes'])))
+        samples['dead_tuple_bytes'].append(labels + " " + str(int(r['dead_tuple_size_bytes'])))
+        samples['free_bytes'].append(labels + " " + str(int(r['free_space_bytes'])))
+        samples['wasted_bytes'].append(labels + " " + str(max(int(r['wasted_bytes']), 0)))
+        samples['wasted_percent'].append(labels + " " + "{:.2f}".format(wasted_percent))
+
+    lines = []
+    for name, help_text in object_metrics:
+        lines.append("# TYPE pg_bloat_check_" + name + " gauge")
+        lines.append("# HELP pg_bloat_check_" + name + " " + help_text + ".")
+        lines += [ "pg_bloat_check_" + name + sample for sample in samples[name] ]
+    for name, help_text, key in run_metrics:
+        lines.append("# TYPE pg_bloat_check_" + name + " gauge")
+        lines.append("# HELP pg_bloat_check_" + name + " " + help_text + ".")
+        for run in run_list:
+            lines.append("pg_bloat_check_" + name + '{database="' + escape(run['database']) + '"} ' + str(run[key]))
+    lines.append("# EOF")
+    return lines
+## end format_openmetrics()
+
+
+def print_openmetrics(lines):
+    """
+    Output OpenMetrics lines to stdout or, with --metrics_file, replace the metrics file with them.
+    """
+    if args.metrics_file == None:
+        for l in lines:
+            print(l)
+        return
+    # write then rename so a collector never reads a partially written file
+    temp_file = args.metrics_file + ".tmp"
+    with open(temp_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_file, args.metrics_file)
+    if args.debug:
+        print("Metrics written to " + args.metrics_file)
+
+
+def get_database_list(conn):
+    """
+    Returns the names of the databases to scan with --all_databases after applying the
+    --include_database & --exclude_database patterns. Without a connection, these are the databases with a
+    finished run in the --store=sqlite file.
+    """
+    if conn == None:
+        database_list = get_result_store().get_database_list()
+    else:
+        cur = conn.cursor()
+        cur.execute("SELECT datname FROM pg_catalog.pg_database WHERE datallowconn AND NOT datistemplate ORDER BY datname")
+        database_list = [ r[0] for r in cur.fetchall() ]
+        conn.commit()
+        cur.close()
+
+    if args.include_database != None:
+        include_patterns = create_list('csv', args.include_database)
+        database_list = [ d for d in database_list if any(fnmatch.fnmatchcase(d, p) for p in include_patterns) ]
+    if args.exclude_database != None:
+        exclude_patterns = create_list('csv', args.exclude_database)
+        database_list = [ d for d in database_list if not any(fnmatch.fnmatchcase(d, p) for p in exclude_patterns) ]
+    return database_list
+
+
+def scan_database(dbname, exclude_schema_list, include_schema_list, exclude_object_list):
+    """
+    Run the bloat scan of a single database for --all_databases and return its report rows,
+    each with the database name added, along with its last completed run for --format=openmetrics.
+    Returns None if the database was skipped.
+    """
+    conn = None
+    if needs_connection():
+        conn = open_worker_conn(dbname)
+    try:
+        try:
+            if conn != None:
+                check_requirements(conn)
+        except BloatCheckError as e:
+            # kept out of stdout so the merged report remains valid json or openmetrics
+            print(str(e), file=sys.stderr)
+            print("Skipping database " + dbname, file=sys.stderr)
+            return None
+
+        if args.create_stats_table:
+            create_stats_table(conn)
+            return [], None
+
+        if args.noscan == False:
+            not_scanned, skipped = get_bloat(conn, exclude_schema_list, include_schema_list, exclude_object_list, dbname)
+            print_not_scanned(not_scanned, dbname)
+            print_skipped(skipped, dbname)
+        print_timing_summary(conn, dbname)
+
+        result = []
+        if args.quiet <= 1 or args.debug == True:
+            # report rows of all databases are merged in order, so they are read in full here
+            for r in get_report_rows(conn, dbname):
+                r['database'] = dbname
+                result.append(r)
+        run = None
+        if args.format == "openmetrics":
+            run = get_last_run(conn, dbname)
+        return result, run
+    finally:
+        if conn != None:
+            release_worker_conn(conn, dbname)
+## end scan_database()
+
+
+def scan_cluster(conn, exclude_schema_list, include_schema_list, exclude_object_list):
+    """
+    Scan all databases chosen by --all_databases, several at a time within the --max_connections limit,
+    and return their merged report rows ordered by wasted space along with the last completed run of each database.
+    """
+    database_list = get_database_list(conn)
+    if args.debug:
+        print("Databases to scan: " + str(database_list))
+
+    connections_per_database = 1
+    if args.jobs > 1:
+        connections_per_database += args.jobs
+    concurrent_databases = max(1, min(args.max_connections // connections_per_database, len(database_list)))
+    if args.debug:
+        print("Scanning " + str(concurrent_databases) + " databases at a time")
+
+    merged_result = []
+    run_list = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrent_databases) as executor:
+        futures = {}
+        for d in database_list:
+            futures[executor.submit(scan_database, d, exclude_schema_list, include_schema_list, exclude_object_list)] = d
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                result = f.result()
+            except (psycopg2.Error, BloatCheckError) as e:
+                print("Error scanning database " + futures[f] + ". Skipping it: " + str(e).strip(), file=sys.stderr)
+                continue
+            if result != None:
+                merged_result += result[0]
+                if result[1] != None:
+                    run_list.append(result[1])
+
+    merged_result.sort(key=lambda r: (-r['wasted_bytes'], r['database'], r['schemaname'], r['objectname']))
+    run_list.sort(key=lambda r: r['database'])
+    return merged_result, run_list
+## end scan_cluster()
 
 
 def print_report(result_list):
     if args.format == "simple":
         for r in result_list:
             print(r)
+    elif args.format == "ndjson":
+        for r in result_list:
+            print(json.dumps(r))
     else:
         print(result_list)
 
@@ -490,77 +2994,141 @@ def print_version():
     print("Version: " + version)
 
 
+def get_rebuild_plan(cur, index_list):
+    """
+    Returns the metadata needed to rebuild every index in index_list (report rows from get_report_rows())
+    fetched with a single query, along with the estimated I/O of each rebuild and the space it would reclaim.
+    Each index is assigned a wave so that no two indexes in the same wave are on the same table.
+    Indexes dropped since they were scanned are left out. Indexes of system catalogs (including their toast tables)
+    and of exclusion constraints, which cannot be rebuilt concurrently, are marked with issystem & isexclusion.
+    """
+    # Building an index concurrently reads the table twice (build & validation) and writes the new index,
+    # which should be about the size of the current index less its wasted space.
+    sql = """SELECT x.oid
+                , n.nspname
+                , c.relname
+                , c.oid AS table_oid
+                , ts.spcname
+                , pg_catalog.pg_get_indexdef(x.oid) AS indexdef
+                , i.indisclustered
+                , EXISTS (SELECT 1 FROM pg_catalog.pg_constraint WHERE conindid = x.oid) AS isconstraint
+                , EXISTS (SELECT 1 FROM pg_catalog.pg_constraint WHERE conindid = x.oid AND contype = 'x') AS isexclusion
+                , n.nspname = 'pg_catalog' OR EXISTS (SELECT 1 FROM pg_catalog.pg_class o
+                        JOIN pg_catalog.pg_namespace onsp ON onsp.oid = o.relnamespace
+                        WHERE o.reltoastrelid = c.oid AND onsp.nspname = 'pg_catalog') AS issystem
+                , pg_catalog.pg_size_pretty(2 * pg_catalog.pg_relation_size(c.oid)
+                    + GREATEST(pg_catalog.pg_relation_size(x.oid) - x.reclaimable, 0)) AS build_io
+                , pg_catalog.pg_size_pretty(x.reclaimable) AS reclaimable
+                , 2 * pg_catalog.pg_relation_size(c.oid) + GREATEST(pg_catalog.pg_relation_size(x.oid) - x.reclaimable, 0) AS build_io_bytes
+                , x.reclaimable AS reclaimable_bytes
+            FROM unnest(%s::oid[], %s::bigint[]) AS x(oid, reclaimable)
+            JOIN pg_catalog.pg_index i ON i.indexrelid = x.oid
+            JOIN pg_catalog.pg_class ic ON ic.oid = x.oid
+            JOIN pg_catalog.pg_class c ON c.oid = i.indrelid
+            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+            LEFT OUTER JOIN pg_catalog.pg_tablespace ts ON ts.oid = ic.reltablespace"""
+    oids = [ i['oid'] for i in index_list ]
+    reclaimable = [ max(int(i['wasted_bytes']), 0) for i in index_list ]
+    if args.debug:
+        print("rebuild plan sql: " + str(cur.mogrify(sql, [oids, reclaimable])))
+    cur.execute(sql, [oids, reclaimable])
+    metadata = dict( (r['oid'], r) for r in cur.fetchall() )
+
+    plan = []
+    table_counts = {}
+    for i in index_list:
+        m = metadata.get(i['oid'])
+        if m == None:
+            continue
+        # the nth index on a table goes into the nth wave, keeping the largest rebuilds in the first waves
+        table_counts[m['table_oid']] = table_counts.get(m['table_oid'], 0) + 1
+        p = dict(m)
+        p['schemaname'] = i['schemaname']
+        p['objectname'] = i['objectname']
+        p['objecttype'] = i['objecttype']
+        p['wave'] = table_counts[m['table_oid']]
+        plan.append(p)
+    return plan
+## end get_rebuild_plan()
+
+
 def rebuild_index(conn, index_list):
 
     if index_list == []:
         print("Bloat statistics table contains no indexes for conditions given.")
-        close_conn(conn)
-        sys.exit(0)
-    
-    for i in index_list:
-        temp_index_name = "pgbloatcheck_rebuild_" + str(randint(1000,9999))
-        quoted_index = "\"" + i['schemaname'] + "\".\"" + i['objectname'] + "\""
-        # get table index is in
-        sql = """SELECT n.nspname, c.relname, t.spcname
-                    FROM pg_catalog.pg_class c 
-                    JOIN pg_catalog.pg_index i ON c.oid = i.indrelid 
-                    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace 
-                    LEFT OUTER JOIN pg_catalog.pg_tablespace t ON c.reltablespace = t.oid
-                    WHERE indexrelid = %s"""
-        cur.execute(sql, [ i['oid'] ] )
-        result = cur.fetchone()
-        quoted_table = "\"" + result[0] + "\".\"" + result[1] + "\""
-        if result[2] != None:
-            quoted_tablespace = "\"" + result[2] + "\""
-        else:
-            quoted_tablespace = None
-        # create temp index definition
-        sql = "SELECT pg_get_indexdef(%s::regclass)"
-        cur.execute(sql, [ "\"" + i['schemaname'] +"\".\""+ i['objectname'] + "\"" ])
-        index_def = cur.fetchone()[0]
-        index_def = re.sub(r' INDEX', ' INDEX CONCURRENTLY', index_def, 1)
-        index_def = index_def.replace(i['objectname'], temp_index_name, 1)
-        if quoted_tablespace != None:
-            index_def += " TABLESPACE " + quoted_tablespace
-        index_def += ";"
-        # check if index is clustered
-        sql = "SELECT indisclustered FROM pg_catalog.pg_index WHERE indexrelid = %s"
-        cur.execute(sql, [ i['oid'] ])
-        indisclustered = cur.fetchone()[0]
-        # start output
+        return
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    plan = get_rebuild_plan(cur, index_list)
+    conn.commit()
+    cur.close()
+    wave_count = max([ p['wave'] for p in plan ] + [0])
+    print("-- Rebuild plan for " + str(len(plan)) + " indexes in " + str(wave_count) + " waves. Indexes within a wave are all on different tables,")
+    print("-- so the commands of a wave can be run in parallel. Each wave should be finished before the next one is started.")
+
+    for wave in range(1, wave_count + 1):
+        wave_plan = [ p for p in plan if p['wave'] == wave ]
+        wave_io = sum(p['build_io_bytes'] for p in wave_plan)
+        wave_reclaimable = sum(p['reclaimable_bytes'] for p in wave_plan)
         print("")
-        print(index_def)
-        if indisclustered == True:
-            print("ALTER TABLE " + quoted_table + " CLUSTER ON " + temp_index_name) + ";"
-        # analyze table
-        print("ANALYZE " + quoted_table + ";")
-        if i['objecttype'] == "index":
-            # drop old index or unique constraint
-            sql = "SELECT count(*) FROM pg_catalog.pg_constraint WHERE conindid = %s"
-            cur.execute(sql, [ i['oid'] ])
-            isconstraint = int(cur.fetchone()[0])
-            if isconstraint == 1:
-                print("ALTER TABLE " + quoted_table + " DROP CONSTRAINT " + "\"" + i['objectname'] + "\";")
-            else:
-                print("DROP INDEX CONCURRENTLY " + quoted_index + ";")
-            # analyze again
-            print("ANALYZE " + quoted_table + ";")
-            # rename temp index to original name
-            print("ALTER INDEX \"" + i['schemaname'] + "\"." + temp_index_name + " RENAME TO \"" + i['objectname'] + "\";")
-        elif i['objecttype'] == "index_pk":
-            print("ALTER TABLE " + quoted_table + " DROP CONSTRAINT " + "\"" + i['objectname'] + "\";")
-            # analyze again
-            print("ANALYZE " + quoted_table + ";")
-            print("ALTER TABLE " + quoted_table + " ADD CONSTRAINT " + i['objectname'] + " PRIMARY KEY USING INDEX " + temp_index_name + ";")
-            # analyze again
-            print("ANALYZE " + quoted_table + ";")
-        if indisclustered == True:
+        print("-- Wave " + str(wave) + ": " + str(len(wave_plan)) + " indexes, estimated build I/O " + "{:.1f}".format(wave_io / 1048576)
+              + " MB, reclaimable " + "{:.1f}".format(wave_reclaimable / 1048576) + " MB")
+        for i in wave_plan:
+            quoted_index = "\"" + i['schemaname'] + "\".\"" + i['objectname'] + "\""
+            quoted_table = "\"" + i['nspname'] + "\".\"" + i['relname'] + "\""
             print("")
-            print("-- WARNING: The following statement will exclusively lock the table for the duration of its runtime.")
-            print("--   Uncomment it or manually run it to recluster the table on the newly created index.")
-            print("-- CLUSTER " + quoted_table + ";")
+            print("-- " + quoted_index + " on " + quoted_table + ": estimated build I/O " + i['build_io'] + ", reclaimable " + i['reclaimable'])
+            if i['issystem'] or i['isexclusion']:
+                # neither REINDEX CONCURRENTLY nor CREATE INDEX CONCURRENTLY can be used, so only a blocking REINDEX is left
+                if i['issystem']:
+                    reason = "is on a system catalog"
+                else:
+                    reason = "backs an exclusion constraint"
+                print("-- WARNING: This index " + reason + " so it cannot be rebuilt concurrently. The following statement blocks writes to the table")
+                print("--   and reads using the index for the duration of its runtime. Uncomment it or manually run it to rebuild the index.")
+                print("-- REINDEX INDEX " + quoted_index + ";")
+                continue
+            if conn.server_version >= 120000:
+                # REINDEX CONCURRENTLY keeps the name, tablespace, constraints & cluster setting of the index
+                print("REINDEX INDEX CONCURRENTLY " + quoted_index + ";")
+                continue
 
-        print("")
+            temp_index_name = "pgbloatcheck_rebuild_" + str(randint(1000,9999))
+            # create temp index definition
+            index_def = re.sub(r' INDEX', ' INDEX CONCURRENTLY', i['indexdef'], 1)
+            index_def = index_def.replace(i['objectname'], temp_index_name, 1)
+            if i['spcname'] != None:
+                index_def += " TABLESPACE \"" + i['spcname'] + "\""
+            index_def += ";"
+            print(index_def)
+            if i['indisclustered'] == True:
+                print("ALTER TABLE " + quoted_table + " CLUSTER ON " + temp_index_name + ";")
+            # analyze table
+            print("ANALYZE " + quoted_table + ";")
+            if i['objecttype'] == "index":
+                # drop old index or unique constraint
+                if i['isconstraint'] == True:
+                    print("ALTER TABLE " + quoted_table + " DROP CONSTRAINT " + "\"" + i['objectname'] + "\";")
+                else:
+                    print("DROP INDEX CONCURRENTLY " + quoted_index + ";")
+                # analyze again
+                print("ANALYZE " + quoted_table + ";")
+                # rename temp index to original name
+                print("ALTER INDEX \"" + i['schemaname'] + "\"." + temp_index_name + " RENAME TO \"" + i['objectname'] + "\";")
+            elif i['objecttype'] == "index_pk":
+                print("ALTER TABLE " + quoted_table + " DROP CONSTRAINT " + "\"" + i['objectname'] + "\";")
+                # analyze again
+                print("ANALYZE " + quoted_table + ";")
+                print("ALTER TABLE " + quoted_table + " ADD CONSTRAINT " + i['objectname'] + " PRIMARY KEY USING INDEX " + temp_index_name + ";")
+                # analyze again
+                print("ANALYZE " + quoted_table + ";")
+            if i['indisclustered'] == True:
+                print("")
+                print("-- WARNING: The following statement will exclusively lock the table for the duration of its runtime.")
+                print("--   Uncomment it or manually run it to recluster the table on the newly created index.")
+                print("-- CLUSTER " + quoted_table + ";")
+
+    print("")
 # end rebuild_index
 
 def convert_to_bytes(val):
@@ -628,57 +3196,106 @@ def convert_to_bytes(val):
 # end convert_to_bytes
 
 
-if __name__ == "__main__":
-    if args.version:
-        print_version()
-        sys.exit(0)
 
-    if args.schema != None and args.exclude_schema != None:
-        print("--schema and --exclude_schema are exclusive options and cannot be set together")
-        sys.exit(2)
 
-    if args.debug:
-        print("quiet level: " + str(args.quiet))
-
-    conn = create_conn()
-
-    if args.recovery_mode_norun == True:
-        is_in_recovery = check_recovery_status(conn)
-        if is_in_recovery == True:
-            if args.debug:
-                print("Recovery mode check found instance in recovery. Skipping run.")
-            close_conn(conn)
-            sys.exit(0)
-        else:
-            if args.debug:
-                print("Recovery mode check found primary instance. Running as normal.")
-
-    pgstattuple_version = float(check_pgstattuple(conn))
-    if args.quick:
-        if pgstattuple_version < 1.3:
-            print("--quick option requires pgstattuple version 1.3 or greater (PostgreSQL 9.5)")
-            close_conn(conn)
-            sys.exit(2)
-
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-    if args.create_stats_table:
-        create_stats_table(conn)
-        close_conn(conn)
-        sys.exit(0)
-
-    sql = "SELECT tablename FROM pg_catalog.pg_tables WHERE tablename = %s"
-    if args.bloat_schema != None:
-        sql += " AND schemaname = %s"
-        cur.execute(sql, ['bloat_stats', args.bloat_schema])
+def check_options(options):
+    """
+    Check the given options for combinations that are not allowed. Raises ValueError with the reason if one is found.
+    Also applies options implied by others, so it modifies the options given.
+    """
+    if options.schema != None and options.exclude_schema != None:
+        raise ValueError("--schema and --exclude_schema are exclusive options and cannot be set together")
+
+    if options.jobs < 1:
+        raise ValueError("--jobs must be set to 1 or greater")
+
+    if options.all_databases:
+        if options.rebuild_index or options.trend:
+            raise ValueError("--all_databases cannot be used with --rebuild_index or --trend")
+        if options.max_connections < 1 + (options.jobs if options.jobs > 1 else 0):
+            raise ValueError("--max_connections must allow at least one connection per database plus one per --jobs worker")
+
+    if options.daemon:
+        if options.create_stats_table or options.rebuild_index:
+            raise ValueError("--daemon cannot be used with --create_stats_table or --rebuild_index")
+        if options.interval < 0:
+            raise ValueError("--interval must be set to 0 or greater")
+
+    if options.metrics_file != None:
+        options.format = "openmetrics"
+
+    if options.commit_rate == 0:
+        # -r 0 committed only once all objects were scanned
+        options.commit_interval = 0
+        options.commit_size = 0
+
+    if options.format == "openmetrics" and options.trend:
+        raise ValueError("--trend cannot be output in the openmetrics format")
+
+    if options.max_read_rate != None and options.max_read_rate <= 0:
+        raise ValueError("--max_read_rate must be greater than zero")
+
+    if options.store == "sqlite":
+        if options.store_file == None:
+            raise ValueError("--store=sqlite requires the path of the SQLite file to be given with --store_file")
+        if options.history or options.trend:
+            raise ValueError("--history and --trend are not available with --store=sqlite")
+## end check_options()
+
+
+def configure(argv=None, **options):
+    """
+    Set the options used by this module when it is imported instead of run as a script. Options can be given
+    as a list of command line arguments, as keyword arguments named after the long option names
+    (ex. connection="dbname=mydb", jobs=4), or both. Keyword values given as strings are converted like the
+    command line values (ex. jobs="4"). Options not given keep their defaults.
+    Raises ValueError for invalid or unknown options or combinations that are not allowed, and BloatCheckError if
+    the installed psycopg2 is too old. The options apply to the whole module, so only one configuration can be in use
+    at a time. configure() waits for a scan() or run_once() running in another thread to finish so its options are
+    not changed under it. Returns the options set.
+    """
+    global args
+    check_psycopg2()
+    new_args = parser.parse_options(argv if argv != None else [])
+    option_actions = { a.dest: a for a in parser._actions }
+    for name, value in options.items():
+        if not hasattr(new_args, name):
+            raise ValueError("Unknown option: " + name)
+        action = option_actions[name]
+        if isinstance(value, str) and action.type != None:
+            try:
+                value = action.type(value)
+            except (TypeError, ValueError, argparse.ArgumentTypeError):
+                raise ValueError("Invalid value for option " + name + ": " + value)
+        if action.choices != None and value not in action.choices:
+            raise ValueError("Invalid value for option " + name + ": " + str(value) + " (choose from " + ", ".join(str(c) for c in action.choices) + ")")
+        setattr(new_args, name, value)
+    check_options(new_args)
+    with run_lock:
+        args = new_args
+    return args
+
+
+def reset_run_state():
+    """
+    Reset the read rate limiter & analyze counts shared by all scans of one run, so that a process
+    running several scans (--daemon or when used as a module) reports each run on its own.
+    """
+    global read_rate_limiter
+    if args.max_read_rate != None:
+        read_rate_limiter = ReadRateLimiter(args.max_read_rate * 1048576)
     else:
-        cur.execute(sql, ['bloat_stats'])
-    table_exists = cur.fetchone()
-    if table_exists == None:
-        print("Required statistics table does not exist. Please run --create_stats_table first before running a bloat scan.")
-        close_conn(conn)
-        sys.exit(2)
+        read_rate_limiter = None
+    with analyze_counts_lock:
+        analyze_counts['analyzed'] = 0
+        analyze_counts['skipped'] = 0
 
+
+def get_filter_lists():
+    """
+    Returns the schemas to exclude, the schemas to include & the objects to exclude set by the
+    --exclude_schema, --schema & --exclude_object_file options.
+    """
     if args.exclude_schema != None:
         exclude_schema_list = create_list('csv', args.exclude_schema)
     else:
@@ -696,115 +3313,217 @@ if __name__ == "__main__":
     else:
         exclude_object_list = []
 
-    if args.noscan == False and args.rebuild_index == False:
-        get_bloat(conn, tuple(exclude_schema_list), tuple(include_schema_list), exclude_object_list)
-
-    # Final commit to ensure transaction that inserted stats data closes
-    conn.commit()
+    return tuple(exclude_schema_list), tuple(include_schema_list), exclude_object_list
+
+
+def scan(conn=None):
+    """
+    Scan the database of the given connection with the options set by configure() and record the results in
+    the statistics tables. A new connection is opened & closed if none is given; a given connection is left open
+    so it can be reused. Returns the objects not scanned before --time_budget ran out and the objects skipped after
+    being retried, as get_bloat() does. Use get_report_rows() to read the report afterwards.
+    """
+    with run_lock:
+        own_conn = conn == None
+        if own_conn:
+            conn = create_conn()
+        try:
+            check_requirements(conn)
+            reset_run_state()
+            exclude_schema_list, include_schema_list, exclude_object_list = get_filter_lists()
+            return get_bloat(conn, exclude_schema_list, include_schema_list, exclude_object_list)
+        finally:
+            if own_conn and not conn.closed:
+                close_conn(conn)
+
+
+def run_once(conn):
+    """
+    Do everything a single run of this script does with the given connection: scan, then output the report,
+    trend or rebuild commands. Used for every run of --daemon. Raises BloatCheckError if the database does not
+    meet the requirements of the chosen options. The connection is left open. The connection is None when
+    only a report is read from --store=sqlite (see needs_connection()).
+    """
+    with run_lock:
+        reset_run_state()
+
+        if args.recovery_mode_norun == True:
+            is_in_recovery = check_recovery_status(conn)
+            conn.commit()
+            if is_in_recovery == True:
+                if args.debug:
+                    print("Recovery mode check found instance in recovery. Skipping run.")
+                return
+            else:
+                if args.debug:
+                    print("Recovery mode check found primary instance. Running as normal.")
+
+        exclude_schema_list, include_schema_list, exclude_object_list = get_filter_lists()
+
+        if args.all_databases:
+            result, run_list = scan_cluster(conn, exclude_schema_list, include_schema_list, exclude_object_list)
+            print_analyze_summary()
+            print_read_rate()
+            if args.create_stats_table:
+                return
+            if args.format == "openmetrics":
+                if args.metrics_file != None or args.quiet <= 1 or args.debug == True:
+                    print_openmetrics(format_openmetrics(result, run_list))
+            elif args.quiet <= 1 or args.debug == True:
+                print_report_rows(result)
+            return
+
+        if conn != None:
+            check_requirements(conn)
+
+        if args.create_stats_table:
+            create_stats_table(conn)
+            return
+
+        if args.noscan == False and args.rebuild_index == False:
+            not_scanned, skipped = get_bloat(conn, exclude_schema_list, include_schema_list, exclude_object_list)
+            print_not_scanned(not_scanned)
+            print_skipped(skipped)
+            print_analyze_summary()
+            print_read_rate()
+        if args.rebuild_index == False:
+            print_timing_summary(conn)
+
+        # Final commit to ensure transaction that inserted stats data closes
+        if conn != None:
+            conn.commit()
 
-    counter = 1
-    result_list = []
-    if args.quiet <= 1 or args.debug == True:
-        simple_cols = """oid
-                         , schemaname
-                         , objectname
-                         , objecttype
-                         , CASE 
-                            WHEN (dead_tuple_percent + (free_percent - (100-fillfactor))) < 0 THEN 0
-                            ELSE (dead_tuple_percent + (free_percent - (100-fillfactor)))
-                           END AS total_waste_percent
-                         , CASE
-                            WHEN (dead_tuple_size_bytes + (free_space_bytes - (relpages - (fillfactor/100) * relpages ) * current_setting('block_size')::int ) ) < 0 THEN '0 bytes'
-                            ELSE pg_size_pretty((dead_tuple_size_bytes + (free_space_bytes - ((relpages - (fillfactor/100) * relpages ) * current_setting('block_size')::int ) ) )::bigint)
-                           END AS total_wasted_size"""
-        dict_cols = "oid, schemaname, objectname, objecttype, size_bytes, live_tuple_count, live_tuple_percent, dead_tuple_count, dead_tuple_size_bytes, dead_tuple_percent, free_space_bytes, free_percent, approximate, relpages, fillfactor"
-        if args.format == "dict" or args.format=="json" or args.format=="jsonpretty" or args.rebuild_index:
-            # Since "simple" is the default, this check needs to be first so that if args.rebuild_index is set, the proper columns are chosen
-            sql = "SELECT " + dict_cols + " FROM "
-        elif args.format == "simple":
-            sql = "SELECT " + simple_cols + " FROM "
-        else:
-            print("Unsupported --format given. Use 'simple', 'dict' 'json', or 'jsonpretty'.")
+        if args.trend:
+            if args.quiet <= 1 or args.debug == True:
+                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                result_list = trend_report(cur)
+                conn.commit()
+                cur.close()
+                if len(result_list) >= 1:
+                    print_report(result_list)
+                elif args.quiet == 0:
+                    print("Not enough history found to calculate trends. At least two runs recorded with --history are required.")
+            return
+
+        if args.format == "openmetrics" and args.rebuild_index == False:
+            if args.metrics_file != None or args.quiet <= 1 or args.debug == True:
+                dbname = get_dbname(conn)
+                run = get_last_run(conn)
+                rows = ( dict(r, database=dbname) for r in get_report_rows(conn) )
+                print_openmetrics(format_openmetrics(rows, [run] if run != None else []))
+        elif args.quiet <= 1 or args.debug == True:
+            # Output rebuild commands instead of status report
+            if args.rebuild_index:
+                rebuild_index(conn, list(get_report_rows(conn)))
+                return
+
+            print_report_rows(get_report_rows(conn))
+## end run_once()
+
+
+def run_daemon(run_requested=None, stop_requested=None):
+    """
+    Keep running for --daemon, doing a run every --interval seconds and whenever run_requested is set.
+    The connection to the database and the connections of scan workers are kept open between runs and
+    reopened after a connection error. Returns once stop_requested is set, after the current run finishes.
+    When called from the main thread, SIGUSR1 requests a run and SIGTERM & SIGINT request a stop.
+    A BloatCheckError or database error fails only the current run.
+    """
+    global worker_conn_pool
+    if run_requested == None:
+        run_requested = threading.Event()
+    if stop_requested == None:
+        stop_requested = threading.Event()
+
+    if threading.current_thread() is threading.main_thread():
+        def request_stop(signum, frame):
+            stop_requested.set()
+            run_requested.set()
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        # not available on Windows
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: run_requested.set())
+
+    worker_conn_pool = ConnectionPool()
+    conn = None
+    try:
+        while not stop_requested.is_set():
+            run_requested.clear()
+            if args.debug:
+                print("Starting daemon run at " + str(datetime.datetime.now()))
+            try:
+                if needs_connection() and (conn == None or conn.closed):
+                    conn = create_conn()
+                run_once(conn)
+            except BloatCheckError as e:
+                print(str(e), file=sys.stderr)
+                if conn != None:
+                    conn.rollback()
+            except psycopg2.Error as e:
+                print("Run failed with a database error. Connections will be reopened for the next run: " + str(e).strip(), file=sys.stderr)
+                if conn != None and not conn.closed:
+                    close_conn(conn)
+                conn = None
+                worker_conn_pool.close_all()
+            sys.stdout.flush()
+
+            if args.interval > 0:
+                run_requested.wait(args.interval)
+            else:
+                run_requested.wait()
+    finally:
+        if conn != None and not conn.closed:
             close_conn(conn)
-            sys.exit(2)
-        if args.bloat_schema != None:
-            sql += args.bloat_schema + "."
-        if args.mode == "tables":
-            sql += "bloat_tables"
-        elif args.mode == "indexes" or args.rebuild_index:
-            sql += "bloat_indexes"
-        else:
-            sql += "bloat_stats"
-        sql += " WHERE (dead_tuple_size_bytes + (free_space_bytes - (relpages - (fillfactor/100) * relpages ) * current_setting('block_size')::int ) ) > %s "
-        sql += " AND (dead_tuple_percent + (free_percent - (100-fillfactor))) > %s "
-        sql += " ORDER BY (dead_tuple_size_bytes + (free_space_bytes - ((relpages - (fillfactor/100) * relpages ) * current_setting('block_size')::int ) )) DESC"
-        cur.execute(sql, [convert_to_bytes(args.min_wasted_size), args.min_wasted_percentage])
-        result = cur.fetchall()
-
-        # Output rebuild commands instead of status report
-        if args.rebuild_index:
-            rebuild_index(conn, result)
+        worker_conn_pool.close_all()
+        worker_conn_pool = None
+        close_result_store()
+## end run_daemon()
+
+
+def main(argv=None):
+    """
+    Run this script with the given command line arguments (sys.argv by default). Returns the exit code.
+    """
+    global args
+    args = parser.parse_args(argv)
+
+    if args.version:
+        print_version()
+        return 0
+
+    try:
+        check_psycopg2()
+        check_options(args)
+    except (ValueError, BloatCheckError) as e:
+        print(str(e))
+        return 2
+
+    if args.debug:
+        print("quiet level: " + str(args.quiet))
+
+    if args.commit_rate != None and (args.quiet <= 1 or args.debug == True):
+        print("--commit_rate (-r) is deprecated and will be removed in a future version. Commits are driven by --commit_interval and --commit_size instead."
+              + (" -r 0 sets both to 0 to commit once all objects are scanned." if args.commit_rate == 0 else " This setting has no effect."), file=sys.stderr)
+
+    if args.daemon:
+        run_daemon()
+        return 0
+
+    conn = None
+    try:
+        if needs_connection():
+            conn = create_conn()
+        run_once(conn)
+    except BloatCheckError as e:
+        print(str(e))
+        return 2
+    finally:
+        if conn != None and not conn.closed:
             close_conn(conn)
-            sys.exit(0)
-
-        for r in result:
-            if args.format == "simple":
-                if r['objecttype'] == 'table' or r['objecttype'] == 'toast_table':
-                    type_label = 't'
-                elif r['objecttype'] == 'index':
-                    type_label = 'i'
-                elif r['objecttype'] == 'index_pk':
-                    type_label = 'p'
-                elif r['objecttype'] == 'materialized_view':
-                    type_label = 'mv'
-                else:
-                    print("Unexpected object type encountered in stats table. Please report this bug to author with value found: " + str(r['objecttype']))
-                    sys.exit(2)
-
-                justify_space = 100 - len(str(counter) + ". " + r['schemaname'] + "." + r['objectname'] + " (" + type_label + ") " + "(" + "{:.2f}".format(r['total_waste_percent']) + "%)" + r['total_wasted_size'] + " wasted")
-
-                output_line = str(counter) + ". " + r['schemaname'] + "." + r['objectname'] + " (" + type_label + ") " + "."*justify_space + "(" + "{:.2f}".format(r['total_waste_percent']) + "%) " + r['total_wasted_size'] + " wasted"
-
-                if r['objecttype'] == 'toast_table':
-                    toast_real_sql = """ SELECT n.nspname||'.'||c.relname 
-                                         FROM pg_catalog.pg_class c
-                                         JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
-                                         WHERE reltoastrelid = %s """
-                    if args.debug:
-                        print( "toast_real_sql: " + str(cur.mogrify(toast_real_sql, [r['oid']]) ) )
-                    cur.execute(toast_real_sql, [r['oid']])
-                    real_table = cur.fetchone()[0]
-                    output_line = output_line + "\n      Real table: " + str(real_table)
-
-                result_list.append(output_line)
-                counter += 1
-
-            elif args.format == "dict" or args.format == "json" or args.format == "jsonpretty":
-                result_dict = dict([  ('oid', r['oid'])
-                                    , ('schemaname', r['schemaname'])
-                                    , ('objectname', r['objectname'])
-                                    , ('objecttype', r['objecttype'])
-                                    , ('size_bytes', int(r['size_bytes']))
-                                    , ('live_tuple_count', int(r['live_tuple_count']))
-                                    , ('live_tuple_percent', "{:.2f}".format(r['live_tuple_percent'])+"%" )
-                                    , ('dead_tuple_count', int(r['dead_tuple_count']))
-                                    , ('dead_tuple_size_bytes', int(r['dead_tuple_size_bytes']))
-                                    , ('dead_tuple_percent', "{:.2f}".format(r['dead_tuple_percent'])+"%" )
-                                    , ('free_space_bytes', int(r['free_space_bytes']))
-                                    , ('free_percent', "{:.2f}".format(r['free_percent'])+"%" )
-                                    , ('approximate', r['approximate'])
-                                   ])
-                result_list.append(result_dict)
-
-        if args.format == "json":
-            result_list = json.dumps(result_list)
-        elif args.format == "jsonpretty":
-            result_list = json.dumps(result_list, indent=4, separators=(',',': '))
-    
-        if len(result_list) >= 1:
-            print_report(result_list)
-        else:
-            if args.quiet == 0:
-                print("No bloat found for given parameters")
+        close_result_store()
+    return 0
 
-    close_conn(conn)
+
+if __name__ == "__main__":
+    sys.exit(main())
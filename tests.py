@@ -42,3 +42,468 @@ test_convert_to_bytes("-1","-1")
 test_convert_to_bytes("1 KB",1)
 
 ### End of convert_to_bytes() test ###
+
+
+### This section tests the print_report_rows() output of each --format ###
+
+import contextlib, io, json
+import pg_bloat_check
+
+def report_row(oid, objectname):
+    return { 'oid': oid, 'schemaname': 'public', 'objectname': objectname, 'objecttype': 'table', 'size_bytes': 81920
+           , 'live_tuple_count': 100, 'live_tuple_percent': 50.0, 'dead_tuple_count': 10, 'dead_tuple_size_bytes': 1000
+           , 'dead_tuple_percent': 1.22, 'free_space_bytes': 40000, 'free_percent': 48.83, 'approximate': False, 'method': 'pgstattuple' }
+
+def test_print_report_rows(output_format, rows, expected_output):
+    pg_bloat_check.configure(format=output_format)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        pg_bloat_check.print_report_rows(rows)
+    if output.getvalue() != expected_output:
+        print("Test failed for --format={} with {} rows -- Expected {!r} but got {!r}".format(output_format, len(rows), expected_output, output.getvalue()))
+
+# the whole document must be the same as dumping the list of rows at once
+pg_bloat_check.configure(format="json")
+report_dicts = [ pg_bloat_check.format_report_row(r, 1) for r in [report_row(1, "a"), report_row(2, "b")] ]
+test_print_report_rows("json", [report_row(1, "a"), report_row(2, "b")], json.dumps(report_dicts) + "\n")
+test_print_report_rows("jsonpretty", [report_row(1, "a"), report_row(2, "b")], json.dumps(report_dicts, indent=4, separators=(',',': ')) + "\n")
+test_print_report_rows("ndjson", [report_row(1, "a"), report_row(2, "b")], "".join(json.dumps(d) + "\n" for d in report_dicts))
+
+# empty reports are still valid documents for json consumers
+test_print_report_rows("json", [], "[]\n")
+test_print_report_rows("jsonpretty", [], "[]\n")
+test_print_report_rows("ndjson", [], "")
+test_print_report_rows("simple", [], "No bloat found for given parameters\n")
+
+pg_bloat_check.configure()
+
+### End of print_report_rows() test ###
+
+### This section tests the options set by configure() ###
+
+def test_configure(expected_error, argv=None, **options):
+    try:
+        pg_bloat_check.configure(argv, **options)
+    except ValueError as e:
+        if expected_error == None:
+            print("Test failed for configure({!r}, {!r}) -- Unexpected error: {}".format(argv, options, e))
+        return
+    except SystemExit:
+        print("Test failed for configure({!r}, {!r}) -- Exited instead of raising ValueError".format(argv, options))
+        return
+    if expected_error != None:
+        print("Test failed for configure({!r}, {!r}) -- Expected ValueError".format(argv, options))
+
+test_configure(None, ["--jobs", "4"])
+test_configure(None, jobs="4")
+if pg_bloat_check.args.jobs != 4:
+    print("Test failed for configure(jobs=\"4\") -- Expected 4 but got {!r}".format(pg_bloat_check.args.jobs))
+test_configure(ValueError, ["--no_such_option"])
+test_configure(ValueError, ["--jobs", "four"])
+test_configure(ValueError, jobs="four")
+test_configure(ValueError, format="xml")
+test_configure(ValueError, no_such_option=1)
+
+pg_bloat_check.configure(format="simple")
+try:
+    pg_bloat_check.format_report_row(dict(report_row(1, "a"), objecttype="sequence"), 1)
+    print("Test failed for format_report_row() with unknown object type -- Expected BloatCheckError")
+except pg_bloat_check.BloatCheckError:
+    pass
+
+pg_bloat_check.configure()
+
+### End of configure() test ###
+
+### This section tests the --exclude_object_file entries ###
+
+import os, tempfile
+
+def test_value(description, return_val, expected_val):
+    if return_val != expected_val:
+        print("Test failed for {} -- Expected {!r} but got {!r}".format(description, expected_val, return_val))
+
+# glob_to_like() keeps characters special to LIKE as literals
+test_value("glob_to_like('public.events_2024_*')", pg_bloat_check.glob_to_like("public.events_2024_*"), "public.events\\_2024\\_%")
+test_value("glob_to_like('public.t?')", pg_bloat_check.glob_to_like("public.t?"), "public.t_")
+test_value("glob_to_like('public.100%')", pg_bloat_check.glob_to_like("public.100%"), "public.100\\%")
+test_value("glob_to_like('public.a\\\\b')", pg_bloat_check.glob_to_like("public.a\\b"), "public.a\\\\b")
+
+# regular expressions containing commas are read from a double quoted entry
+exclude_file = tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False)
+exclude_file.write('# comment\n')
+exclude_file.write('public.orders\n')
+exclude_file.write('public.logs_*\n')
+exclude_file.write('public.t[12]\n')
+exclude_file.write('"re:public\\.audit_p\\d{4,6}"\n')
+exclude_file.write('public.events,1000,10\n')
+exclude_file.write('public.events*,2000,20\n')
+exclude_file.write('public.even*,3000,30\n')
+exclude_file.write('re:public\\.ev.*,4000,40\n')
+exclude_file.close()
+exclude_object_list = pg_bloat_check.create_list('file', exclude_file.name)
+os.remove(exclude_file.name)
+test_value("create_list() of a quoted regular expression", exclude_object_list[3], { 'objectname': 're:public\\.audit_p\\d{4,6}', 'max_wasted': 0, 'max_perc': 0 })
+test_value("create_list() entry count", len(exclude_object_list), 8)
+
+rules = pg_bloat_check.ExcludeRules(exclude_object_list)
+# exact names & wildcard patterns without [seq] are left to the SQL filters
+test_value("full_names", rules.full_names, {"public.orders"})
+test_value("full_like_patterns", rules.full_like_patterns, ["public.logs\\_%"])
+test_value("is_excluded('public.orders')", rules.is_excluded("public.orders"), False)
+test_value("is_excluded('public.logs_1')", rules.is_excluded("public.logs_1"), False)
+test_value("is_excluded('public.t1')", rules.is_excluded("public.t1"), True)
+test_value("is_excluded('public.t3')", rules.is_excluded("public.t3"), False)
+test_value("is_excluded('public.audit_p20240')", rules.is_excluded("public.audit_p20240"), True)
+test_value("is_excluded('public.audit_p202')", rules.is_excluded("public.audit_p202"), False)
+# an exact name is used before any pattern, then the first matching pattern of the file
+test_value("get_limits('public.events')", rules.get_limits("public.events"), (1000, 10.0))
+test_value("get_limits('public.events_1')", rules.get_limits("public.events_1"), (2000, 20.0))
+test_value("get_limits('public.event')", rules.get_limits("public.event"), (3000, 30.0))
+test_value("get_limits('public.evx')", rules.get_limits("public.evx"), (4000, 40.0))
+test_value("get_limits('public.other')", rules.get_limits("public.other"), None)
+
+### End of --exclude_object_file test ###
+
+### This section tests the --store=sqlite results file without a database ###
+
+def stats_row(oid, objectname, objecttype, dead_tuple_size_bytes):
+    # 10 pages of 8kB with no free space, so the dead tuples are all of the wasted space
+    return [ oid, 'public', objectname, objecttype, 81920, 100, 50.0, 10, dead_tuple_size_bytes, dead_tuple_size_bytes * 100.0 / 81920
+           , 0, 0.0, False, 10, 100.0, 'pgstattuple', None, None, None, None, None, None, None, None, None, 0.0, 0.0, 0.0, 81920 ]
+
+def scan_state(oid, relkind):
+    return { 'oid': oid, 'relkind': relkind, 'relfilenode': oid, 'n_tup_upd': 0, 'n_tup_del': 0, 'n_tup_hot_upd': 0, 'vacuum_count': 0, 'autovacuum_count': 0 }
+
+def write_run(store, rows, carried_oids, snapshot_oids, finish=True):
+    run_id = store.new_run("storetest", "both", 8192)
+    writer = pg_bloat_check.StatsWriter(None, run_id)
+    for table, row, real_table, relkind in rows:
+        writer.add_stats(table, row, real_table)
+        writer.add_scan_state(scan_state(row[0], relkind), row[4])
+    writer.flush()
+    if finish:
+        store.finish_run("storetest", run_id, carried_oids, snapshot_oids)
+
+def report_via_noscan(output_format):
+    pg_bloat_check.configure(connection="dbname=storetest", store="sqlite", store_file=store_file, noscan=True, format=output_format)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        pg_bloat_check.run_once(None)
+    return output.getvalue()
+
+store_dir = tempfile.TemporaryDirectory()
+store_file = os.path.join(store_dir.name, "bloat.db")
+pg_bloat_check.configure(connection="dbname=storetest", store="sqlite", store_file=store_file)
+store = pg_bloat_check.get_result_store()
+
+write_run(store, [ ('bloat_tables', stats_row(10, 'big', 'table', 40960), None, 'r')
+                 , ('bloat_tables', stats_row(11, 'pg_toast_10', 'toast_table', 20480), 'public.big', 't')
+                 , ('bloat_indexes', stats_row(12, 'big_pkey', 'index_pk', 10240), None, 'i') ], [], [10, 11, 12])
+report = json.loads(report_via_noscan("json"))
+test_value("first run report", [ (r['oid'], r['objectname'], r['dead_tuple_size_bytes']) for r in report ], [ (10, 'big', 40960), (11, 'pg_toast_10', 20480), (12, 'big_pkey', 10240) ])
+test_value("first run toast table", report_via_noscan("simple").splitlines()[2], "      Real table: public.big")
+
+# the second run scans only the table. The toast table is carried over & the dropped index removed
+write_run(store, [ ('bloat_tables', stats_row(10, 'big', 'table', 8192), None, 'r') ], [11], [10, 11])
+report = json.loads(report_via_noscan("json"))
+test_value("second run report", [ (r['oid'], r['objectname'], r['dead_tuple_size_bytes']) for r in report ], [ (11, 'pg_toast_10', 20480), (10, 'big', 8192) ])
+test_value("second run toast table", [ r['real_table'] for r in pg_bloat_check.get_report_rows(None, "storetest") ], ['public.big', None])
+test_value("second run state", [ r['oid'] for r in store.query("SELECT oid FROM bloat_scan_state ORDER BY oid") ], [10, 11])
+
+# an unfinished run is not reported & is removed by the next one
+write_run(store, [ ('bloat_tables', stats_row(10, 'big', 'table', 81920), None, 'r') ], [], [10, 11], finish=False)
+test_value("unfinished run report", [ r['dead_tuple_size_bytes'] for r in json.loads(report_via_noscan("json")) ], [20480, 8192])
+store.new_run("storetest", "both", 8192)
+test_value("unfinished run removed", store.query("SELECT count(*) AS c FROM bloat_stats WHERE dead_tuple_size_bytes = 81920"), [{ 'c': 0 }])
+
+pg_bloat_check.close_result_store()
+store_dir.cleanup()
+pg_bloat_check.configure()
+
+# the same output as pg_size_pretty() of PostgreSQL at each unit boundary
+for size, expected in [ (0, "0 bytes"), (10239, "10239 bytes"), (10240, "10 kB"), (-10240, "-10 kB"), (10485247, "10239 kB")
+                      , (10485248, "10 MB"), (10736893951, "10239 MB"), (10736893952, "10 GB"), (10994847842304, "10 TB")
+                      , (11258524190326784, "10 PB"), (None, None) ]:
+    test_value("pg_size_pretty({})".format(size), pg_bloat_check.pg_size_pretty(size), expected)
+
+### End of --store=sqlite test ###
+
+### This section tests the run of a --time_budget scan that ran out of time ###
+
+class StoreCursor:
+    """
+    Stands in for the cursor of get_bloat(), which is only used for its connection with --store=sqlite.
+    """
+    connection = None
+
+def budget_objects():
+    return [ { 'oid': oid, 'relation_size': 81920 * oid } for oid in [10, 11, 12, 13] ]
+
+store_dir = tempfile.TemporaryDirectory()
+store_file = os.path.join(store_dir.name, "bloat.db")
+pg_bloat_check.configure(connection="dbname=storetest", store="sqlite", store_file=store_file, time_budget=60, format="json")
+store = pg_bloat_check.get_result_store()
+cur = StoreCursor()
+
+write_run(store, [ ('bloat_tables', stats_row(10, 'big', 'table', 40960), None, 'r')
+                 , ('bloat_tables', stats_row(11, 'pg_toast_10', 'toast_table', 20480), 'public.big', 't')
+                 , ('bloat_indexes', stats_row(12, 'big_pkey', 'index_pk', 10240), None, 'i') ], [], [10, 11, 12])
+test_value("first budgeted run order", [ o['oid'] for o in pg_bloat_check.order_by_scan_priority(cur, budget_objects(), 8192) ], [10, 11, 12, 13])
+
+# only the first object is scanned before the budget runs out. The run is finished with the others carried forward
+run_id, resumed = pg_bloat_check.start_run(cur, 8192)
+writer = pg_bloat_check.StatsWriter(None, run_id)
+writer.add_stats('bloat_tables', stats_row(10, 'big', 'table', 8192))
+writer.add_scan_state(scan_state(10, 'r'), 81920)
+writer.flush()
+pg_bloat_check.finish_run(cur, run_id, [11, 12, 13], [10, 11, 12, 13])
+test_value("budgeted run report", [ (r['oid'], r['dead_tuple_size_bytes']) for r in pg_bloat_check.get_report_rows(None, "storetest") ], [ (11, 20480), (12, 10240), (10, 8192) ])
+test_value("budgeted run finished", pg_bloat_check.get_last_run(None, "storetest")['run_id'], run_id)
+# the next run ranks objects by the statistics just recorded
+test_value("second budgeted run order", [ o['oid'] for o in pg_bloat_check.order_by_scan_priority(cur, budget_objects(), 8192) ], [11, 12, 10, 13])
+
+pg_bloat_check.close_result_store()
+store_dir.cleanup()
+pg_bloat_check.configure()
+
+### End of --time_budget test ###
+
+### This section tests sum_block_stats() ###
+
+block_rows = [ { 'tuple_count': 10, 'tuple_len': 4000, 'dead_tuple_count': 2, 'dead_tuple_len': 800, 'free_space': 3000 }
+             , { 'tuple_count': 20, 'tuple_len': 6000, 'dead_tuple_count': 0, 'dead_tuple_len': 0, 'free_space': 1000 } ]
+# two blocks read out of eight are scaled up four times
+test_value("sum_block_stats() of a sample", pg_bloat_check.sum_block_stats(block_rows, 8, 8192),
+    { 'table_len': 65536, 'relpages': 8, 'tuple_count': 120, 'tuple_len': 40000, 'dead_tuple_count': 8, 'dead_tuple_len': 3200
+    , 'free_space': 16000, 'tuple_percent': 40000 * 100.0 / 65536, 'dead_tuple_percent': 3200 * 100.0 / 65536
+    , 'free_percent': 16000 * 100.0 / 65536 })
+test_value("sum_block_stats() of every block", pg_bloat_check.sum_block_stats(block_rows, 2, 8192)['dead_tuple_len'], 800)
+
+### End of sum_block_stats() test ###
+
+### This section tests the waves of get_rebuild_plan() & the commands of rebuild_index() ###
+
+class RebuildPlanCursor:
+    """
+    Stands in for a cursor, returning the given index metadata as the rebuild plan query would.
+    """
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def mogrify(self, sql, params):
+        return sql
+
+    def execute(self, sql, params):
+        self.oids = params[0]
+
+    def fetchall(self):
+        return [ m for m in self.metadata if m['oid'] in self.oids ]
+
+    def close(self):
+        pass
+
+class RebuildPlanConnection:
+    """
+    Stands in for a connection to a server of the given version whose cursors return the given index metadata.
+    """
+    def __init__(self, metadata, server_version):
+        self.metadata = metadata
+        self.server_version = server_version
+
+    def cursor(self, cursor_factory=None):
+        return RebuildPlanCursor(self.metadata)
+
+    def commit(self):
+        pass
+
+def index_row(oid, objectname):
+    return { 'oid': oid, 'schemaname': 'public', 'objectname': objectname, 'objecttype': 'index', 'wasted_bytes': 1000 }
+
+def index_metadata(oid, table_oid, issystem=False, isexclusion=False):
+    return { 'oid': oid, 'table_oid': table_oid, 'nspname': 'public', 'relname': 't' + str(table_oid), 'spcname': None
+           , 'indexdef': 'CREATE INDEX i' + str(oid) + ' ON public.t' + str(table_oid) + ' USING btree (id)', 'indisclustered': False
+           , 'isconstraint': isexclusion, 'isexclusion': isexclusion, 'issystem': issystem
+           , 'build_io': '16 kB', 'reclaimable': '1000 bytes', 'build_io_bytes': 16384, 'reclaimable_bytes': 1000 }
+
+# index 5 was dropped since it was scanned
+cur = RebuildPlanCursor([ index_metadata(1, 100), index_metadata(2, 200), index_metadata(3, 100), index_metadata(4, 100), index_metadata(6, 200) ])
+plan = pg_bloat_check.get_rebuild_plan(cur, [ index_row(1, "a"), index_row(2, "b"), index_row(3, "c"), index_row(4, "d"), index_row(5, "e"), index_row(6, "f") ])
+test_value("get_rebuild_plan() waves", [ (p['objectname'], p['wave']) for p in plan ], [ ("a", 1), ("b", 1), ("c", 2), ("d", 3), ("f", 2) ])
+
+# system catalog & exclusion constraint indexes cannot be rebuilt concurrently, so their REINDEX is left commented out
+for server_version in [110000, 160000]:
+    conn = RebuildPlanConnection([ index_metadata(1, 100), index_metadata(2, 1259, issystem=True), index_metadata(3, 300, isexclusion=True) ], server_version)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        pg_bloat_check.rebuild_index(conn, [ index_row(1, "i1"), index_row(2, "i2"), index_row(3, "i3") ])
+    commands = [ l for l in output.getvalue().splitlines() if l != "" and (not l.startswith("--") or "REINDEX" in l) ]
+    if server_version >= 120000:
+        test_value("rebuild_index() commands of server version {}".format(server_version), commands[0], 'REINDEX INDEX CONCURRENTLY "public"."i1";')
+    else:
+        test_value("rebuild_index() commands of server version {}".format(server_version), commands[0].startswith("CREATE INDEX CONCURRENTLY pgbloatcheck_rebuild_"), True)
+    test_value("rebuild_index() commands of server version {}".format(server_version), commands[-2:], [ '-- REINDEX INDEX "public"."i2";', '-- REINDEX INDEX "public"."i3";' ])
+
+### End of get_rebuild_plan() test ###
+
+### This section tests format_openmetrics() ###
+
+metrics_row = dict(report_row(1, 'we"ird\\name\nx'), database="db", fillfactor=90.0, wasted_bytes=2000)
+lines = pg_bloat_check.format_openmetrics([metrics_row], [])
+test_value("format_openmetrics() label escaping", lines[2], 'pg_bloat_check_size_bytes{database="db",schema="public",object="we\\"ird\\\\name\\nx",type="table"} 81920')
+# wasted percent leaves out the free space reserved by fillfactor
+test_value("format_openmetrics() wasted percent", lines[14].split(" ")[-1], "{:.2f}".format(1.22 + 48.83 - 10))
+test_value("format_openmetrics() last line", lines[-1], "# EOF")
+
+### End of format_openmetrics() test ###
+
+### This section tests check_object_changed() of --incremental ###
+
+def change_counters(relkind='r', relfilenode=1, n_tup_upd=0, n_tup_del=0, n_tup_hot_upd=0, vacuum_count=0, autovacuum_count=0):
+    return { 'relkind': relkind, 'relfilenode': relfilenode, 'n_tup_upd': n_tup_upd, 'n_tup_del': n_tup_del, 'n_tup_hot_upd': n_tup_hot_upd
+           , 'vacuum_count': vacuum_count, 'autovacuum_count': autovacuum_count, 'parent_reltuples': 1000 }
+
+pg_bloat_check.configure(incremental=True, incremental_threshold=10)
+state = change_counters(n_tup_upd=500, n_tup_del=100, n_tup_hot_upd=400, vacuum_count=2)
+test_value("check_object_changed() never scanned", pg_bloat_check.check_object_changed(change_counters(), None), True)
+test_value("check_object_changed() unchanged", pg_bloat_check.check_object_changed(dict(state), state), False)
+test_value("check_object_changed() rewritten", pg_bloat_check.check_object_changed(dict(state, relfilenode=2), state), True)
+test_value("check_object_changed() counters reset", pg_bloat_check.check_object_changed(change_counters(n_tup_upd=10), state), True)
+# 10% of 1000 rows may change before the object is scanned again
+test_value("check_object_changed() below threshold", pg_bloat_check.check_object_changed(dict(state, n_tup_upd=550, n_tup_del=150), state), False)
+test_value("check_object_changed() above threshold", pg_bloat_check.check_object_changed(dict(state, n_tup_upd=560, n_tup_del=150), state), True)
+# heap only tuple updates add no index entries, so they only count for tables
+hot_updated = dict(state, n_tup_upd=650, n_tup_hot_upd=500)
+test_value("check_object_changed() hot updates of a table", pg_bloat_check.check_object_changed(hot_updated, state), True)
+test_value("check_object_changed() hot updates of an index", pg_bloat_check.check_object_changed(dict(hot_updated, relkind='i'), dict(state, relkind='i')), False)
+pg_bloat_check.configure()
+
+### End of check_object_changed() test ###
+
+### This section tests apply_triage_estimates() of --triage ###
+
+class TriageCursor:
+    """
+    Stands in for a cursor, returning the given catalog statistics for the table or index query of apply_triage_estimates().
+    """
+    def __init__(self, table_stats, index_stats):
+        self.table_stats = table_stats
+        self.index_stats = index_stats
+
+    def execute(self, sql, params):
+        stats = self.index_stats if "pg_index" in sql else self.table_stats
+        self.rows = [ s for s in stats if s['oid'] in params[0] ]
+
+    def fetchall(self):
+        return self.rows
+
+def triage_object(oid, relkind, pages):
+    return { 'oid': oid, 'relkind': relkind, 'nspname': 'public', 'relname': 'o' + str(oid), 'reloptions': None, 'relation_size': pages * 8192 }
+
+def triage_stats(oid, reltuples, data_width, stats_count=2, amname=None):
+    return { 'oid': oid, 'reltuples': reltuples, 'att_count': 2, 'stats_count': stats_count, 'data_width': data_width, 'has_nulls': False, 'amname': amname }
+
+# 1000 rows of 132 byte heap tuples fit in 17 pages and 1000 btree entries of 20 bytes in 3 pages plus the metapage
+cur = TriageCursor([ triage_stats(1, 1000, 100), triage_stats(2, 1000, 100), triage_stats(3, 1000, 100, stats_count=1) ]
+                 , [ triage_stats(4, 1000, 8, amname='btree'), triage_stats(5, 1000, 8, amname='gist') ])
+triage_list = [ triage_object(1, 'r', 17), triage_object(2, 'r', 100), triage_object(3, 'r', 100), triage_object(4, 'i', 4), triage_object(5, 'i', 4) ]
+pg_bloat_check.configure(triage=True)
+test_value("apply_triage_estimates() objects to scan", pg_bloat_check.apply_triage_estimates(cur, triage_list, 8192), 3)
+# the bloated table, the table missing column statistics & the non btree index are still scanned
+test_value("apply_triage_estimates() objects estimated", [ o['oid'] for o in triage_list if 'estimate' in o ], [1, 4])
+test_value("apply_triage_estimates() table estimate", triage_list[0]['estimate'],
+    { 'table_len': 139264, 'tuple_count': 1000, 'tuple_len': 132000, 'tuple_percent': 132000 / 139264 * 100, 'dead_tuple_count': 0
+    , 'dead_tuple_len': 0, 'dead_tuple_percent': 0, 'free_space': 0, 'free_percent': 0.0, 'relpages': 17 })
+# free space of an index includes the space reserved by its fillfactor of 90
+test_value("apply_triage_estimates() index free space", triage_list[3]['estimate']['free_space'], int(0.4 * 8192))
+pg_bloat_check.configure()
+
+### End of apply_triage_estimates() test ###
+
+### This section tests order_by_scan_priority() of --time_budget ###
+
+class PreviousStatsCursor:
+    """
+    Stands in for a cursor, returning the wasted space each object had in the previous run.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, params):
+        self.block_size = params[0]
+
+    def fetchall(self):
+        return self.rows
+
+cur = PreviousStatsCursor([ { 'oid': 1, 'wasted_size': 5000 }, { 'oid': 2, 'wasted_size': 90000 }, { 'oid': 3, 'wasted_size': -800 } ])
+priority_list = [ { 'oid': 1, 'relation_size': 8192 }, { 'oid': 2, 'relation_size': 8192 }, { 'oid': 3, 'relation_size': 819200 }
+                , { 'oid': 4, 'relation_size': 16384 }, { 'oid': 5, 'relation_size': 4096000 } ]
+pg_bloat_check.configure()
+ordered = pg_bloat_check.order_by_scan_priority(cur, priority_list, 8192)
+# negative wasted space from fillfactor rounding counts as none, so those objects are ordered by size with new ones
+test_value("order_by_scan_priority() order", [ o['oid'] for o in ordered ], [2, 1, 5, 3, 4])
+test_value("order_by_scan_priority() block size", cur.block_size, 8192)
+test_value("order_by_scan_priority() object count", len(priority_list), 5)
+
+### End of order_by_scan_priority() test ###
+
+### This section tests ReadRateLimiter of --max_read_rate ###
+
+import time
+
+limiter = pg_bloat_check.ReadRateLimiter(1048576)
+pace_start = time.time()
+# two reads of 50kB at 1MB/s must together take at least a tenth of a second
+limiter.consume(52428)
+limiter.consume(52428)
+test_value("ReadRateLimiter pacing", time.time() - pace_start >= 0.099, True)
+test_value("ReadRateLimiter bytes read", limiter.bytes_read, 104856)
+test_value("ReadRateLimiter seconds paced", round(limiter.seconds_paced, 1), 0.1)
+test_value("ReadRateLimiter summary", limiter.summary().endswith("limit 1.00 MB/s). Waited 0.1 seconds to stay under --max_read_rate."), True)
+# a read after the limiter has been idle does not wait for the time it was idle
+limiter = pg_bloat_check.ReadRateLimiter(1048576)
+limiter.start_time -= 10
+limiter.next_time -= 10
+limiter.consume(1024)
+test_value("ReadRateLimiter idle", limiter.seconds_paced < 0.01, True)
+
+### End of ReadRateLimiter test ###
+
+### This section tests check_analyze_needed() of --analyze_threshold ###
+
+def analyze_object(relkind="r", parent_nspname="public", last_analyze="2024-01-01", n_mod_since_analyze=0, parent_reltuples=1000):
+    return { 'relkind': relkind, 'parent_nspname': parent_nspname, 'last_analyze': last_analyze, 'n_mod_since_analyze': n_mod_since_analyze, 'parent_reltuples': parent_reltuples }
+
+pg_bloat_check.configure(analyze_threshold=10)
+test_value("check_analyze_needed() recently analyzed", pg_bloat_check.check_analyze_needed(analyze_object(n_mod_since_analyze=100)), False)
+test_value("check_analyze_needed() over threshold", pg_bloat_check.check_analyze_needed(analyze_object(n_mod_since_analyze=101)), True)
+test_value("check_analyze_needed() never analyzed", pg_bloat_check.check_analyze_needed(analyze_object(last_analyze=None)), True)
+test_value("check_analyze_needed() no statistics", pg_bloat_check.check_analyze_needed(analyze_object(n_mod_since_analyze=None)), True)
+test_value("check_analyze_needed() unknown row count", pg_bloat_check.check_analyze_needed(analyze_object(parent_reltuples=-1)), True)
+# an empty table is analyzed again after a single modified row
+test_value("check_analyze_needed() empty table", pg_bloat_check.check_analyze_needed(analyze_object(n_mod_since_analyze=1, parent_reltuples=0)), True)
+test_value("check_analyze_needed() toast table", pg_bloat_check.check_analyze_needed(analyze_object(relkind="t", last_analyze=None)), False)
+test_value("check_analyze_needed() toast index", pg_bloat_check.check_analyze_needed(analyze_object(relkind="i", parent_nspname="pg_toast", last_analyze=None)), False)
+pg_bloat_check.configure(analyze_threshold=50)
+test_value("check_analyze_needed() raised threshold", pg_bloat_check.check_analyze_needed(analyze_object(n_mod_since_analyze=101)), False)
+pg_bloat_check.configure()
+
+### End of check_analyze_needed() test ###
+
+### This section tests check_fsm_stale() of --fsm ###
+
+def fsm_object(last_vacuum="2024-01-01", fsm_size=24576, n_ins_since_vacuum=0, n_dead_tup=0, parent_reltuples=1000):
+    return { 'last_vacuum': last_vacuum, 'fsm_size': fsm_size, 'n_ins_since_vacuum': n_ins_since_vacuum, 'n_dead_tup': n_dead_tup, 'parent_reltuples': parent_reltuples }
+
+pg_bloat_check.configure(fsm_stale_threshold=10)
+test_value("check_fsm_stale() recently vacuumed", pg_bloat_check.check_fsm_stale(fsm_object(n_ins_since_vacuum=60, n_dead_tup=40)), False)
+# inserted and dead rows are counted together against the threshold
+test_value("check_fsm_stale() over threshold", pg_bloat_check.check_fsm_stale(fsm_object(n_ins_since_vacuum=60, n_dead_tup=41)), True)
+test_value("check_fsm_stale() never vacuumed", pg_bloat_check.check_fsm_stale(fsm_object(last_vacuum=None)), True)
+test_value("check_fsm_stale() no free space map", pg_bloat_check.check_fsm_stale(fsm_object(fsm_size=0)), True)
+test_value("check_fsm_stale() empty table", pg_bloat_check.check_fsm_stale(fsm_object(n_dead_tup=1, parent_reltuples=0)), True)
+pg_bloat_check.configure(fsm_stale_threshold=50)
+test_value("check_fsm_stale() raised threshold", pg_bloat_check.check_fsm_stale(fsm_object(n_ins_since_vacuum=60, n_dead_tup=41)), False)
+pg_bloat_check.configure()
+
+### End of check_fsm_stale() test ###